@@ -0,0 +1,426 @@
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "server"), os.path.join(ROOT, "client")]  # Make both ends importable
+
+import numpy as np
+
+from common import compression, metrics, protocol, tile_delta
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+RESOLUTIONS = {"1080p": (1920, 1080), "1440p": (2560, 1440), "4k": (3840, 2160)}
+DEFAULT_SCENES = ("static", "typing", "window_drag", "video")
+
+
+class NullDisplay:
+    """
+    NullDisplay stands in for FrameDisplay, counting the displayed frames instead of showing them.
+
+    Attributes:
+        frame_count (int): The number of displayed frames.
+        deadline (float): The time.perf_counter() time after which the client quits.
+    """
+
+    def __init__(self, duration):
+        self.frame_count = 0
+        self.deadline = time.perf_counter() + duration
+
+    def set_frame_size(self, frame_width, frame_height):
+        pass
+
+    def display_frame(self, frame):
+        self.frame_count += 1
+
+    def wait_for_quit(self):
+        time.sleep(0.001)  # FrameDisplay.wait_for_quit waits 1 ms for a key press
+        return time.perf_counter() >= self.deadline
+
+    def close(self):
+        pass
+
+
+def peak_rss_mb():
+    """
+    Get the peak resident set size of this process.
+
+    Returns:
+        float: The peak RSS in MiB, or None where the resource module is missing.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024  # Bytes on macOS, KiB elsewhere
+
+
+def free_port():
+    """
+    Find a free TCP port on the loopback interface.
+
+    Returns:
+        int: The port number.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def environment():
+    """
+    Describe the machine and the build the benchmarks run on.
+
+    Returns:
+        dict: The environment record.
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "benchmark": "environment",
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "zero_copy_decompression": compression.ZERO_COPY_DECOMPRESSION,
+    }
+
+
+def _stage_summary(registry, elapsed):
+    """
+    Summarize the stage histograms of a run.
+
+    Returns:
+        dict: Per "side.stage" the mean and p99 duration in ms and the share of one core spent in the stage.
+    """
+    stages = {}
+    for metric in registry.metrics.values():
+        if not isinstance(metric, metrics.Histogram) or not metric.name.endswith("_stage_seconds") or not metric.count:
+            continue
+        side = metric.name[len(registry.prefix) + 1:].split("_")[0]
+        stages[f"{side}.{metric.labels['stage']}"] = {
+            "mean_ms": 1000 * metric.sum / metric.count,
+            "p99_ms": 1000 * metric.quantile(0.99),
+            "core_share": metric.sum / elapsed,
+        }
+    return stages
+
+
+def run_stream(scene, resolution, duration, frame_rate, encoder_workers, applier, pipelined, target_latency):
+    """
+    Stream a synthetic scene from a ServerHandler to a ClientHandler over loopback, in this process.
+
+    Args:
+        scene (str): The synthetic scene.
+        resolution (str): A key of RESOLUTIONS.
+        duration (float): The seconds to stream for.
+        frame_rate (int): The server's frame rate limit.
+        encoder_workers (int): The number of encoder processes.
+        applier (str): The client's diff applier.
+        pipelined (bool): Whether the client runs pipelined.
+        target_latency (float): The server's latency target in seconds, or None.
+
+    Returns:
+        dict: The result record.
+    """
+    metrics.REGISTRY = metrics.MetricsRegistry()  # Fresh metrics, the handlers look the registry up when created
+    from server_handler import ServerHandler
+    from client_handler import ClientHandler
+
+    frame_width, frame_height = RESOLUTIONS[resolution]
+    port = free_port()
+    server = ServerHandler("127.0.0.1", port, frame_width, frame_height, frame_rate, "synthetic", {"scene": scene},
+                           encoder_workers, target_latency)
+    server_thread = threading.Thread(target=server.start_server, daemon=True)
+    server_thread.start()
+    while not server.running:
+        time.sleep(0.01)
+
+    client = ClientHandler("127.0.0.1", port, applier=applier, pipelined=pipelined)
+    client.display = NullDisplay(duration)
+    cpu_start = time.process_time()
+    start_time = time.perf_counter()
+    client.start()
+    elapsed = time.perf_counter() - start_time
+    cpu_time = time.process_time() - cpu_start
+    server.stop_server()
+
+    registry = metrics.REGISTRY
+    snapshot = registry.snapshot()
+    latency = snapshot.get("screenshare_client_latency_seconds", {})
+    frames_sent = registry.counter("server_frames_total").value
+    return {
+        "benchmark": "stream",
+        "scene": scene,
+        "resolution": resolution,
+        "width": frame_width,
+        "height": frame_height,
+        "frame_rate": frame_rate,
+        "encoder_workers": encoder_workers,
+        "applier": type(client.processor).__name__,
+        "pipelined": pipelined,
+        "duration_s": elapsed,
+        "fps": client.display.frame_count / elapsed,
+        "server_fps": frames_sent / elapsed,
+        "latency_p50_ms": 1000 * latency.get("p50", 0.0),
+        "latency_p99_ms": 1000 * latency.get("p99", 0.0),
+        "bytes_per_frame": registry.counter("server_sent_bytes_total").value / max(1, frames_sent),
+        "compression_ratio": (registry.counter("server_encoded_bytes_total").value /
+                              max(1, registry.counter("server_compressed_bytes_total").value)),
+        "dirty_ratio_mean": snapshot.get("screenshare_server_dirty_ratio", {}).get("mean", 0.0),
+        "dropped_frames": (registry.counter("server_dropped_frames_total").value +
+                           registry.counter("client_dropped_frames_total").value),
+        "cpu_share": cpu_time / elapsed,  # Cores used by both ends together
+        "stages": _stage_summary(registry, elapsed),
+        "peak_rss_mb": peak_rss_mb(),  # Both ends run in this process
+    }
+
+
+def _measure(function, iterations, setup=None):
+    """
+    Time repeated calls of a function.
+
+    Args:
+        function (callable): The function to time.
+        iterations (int): The number of timed calls.
+        setup (callable, optional): Called untimed before every call. Defaults to None.
+
+    Returns:
+        dict: The mean, median and p99 duration in ms.
+    """
+    timings = []
+    for _ in range(iterations):
+        if setup is not None:
+            setup()
+        start_time = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start_time)
+    timings = np.array(timings) * 1000
+    return {"iterations": iterations, "mean_ms": float(timings.mean()), "p50_ms": float(np.median(timings)),
+            "p99_ms": float(np.percentile(timings, 99))}
+
+
+def _changing_frames(scene, frame_width, frame_height, max_frames=120):
+    """
+    Generate the first two consecutive frames of a synthetic scene that differ, as (height, width) uint32 arrays.
+    """
+    from capture_backends import SyntheticBackend
+    backend = SyntheticBackend(frame_width, frame_height, 1000, scene)
+    grab = lambda: np.array(backend.grab_frame()).view(np.uint32).reshape((frame_height, frame_width))
+    old_frame = grab()
+    for _ in range(max_frames):
+        new_frame = grab()
+        if not np.array_equal(old_frame, new_frame):
+            break
+        old_frame = new_frame
+    backend.stop()
+    return old_frame, new_frame
+
+
+def _drain(sock):
+    """
+    Receive and discard data until the peer closes the connection.
+    """
+    while sock.recv(1 << 20):
+        pass
+    sock.close()
+
+
+class _Feeder:
+    """
+    A loopback server sending the same frame message over and over, for timing FrameReceiver.receive_data.
+    """
+
+    def __init__(self, frame_width, frame_height, packet):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+        self.hello = protocol.hello_packet({0: (frame_width, frame_height)})
+        self.packet = packet
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        connection, _ = self.listener.accept()
+        try:
+            protocol.send_message(connection, self.hello.header_bytes, self.hello.payload)
+            while True:
+                protocol.send_message(connection, self.packet.header_bytes, self.packet.payload)
+        except OSError:
+            pass  # The receiver disconnected
+        finally:
+            connection.close()
+            self.listener.close()
+
+
+def run_micro(resolution, iterations, scene="window_drag"):
+    """
+    Time the hot functions of both ends at a resolution, on the update between two frames of a scene.
+
+    Args:
+        resolution (str): A key of RESOLUTIONS.
+        iterations (int): The number of timed calls per function.
+        scene (str, optional): The synthetic scene the frames come from. Defaults to "window_drag".
+
+    Returns:
+        list: The result records.
+    """
+    from frame_processor import FrameProcessor
+    from frame_receiver import FrameReceiver
+    from diff_applier import NumPyDiffApplier
+
+    frame_width, frame_height = RESOLUTIONS[resolution]
+    old_frame, new_frame = _changing_frames(scene, frame_width, frame_height)
+    back_buffer = old_frame.copy()
+    dirty_tiles = tile_delta.find_dirty_tiles(old_frame, new_frame)
+    delta = tile_delta.encode_tiles(new_frame, dirty_tiles)
+    compressed = compression.compress_block(delta)
+    header = protocol.MessageHeader(protocol.MSG_FRAME, codec=protocol.CODEC_LZ4_BLOCK, frame_id=1,
+                                    width=frame_width, height=frame_height)
+    packet = protocol.Packet(header, compressed)
+    results = {}
+
+    results["calculate_diff"] = _measure(lambda: FrameProcessor.calculate_diff(back_buffer, new_frame), iterations,
+                                         setup=lambda: np.copyto(back_buffer, old_frame))
+
+    results["estimate_motion"] = _measure(lambda: FrameProcessor.estimate_motion(old_frame, new_frame), iterations)
+
+    frame_processor = FrameProcessor(frame_width, frame_height)
+    bgra_frame = new_frame.view(np.uint8).reshape((frame_height, frame_width, 4)).copy()
+    results["draw_overlay"] = _measure(lambda: frame_processor.draw_overlay(bgra_frame), iterations)
+
+    results["encode_tiles"] = _measure(lambda: tile_delta.encode_tiles(new_frame, dirty_tiles), iterations)
+    results["compress_block"] = _measure(lambda: compression.compress_block(delta), iterations)
+    if compression.ZSTD_AVAILABLE:
+        results["compress_zstd"] = _measure(lambda: compression.compress_zstd(delta), iterations)
+
+    # Sending: a reader thread drains the other end of a socket pair
+    sender, reader = socket.socketpair()
+    threading.Thread(target=_drain, args=(reader,), daemon=True).start()
+    results["send_frame"] = _measure(lambda: protocol.send_message(sender, packet.header_bytes, packet.payload),
+                                     iterations)
+    sender.close()
+
+    feeder = _Feeder(frame_width, frame_height, packet)
+    receiver = FrameReceiver("127.0.0.1", feeder.port)
+    receiver.subscribe([0])
+    received = receiver.receive_data()  # Warm up the receive buffers
+    results["receive_data"] = _measure(receiver.receive_data, iterations)
+    receiver.close()
+
+    applier = NumPyDiffApplier(frame_width, frame_height)
+    results["apply_delta"] = _measure(lambda: applier.process_frame(received), iterations)
+
+    records = []
+    for name, result in results.items():
+        record = {"benchmark": "micro", "name": name, "scene": scene, "resolution": resolution, "width": frame_width,
+                  "height": frame_height, "dirty_tiles": len(dirty_tiles), "payload_bytes": len(compressed)}
+        record.update(result)
+        records.append(record)
+    return records
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the screen sharing pipeline headless over loopback. "
+                                                 "Results are written as JSON lines, one record per benchmark.")
+    parser.add_argument("--suite", choices=("stream", "micro", "all"), default="all", help="The benchmarks to run.")
+    parser.add_argument("--resolutions", nargs="+", choices=list(RESOLUTIONS), default=list(RESOLUTIONS),
+                        help="The resolutions to benchmark.")
+    parser.add_argument("--scenes", nargs="+", default=list(DEFAULT_SCENES), help="The synthetic scenes to stream.")
+    parser.add_argument("--duration", type=float, default=5.0, help="The seconds to stream each scene for.")
+    parser.add_argument("--fps", type=int, default=60, help="The server's frame rate limit.")
+    parser.add_argument("--encoder-workers", type=int, default=0, help="The number of encoder processes.")
+    parser.add_argument("--applier", default="numpy", help="The client's diff applier.")
+    parser.add_argument("--sequential", action="store_true", help="Run the client without pipelining.")
+    parser.add_argument("--target-latency", type=int, default=0,
+                        help="The latency target in milliseconds, 0 streams at full quality.")
+    parser.add_argument("--iterations", type=int, default=50, help="The timed calls per micro-benchmark.")
+    parser.add_argument("--micro-scene", default="window_drag", help="The synthetic scene of the micro-benchmarks.")
+    parser.add_argument("--output", help="The file to append the results to. Defaults to stdout.")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the streaming runs.")
+    parser.add_argument("--case", help=argparse.SUPPRESS)  # A single streaming run, used by the subprocesses
+    return parser.parse_args()
+
+
+def run_case(case):
+    """
+    Run a single streaming benchmark and print its record as the last line of stdout.
+
+    Args:
+        case (str): The JSON encoded arguments of run_stream.
+    """
+    stdout = sys.stdout
+    sys.stdout = sys.stderr  # The handlers print progress, keep stdout for the record
+    try:
+        record = run_stream(**json.loads(case))
+    finally:
+        sys.stdout = stdout
+    print(json.dumps(record), flush=True)
+
+
+def stream_in_subprocess(case, timeout, verbose):
+    """
+    Run a streaming benchmark in a fresh process, so memory and metrics of the runs don't mix.
+
+    Returns:
+        dict: The result record, or an error record.
+    """
+    try:
+        completed = subprocess.run([sys.executable, os.path.abspath(__file__), "--case", json.dumps(case)],
+                                   stdout=subprocess.PIPE, stderr=None if verbose else subprocess.DEVNULL,
+                                   text=True, timeout=timeout)
+        lines = completed.stdout.strip().splitlines()
+        if completed.returncode == 0 and lines:
+            return json.loads(lines[-1])
+        error = f"exit code {completed.returncode}"
+    except subprocess.TimeoutExpired:
+        error = f"timed out after {timeout} s"
+    record = {"benchmark": "stream", "error": error}
+    record.update(case)
+    return record
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.case:
+        run_case(args.case)
+        sys.exit()
+
+    output = open(args.output, "a") if args.output else sys.stdout
+
+    def emit(record):
+        output.write(json.dumps(record) + "\n")
+        output.flush()
+
+    emit(environment())
+    try:
+        if args.suite in ("micro", "all"):
+            for resolution in args.resolutions:
+                for record in run_micro(resolution, args.iterations, args.micro_scene):
+                    emit(record)
+        if args.suite in ("stream", "all"):
+            for resolution in args.resolutions:
+                for scene in args.scenes:
+                    case = {"scene": scene, "resolution": resolution, "duration": args.duration,
+                            "frame_rate": args.fps, "encoder_workers": args.encoder_workers,
+                            "applier": args.applier, "pipelined": not args.sequential,
+                            "target_latency": args.target_latency / 1000 or None}
+                    emit(stream_in_subprocess(case, args.duration + 120, args.verbose))
+    finally:
+        if output is not sys.stdout:
+            output.close()
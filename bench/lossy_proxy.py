@@ -0,0 +1,245 @@
+import argparse
+import heapq
+import os
+import random
+import select
+import socket
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "server")]
+
+from relay import parse_address
+
+MAX_DATAGRAM_SIZE = 65536
+SOCKET_BUFFER_SIZE = 8 * 1024 * 1024  # Bytes of datagrams the sockets buffer, so the proxy itself drops none
+POLL_INTERVAL = 0.5  # Seconds between checks whether the proxy was closed
+
+
+class LossyProxy:
+    """
+    LossyProxy sits between a client and a server on the local machine and simulates a bad network
+    for the datagrams between them: it drops a share of them in both directions and delivers the
+    others late, by a fixed delay plus a random jitter, which also reorders them. The TCP connections
+    on the same port are forwarded unchanged, as TCP hides losses behind retransmissions anyway.
+
+    Each client address gets an upstream UDP socket of its own, so the server sees one address per
+    client and its datagrams find their way back.
+
+    Attributes:
+        listen_port (int): The TCP and UDP port the proxy listens on.
+        target (tuple): The host and port of the server.
+        loss (float): The share of datagrams dropped, 0 to 1.
+        delay (float): The seconds each datagram is delayed by.
+        jitter (float): The seconds of random delay added on top, at most.
+        forwarded (int): The number of datagrams forwarded so far.
+        dropped (int): The number of datagrams dropped so far.
+    """
+
+    def __init__(self, listen_port, target_host, target_port, loss=0.0, delay=0.0, jitter=0.0, seed=None,
+                 listen_host="127.0.0.1"):
+        """
+        Initializes the LossyProxy.
+
+        Args:
+            listen_port (int): The TCP and UDP port to listen on.
+            target_host (str): The host address of the server.
+            target_port (int): The port of the server.
+            loss (float, optional): The share of datagrams to drop, 0 to 1. Defaults to 0.
+            delay (float, optional): The seconds to delay each datagram by. Defaults to 0.
+            jitter (float, optional): The seconds of random delay to add on top, at most. Defaults to 0.
+            seed (int, optional): The seed of the random losses and jitter, for repeatable runs. Defaults to None.
+            listen_host (str, optional): The host address to listen on. Defaults to "127.0.0.1".
+        """
+        self.listen_host = listen_host
+        self.listen_port = listen_port
+        self.target = (target_host, target_port)
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.forwarded = 0
+        self.dropped = 0
+        self.running = False
+        self.tcp_socket = None
+        self.udp_socket = None
+        self.upstreams = {}  # The upstream socket of each client address
+        self.clients = {}  # The client address of each upstream socket
+        self.queue = []  # The (due time, order, socket, datagram, address) of the delayed datagrams
+        self.order = 0
+        self.condition = threading.Condition()
+        self.threads = []
+
+    def start(self):
+        """
+        Start listening and forwarding.
+        """
+        self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp_socket.bind((self.listen_host, self.listen_port))
+        self.tcp_socket.listen()
+        self.udp_socket = self._datagram_socket()
+        self.udp_socket.bind((self.listen_host, self.listen_port))
+        self.running = True
+        for target in (self._accept_connections, self._receive_datagrams, self._send_datagrams):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _datagram_socket(self):
+        """
+        Create a UDP socket with large buffers.
+
+        Returns:
+            socket.socket: The socket.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        return sock
+
+    def _accept_connections(self):
+        """
+        Accept TCP connections and forward each to the server.
+        """
+        while self.running:
+            try:
+                if not select.select([self.tcp_socket], [], [], POLL_INTERVAL)[0]:
+                    continue
+                client_socket, _ = self.tcp_socket.accept()
+                server_socket = socket.create_connection(self.target)
+            except OSError:
+                if not self.running:
+                    break
+                continue
+            for sockets in ((client_socket, server_socket), (server_socket, client_socket)):
+                sockets[0].setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                threading.Thread(target=self._forward_stream, args=sockets, daemon=True).start()
+
+    def _forward_stream(self, source, destination):
+        """
+        Forward the data of a TCP connection in one direction until either end closes it.
+        """
+        try:
+            while True:
+                data = source.recv(MAX_DATAGRAM_SIZE)
+                if not data:
+                    break
+                destination.sendall(data)
+        except OSError:
+            pass
+        finally:
+            for sock in (source, destination):
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)  # Ends the other direction too
+                except OSError:
+                    pass
+
+    def _receive_datagrams(self):
+        """
+        Receive the datagrams of the clients and of the server, and queue them for delivery.
+        """
+        while self.running:
+            try:
+                readable = select.select([self.udp_socket, *self.clients], [], [], POLL_INTERVAL)[0]
+            except (OSError, ValueError):
+                break  # Closed
+            for sock in readable:
+                try:
+                    datagram, address = sock.recvfrom(MAX_DATAGRAM_SIZE)
+                except OSError:
+                    continue  # E.g. a datagram to the server bounced off a closed port
+                if sock is self.udp_socket:
+                    upstream = self.upstreams.get(address)
+                    if upstream is None:
+                        upstream = self._datagram_socket()
+                        upstream.connect(self.target)
+                        self.upstreams[address] = upstream
+                        self.clients[upstream] = address
+                    self._queue(upstream, datagram, None)
+                else:
+                    self._queue(self.udp_socket, datagram, self.clients[sock])
+
+    def _queue(self, sock, datagram, address):
+        """
+        Drop a datagram, or queue it for delivery after the delay and jitter.
+
+        Args:
+            sock (socket.socket): The socket to send it with.
+            datagram (bytes): The datagram.
+            address (tuple): The address to send it to, or None for the one the socket is connected to.
+        """
+        if self.random.random() < self.loss:
+            self.dropped += 1
+            return
+        due = time.perf_counter() + self.delay + self.random.uniform(0.0, self.jitter)
+        with self.condition:
+            heapq.heappush(self.queue, (due, self.order, sock, datagram, address))
+            self.order += 1
+            self.condition.notify()
+
+    def _send_datagrams(self):
+        """
+        Send the queued datagrams once they are due.
+        """
+        while self.running:
+            with self.condition:
+                now = time.perf_counter()
+                if not self.queue or self.queue[0][0] > now:
+                    self.condition.wait(min(self.queue[0][0] - now, POLL_INTERVAL) if self.queue else POLL_INTERVAL)
+                    continue
+                _, _, sock, datagram, address = heapq.heappop(self.queue)
+            try:
+                if address is None:
+                    sock.send(datagram)
+                else:
+                    sock.sendto(datagram, address)
+                self.forwarded += 1
+            except OSError:
+                self.dropped += 1  # Nobody listening, or the buffer is full: lost like on a real network
+
+    def close(self):
+        """
+        Stop forwarding and close the sockets.
+        """
+        self.running = False
+        with self.condition:
+            self.condition.notify()
+        for sock in [self.tcp_socket, self.udp_socket, *self.clients]:
+            if sock is not None:
+                sock.close()
+        for thread in self.threads:
+            thread.join(2 * POLL_INTERVAL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Forward a server's connections, dropping and delaying its "
+                                                 "datagrams to test the UDP transport under loss.")
+    parser.add_argument("--listen", type=int, default=9999, help="The TCP and UDP port to listen on.")
+    parser.add_argument("--target", type=parse_address, default=("127.0.0.1", 9998),
+                        help="The host:port of the server.")
+    parser.add_argument("--loss", type=float, default=0.02, help="The share of datagrams to drop, 0 to 1.")
+    parser.add_argument("--delay", type=float, default=0.01, help="The seconds to delay each datagram by.")
+    parser.add_argument("--jitter", type=float, default=0.005, help="The seconds of random delay to add, at most.")
+    parser.add_argument("--seed", type=int, help="The seed of the random losses and jitter.")
+    args = parser.parse_args()
+
+    proxy = LossyProxy(args.listen, *args.target, loss=args.loss, delay=args.delay, jitter=args.jitter,
+                       seed=args.seed)
+    proxy.start()
+    print(f"Forwarding port {args.listen} to {args.target[0]}:{args.target[1]} with {args.loss:.1%} loss, "
+          f"{args.delay * 1000:.0f} ms delay and {args.jitter * 1000:.0f} ms jitter. Press Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(5)
+            print(f"Forwarded {proxy.forwarded} datagrams, dropped {proxy.dropped}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        proxy.close()
+
+
+if __name__ == "__main__":
+    main()
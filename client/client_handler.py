@@ -1,19 +1,81 @@
-from opencl_handler import OpenCLHandler
+import collections
+import queue
+import threading
+import time
+import numpy as np
+
+from common import metrics, protocol
+from diff_applier import DISPLAY_CHANNELS, create_diff_applier
 from frame_receiver import FrameReceiver
 from frame_display import FrameDisplay
 
 
+class StreamView:
+    """
+    StreamView holds the client side state of one received stream: its diff applier, display window
+    and finished frame buffers. The finished frames are scaled to the display size by the diff
+    applier, which updates each buffer in place with the rectangles that changed.
+
+    Attributes:
+        stream_id (int): The id of the stream.
+        processor (DiffApplier): The diff applier object, OpenCL or NumPy.
+        display (FrameDisplay): The frame display object.
+        outputs (list): The finished frame buffers, one in sequential mode.
+        free_outputs (queue.Queue): The finished frame buffers neither displayed nor waiting to be.
+        latest_output (tuple): The index and header of the newest finished frame not displayed yet.
+        displayed (int): The index of the displayed frame buffer.
+    """
+
+    def __init__(self, stream_id, frame_width, frame_height, display_width, display_height, applier, window_name):
+        self.stream_id = stream_id
+        self.processor = create_diff_applier(frame_width, frame_height, applier)
+        self.display = FrameDisplay(frame_width, frame_height, display_width, display_height, window_name)
+        self.processor.set_display_size(self.display.display_width, self.display.display_height)
+        self.outputs = []
+        self.free_outputs = queue.Queue()
+        self.latest_output = None
+        self.latest_lock = threading.Lock()
+        self.displayed = None
+        self.last_ack_time = 0.0
+
+    def allocate_outputs(self, count):
+        """
+        Allocate the finished frame buffers.
+
+        Args:
+            count (int): The number of buffers, at least 3 in pipelined mode.
+        """
+        shape = (self.display.display_height, self.display.display_width, DISPLAY_CHANNELS)
+        self.outputs = [self.processor.allocate_host_buffer(shape, np.uint8) for _ in range(count)]
+        for output in range(count):
+            self.free_outputs.put(output)
+
+
 class ClientHandler:
     """
     ClientHandler is responsible for receiving, processing, and displaying frames.
 
+    The server may offer several streams, e.g. one per monitor. The client subscribes to some of
+    them and shows each in a window of its own, with its own diff applier.
+
+    In pipelined mode receiving, applying and displaying run concurrently: a receiver thread
+    decodes into a ring of host buffers, an applier thread submits the updates without waiting
+    for them, and the calling thread displays the latest finished frame, dropping stale ones.
+
+    Applied frames are acknowledged to the server every protocol.ACK_INTERVAL seconds, which lets
+    it adapt the stream to the link.
+
     Attributes:
         receiver (FrameReceiver): The frame receiver object.
-        processor (OpenCLHandler): The OpenCL processor object.
-        display (FrameDisplay): The frame display object.
+        views (dict): The StreamView of each received stream by stream id.
+        processor (DiffApplier): The diff applier of the first received stream.
+        display (FrameDisplay): The frame display of the first received stream.
+        pipelined (bool): Whether receiving, applying and displaying overlap.
+        dropped_frames (int): The number of finished frames replaced by a newer one before being displayed.
     """
 
-    def __init__(self, host, port, display_width=None, display_height=None):
+    def __init__(self, host, port, display_width=None, display_height=None, applier="auto", pipelined=True,
+                 ring_size=4, output_count=3, metrics_port=None, metrics_file=None, streams=None, transport="tcp"):
         """
         Initializes the ClientHandler with the given host, port, and optional display width and height.
 
@@ -22,31 +84,113 @@ class ClientHandler:
             port (int): The port number to connect to.
             display_width (int, optional): The width of the display window. Defaults to None.
             display_height (int, optional): The height of the display window. Defaults to None.
+            applier (str, optional): The diff applier: "auto", "opencl" or "numpy". Defaults to "auto".
+            pipelined (bool, optional): Whether to overlap receiving, applying and displaying. Defaults to True.
+            ring_size (int, optional): The number of receive buffers in pipelined mode. Defaults to 4.
+            output_count (int, optional): The number of finished frame buffers in pipelined mode, at least 3.
+                Defaults to 3.
+            metrics_port (int, optional): The port to serve Prometheus metrics on. Defaults to None.
+            metrics_file (str, optional): The JSON-lines file to write metrics snapshots to. Defaults to None.
+            streams (list, optional): The ids of the streams to receive. Defaults to the first stream of the server.
+            transport (str, optional): "tcp" or "udp", see FrameReceiver. Defaults to "tcp".
+
+        Raises:
+            ValueError: If the server doesn't have one of the streams.
         """
-        self.receiver = FrameReceiver(host, port)
-        self.processor = OpenCLHandler(self.receiver.frame_width, self.receiver.frame_height)
-        self.display = FrameDisplay(self.receiver.frame_width, self.receiver.frame_height, display_width, display_height)
+        self.pipelined = pipelined
+        self.receiver = FrameReceiver(host, port, ring_size if pipelined else 2, transport)
+        if streams is None:
+            streams = [min(self.receiver.streams)]
+        self.views = {}
+        for stream_id in streams:
+            if stream_id not in self.receiver.streams:
+                raise ValueError(f"The server has no stream {stream_id}")
+            frame_width, frame_height = self.receiver.streams[stream_id]
+            window_name = "Screen" if len(streams) == 1 else f"Screen {stream_id}"
+            self.views[stream_id] = StreamView(stream_id, frame_width, frame_height, display_width, display_height,
+                                               applier, window_name)
+        self.running = False
+        self.dropped_frames = 0
+        self.metrics_port = metrics_port
+        self.metrics_file = metrics_file
+        self.apply_timer = metrics.REGISTRY.stage("client", "apply")
+        self.display_timer = metrics.REGISTRY.stage("client", "display")
+        self.latency = metrics.REGISTRY.histogram("client_latency_seconds",
+                                                  "Time from capturing a frame to displaying it, "
+                                                  "assuming synchronized clocks")
+        self.dropped_frames_total = metrics.REGISTRY.counter("client_dropped_frames_total",
+                                                             "Frames replaced by a newer one before being displayed")
+
+        if pipelined:
+            # Page-locked buffers let the applier upload and read back without staging copies
+            self.receiver.use_frame_buffers([
+                self.processor.allocate_host_buffer((self.receiver.max_frame_size,), np.uint8)
+                for _ in range(ring_size)])
+            self.output_count = max(3, output_count)
+        else:
+            self.output_count = 1  # Updated in place and displayed after each frame
+        for view in self.views.values():
+            view.allocate_outputs(self.output_count)
+        self.receiver.subscribe(self.views)
+
+    @property
+    def processor(self):
+        """
+        DiffApplier: The diff applier of the first received stream.
+        """
+        return next(iter(self.views.values())).processor
+
+    @property
+    def display(self):
+        """
+        FrameDisplay: The frame display of the first received stream.
+        """
+        return next(iter(self.views.values())).display
+
+    @display.setter
+    def display(self, display):
+        next(iter(self.views.values())).display = display
 
     def start(self):
         """
         Starts the client to receive, process, and display frames.
 
-        Continuously receives frames from the receiver, processes them using the OpenCL processor,
+        Continuously receives frames from the receiver, processes them using the diff applier,
         and displays them using the frame display. The loop terminates if no more frames are received
         or if the user chooses to quit.
 
         Raises:
             Exception: If an error occurs during the frame handling process.
         """
+        exporters = metrics.start_exporters(port=self.metrics_port, path=self.metrics_file)
+        try:
+            if self.pipelined:
+                self._run_pipelined()
+            else:
+                self._run_sequential()
+        finally:
+            for exporter in exporters:
+                exporter.close()
+
+    def _run_sequential(self):
+        """
+        Receive, apply and display frames one after another until quit or disconnect.
+        """
         try:
             while True:
                 received_frame = self.receiver.receive_data()
                 if received_frame is None:
                     break
 
-                self.processor.process_frame(received_frame)
-                processed_frame = self.processor.get_processed_frame()
-                self.display.display_frame(processed_frame)
+                header = self.receiver.last_header
+                view = self.views[header.stream_id]
+                start_time = time.perf_counter()
+                event = view.processor.submit_display(received_frame, view.outputs[0])
+                if event is not None:
+                    event.wait()
+                self.apply_timer.observe(time.perf_counter() - start_time)
+                self._acknowledge(view, header, self.receiver.last_receive_time)
+                self._show(view, view.outputs[0], header)
 
                 if self.display.wait_for_quit():
                     break
@@ -55,4 +199,160 @@ class ClientHandler:
             print(f"An error occurred: {e}")
         finally:
             self.receiver.close()
-            self.display.close()
+            for view in self.views.values():
+                view.display.close()
+
+    def _show(self, view, frame, header):
+        """
+        Display a frame and record its latency.
+
+        Args:
+            view (StreamView): The stream of the frame.
+            frame (np.ndarray): The frame to display, scaled to the display size.
+            header (MessageHeader): The header of the frame.
+        """
+        start_time = time.perf_counter()
+        view.display.set_frame_size(header.width, header.height)
+        view.display.display_frame(frame)
+        self.display_timer.observe(time.perf_counter() - start_time)
+        self.latency.observe(max(0.0, (protocol.timestamp_now() - header.timestamp) / 1e6))
+
+    def _run_pipelined(self):
+        """
+        Run the receiver and applier threads and display finished frames until quit or disconnect.
+        """
+        free_slots = queue.Queue()
+        for slot in range(self.receiver.ring_size):
+            free_slots.put(slot)
+        decoded = queue.Queue()  # Bounded by the number of receive slots
+
+        self.running = True
+        receive_thread = threading.Thread(target=self._receive_loop, args=(free_slots, decoded), daemon=True)
+        apply_thread = threading.Thread(target=self._apply_loop, args=(free_slots, decoded), daemon=True)
+        receive_thread.start()
+        apply_thread.start()
+
+        try:
+            while self.running:
+                for view in self.views.values():
+                    with view.latest_lock:
+                        latest, view.latest_output = view.latest_output, None
+                    if latest is not None:
+                        output, header = latest
+                        self._show(view, view.outputs[output], header)
+                        if view.displayed is not None:
+                            view.free_outputs.put(view.displayed)
+                        view.displayed = output
+
+                if self.display.wait_for_quit():
+                    break
+        except Exception as e:
+            print(f"An error occurred: {e}")
+        finally:
+            self.running = False
+            self.receiver.close()  # Unblocks the receiver thread
+            receive_thread.join()
+            apply_thread.join()
+            for view in self.views.values():
+                view.display.close()
+
+    def _receive_loop(self, free_slots, decoded):
+        """
+        Receive frames into free ring slots and pass them to the applier thread.
+
+        Args:
+            free_slots (queue.Queue): The receive slots no longer used by the applier.
+            decoded (queue.Queue): The received frames, None when receiving stopped.
+        """
+        try:
+            while self.running:
+                slot = free_slots.get()
+                delta = self.receiver.receive_data(slot)
+                if delta is None:
+                    break
+                decoded.put((slot, delta, self.receiver.last_header, self.receiver.last_receive_time))
+        except Exception as e:
+            if self.running:
+                print(f"An error occurred: {e}")
+        finally:
+            self.running = False
+            decoded.put(None)
+
+    def _apply_loop(self, free_slots, decoded):
+        """
+        Submit received frames to the diff applier of their stream and publish them once they are finished.
+
+        A frame is only waited for when the next one has not arrived yet or too many are in flight,
+        so the upload of one frame overlaps with the processing of the previous one.
+
+        Args:
+            free_slots (queue.Queue): The receive slots no longer used by the applier.
+            decoded (queue.Queue): The received frames, None when receiving stopped.
+        """
+        in_flight = collections.deque()
+        max_in_flight = self.output_count - 2  # One buffer is displayed, one holds the latest finished frame
+
+        try:
+            while True:
+                item = decoded.get()
+                if item is None:
+                    break
+                slot, delta, header, receive_time = item
+                view = self.views[header.stream_id]
+
+                while view.free_outputs.empty() and in_flight:
+                    self._finish(in_flight.popleft(), free_slots)
+                output = view.free_outputs.get()
+
+                submit_time = time.perf_counter()
+                event = view.processor.submit_display(delta, view.outputs[output])
+                if event is None:  # Nothing changed, keep showing the current frame
+                    free_slots.put(slot)
+                    view.free_outputs.put(output)
+                    self._acknowledge(view, header, receive_time)
+                    continue
+                in_flight.append((event, slot, view, output, header, receive_time, submit_time))
+
+                while in_flight and (len(in_flight) > max_in_flight or decoded.empty()):
+                    self._finish(in_flight.popleft(), free_slots)
+        except Exception as e:
+            print(f"An error occurred: {e}")
+            self.running = False
+        finally:
+            for submitted in in_flight:
+                submitted[0].wait()  # Don't release buffers the device may still use
+
+    def _finish(self, submitted, free_slots):
+        """
+        Wait for a submitted frame, release its receive slot and publish it for display.
+
+        Args:
+            submitted (tuple): The event, receive slot, stream view, output buffer, header, receive and submit
+                time of the frame.
+            free_slots (queue.Queue): The receive slots no longer used by the applier.
+        """
+        event, slot, view, output, header, receive_time, submit_time = submitted
+        event.wait()
+        self.apply_timer.observe(time.perf_counter() - submit_time)
+        free_slots.put(slot)
+        self._acknowledge(view, header, receive_time)
+        with view.latest_lock:
+            stale, view.latest_output = view.latest_output, (output, header)
+        if stale is not None:
+            self.dropped_frames += 1  # Never displayed, a newer frame is ready
+            self.dropped_frames_total.inc()
+            view.free_outputs.put(stale[0])
+
+    def _acknowledge(self, view, header, receive_time):
+        """
+        Acknowledge an applied frame to the server, at most every protocol.ACK_INTERVAL seconds per stream.
+
+        Args:
+            view (StreamView): The stream of the frame.
+            header (MessageHeader): The header of the applied frame.
+            receive_time (float): The time.perf_counter() time the frame was received.
+        """
+        now = time.perf_counter()
+        if now - view.last_ack_time >= protocol.ACK_INTERVAL:
+            self.receiver.send_ack(header, now - receive_time)
+            view.last_ack_time = now
@@ -0,0 +1,310 @@
+import secrets
+import select
+import socket
+import time
+
+from common import datagrams, metrics, protocol, tile_delta
+from common.datagrams import FrameAssembly
+
+RECEIVE_BUFFER_SIZE = 8 * 1024 * 1024  # Bytes of datagrams the socket buffers, keyframes arrive in bursts
+REGISTER_INTERVAL = 0.2  # Seconds between registrations until the first fragment arrives
+LOSS_WAIT = 0.05  # Seconds without fragments of a frame, after which it is applied without the missing ones
+NACK_INTERVAL = 0.05  # Seconds between requests for the missing fragments of a frame
+MAX_NACKS = 5  # Requests for the missing fragments of a frame before giving up on it
+RESYNC_INTERVAL = 1.0  # Seconds between keyframe requests while none arrives
+MAX_PENDING_FRAMES = 256  # Frames of a stream waiting for an earlier one, beyond that the stream is resynchronized
+MAX_DATAGRAM_SIZE = 65536
+
+
+class ReceivedFrame:
+    """
+    ReceivedFrame is a frame assembled from its fragments, possibly without some of its tiles.
+
+    Attributes:
+        header (MessageHeader): The header of the frame, with the codec of its units.
+        units (list): The (first tile, last tile, data) of each unit received, a single unit with the whole payload
+            unless the header has protocol.FLAG_TILE_UNITS.
+        lost_tiles (list): The (first tile, last tile) ranges of the tiles lost on the way.
+        receive_time (float): The time.perf_counter() time the frame was assembled.
+    """
+
+    def __init__(self, header, units, lost_tiles, receive_time):
+        self.header = header
+        self.units = units
+        self.lost_tiles = lost_tiles
+        self.receive_time = receive_time
+
+
+class _StreamState:
+    """
+    The frames of a stream being assembled, delivered in the order they were sent.
+    """
+
+    def __init__(self, now):
+        self.frames = {}  # The FrameAssembly of each frame by sequence number
+        self.expected = None  # The sequence number of the next frame to deliver, None while waiting for a keyframe
+        self.lost_time = now  # When the stream started waiting for a keyframe
+        self.gap_time = None  # When a later frame arrived while nothing of the expected frame did
+        self.nacks = 0  # Requests sent for the expected frame
+        self.next_nack_time = 0.0
+
+    def advance(self, sequence):
+        """
+        Continue with the frame after the given one.
+        """
+        self.expected = (sequence + 1) & 0xFFFFFFFF
+        self.gap_time = None
+        self.nacks = 0
+        self.next_nack_time = 0.0
+        for pending in [pending for pending in self.frames if not datagrams.follows(pending, sequence)]:
+            del self.frames[pending]  # Retransmitted late
+
+
+class DatagramReceiver:
+    """
+    DatagramReceiver receives the frames of the subscribed streams over UDP, while the TCP
+    connection to the server stays the control channel.
+
+    The receiver registers its address with the server by sending the token it subscribed with
+    until the first fragment arrives. Lost fragments are recovered from the parity fragments
+    where possible. Frames of a stream are delivered in the order they were sent:
+
+    - Tile deltas split into units (protocol.FLAG_TILE_UNITS) are delivered once complete, or
+      LOSS_WAIT seconds after their last fragment arrived without the units still missing, whose
+      tiles the caller asks the server for again.
+    - Any other frame, e.g. a keyframe, a zstd delta or a frame of which nothing arrived, is only
+      useful complete, so its missing fragments are requested with NACKs. After MAX_NACKS
+      unanswered ones the stream waits for a keyframe, requested by the on_lost callback.
+
+    Attributes:
+        server_address (tuple): The host and UDP port of the server.
+        control_socket (socket.socket): The TCP connection to the server, closing it ends receiving.
+        token (int): The random token the receiver subscribed and registers with.
+        datagram_socket (socket.socket): The UDP socket the fragments arrive on.
+        registered (bool): Whether a fragment arrived, so the server knows the receiver's address.
+        streams (dict): The frames being assembled of each stream by stream id.
+        on_lost (callable): Called with the stream id once a frame of it could not be received.
+        loss_wait (float): The seconds a tile delta waits for its missing fragments.
+    """
+
+    def __init__(self, server_address, control_socket, on_lost, loss_wait=LOSS_WAIT):
+        """
+        Initializes the DatagramReceiver and opens its UDP socket.
+
+        Args:
+            server_address (tuple): The host and UDP port of the server.
+            control_socket (socket.socket): The TCP connection to the server.
+            on_lost (callable): Called with the stream id once a frame of it could not be received.
+            loss_wait (float, optional): The seconds a tile delta waits for its missing fragments.
+                Defaults to LOSS_WAIT.
+        """
+        self.server_address = server_address
+        self.control_socket = control_socket
+        self.token = secrets.randbits(32)
+        self.datagram_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.datagram_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+        self.datagram_socket.connect(server_address)  # Only the server's datagrams are received
+        self.datagram_socket.setblocking(False)
+        self.buffer = bytearray(MAX_DATAGRAM_SIZE)
+        self.registered = False
+        self.next_register_time = 0.0
+        self.streams = {}
+        self.on_lost = on_lost
+        self.loss_wait = loss_wait
+        self.received_datagrams_total = metrics.REGISTRY.counter("client_received_datagrams_total",
+                                                                 "Fragment datagrams received")
+        self.recovered_fragments_total = metrics.REGISTRY.counter("client_recovered_fragments_total",
+                                                                  "Lost fragments recovered from the parity")
+        self.partial_frames_total = metrics.REGISTRY.counter("client_partial_frames_total",
+                                                             "Tile deltas applied without some of their tiles")
+        self.lost_frames_total = metrics.REGISTRY.counter("client_lost_frames_total",
+                                                          "Frames given up on, resynchronized with a keyframe")
+
+    def receive(self):
+        """
+        Receive datagrams until the next frame of any stream can be delivered.
+
+        Returns:
+            ReceivedFrame: The next frame, or None if the connection to the server was closed.
+
+        Raises:
+            ProtocolError: If the server sent a message on the control connection.
+        """
+        while True:
+            now = time.perf_counter()
+            frame = self._next_frame(now)
+            if frame is not None:
+                return frame
+            if not self.registered and now >= self.next_register_time:
+                register = protocol.MessageHeader(protocol.MSG_REGISTER, frame_id=self.token)
+                self._send(register.pack())
+                self.next_register_time = now + REGISTER_INTERVAL
+
+            readable, _, _ = select.select([self.datagram_socket, self.control_socket], [], [], self._timeout(now))
+            if self.control_socket in readable:
+                if not self.control_socket.recv(1):
+                    return None
+                raise protocol.ProtocolError("Unexpected message on the control connection")
+            if self.datagram_socket in readable:
+                self._receive_datagrams(time.perf_counter())
+
+    def _timeout(self, now):
+        """
+        Get the seconds until a frame has waited long enough for its missing fragments.
+
+        Args:
+            now (float): The current time.perf_counter() time.
+
+        Returns:
+            float: The seconds to wait for datagrams at most.
+        """
+        timeout = NACK_INTERVAL if not self.registered else 0.5
+        for state in self.streams.values():
+            if state.expected is None:
+                timeout = min(timeout, state.lost_time + RESYNC_INTERVAL - now)
+            assembly = state.frames.get(state.expected)
+            if assembly is not None:
+                timeout = min(timeout, assembly.last_time + self.loss_wait - now)
+            if state.gap_time is not None or state.nacks:
+                timeout = min(timeout, max(state.next_nack_time, (state.gap_time or now) + self.loss_wait) - now)
+        return max(0.001, timeout)
+
+    def _receive_datagrams(self, now):
+        """
+        Add the waiting fragment datagrams to the frames they belong to.
+
+        Args:
+            now (float): The current time.perf_counter() time.
+        """
+        offset = protocol.HEADER.size + datagrams.FRAGMENT.size
+        while True:
+            try:
+                length = self.datagram_socket.recv_into(self.buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionRefusedError:
+                continue  # An earlier registration reached a closed port, e.g. before the server bound it
+            if length < offset:
+                continue
+            try:
+                header = protocol.MessageHeader.unpack(self.buffer)
+            except protocol.ProtocolError:
+                continue
+            if header.msg_type != protocol.MSG_FRAGMENT:
+                continue
+            sequence, index, data_count, parity_count = datagrams.FRAGMENT.unpack_from(self.buffer,
+                                                                                        protocol.HEADER.size)
+            self.registered = True
+            self.received_datagrams_total.inc()
+            state = self.streams.get(header.stream_id)
+            if state is None:
+                state = self.streams[header.stream_id] = _StreamState(now)
+            if not data_count or (state.expected is not None and state.expected != sequence and
+                                  not datagrams.follows(sequence, state.expected)):
+                continue  # Already delivered or given up on
+            assembly = state.frames.get(sequence)
+            if assembly is None:
+                if len(state.frames) >= MAX_PENDING_FRAMES:
+                    self._give_up(state, header.stream_id, now)
+                assembly = state.frames[sequence] = FrameAssembly(header, sequence, data_count, parity_count, now)
+            elif (assembly.data_count, assembly.parity_count) != (data_count, parity_count):
+                continue
+            recovered = assembly.recovered
+            assembly.add(index, bytes(self.buffer[offset:length]), now)
+            self.recovered_fragments_total.inc(assembly.recovered - recovered)
+
+    def _next_frame(self, now):
+        """
+        Find the next frame of any stream that can be delivered, requesting missing fragments on the way.
+
+        Args:
+            now (float): The current time.perf_counter() time.
+
+        Returns:
+            ReceivedFrame: The frame, or None if no stream has one ready.
+        """
+        for stream_id, state in self.streams.items():
+            if state.expected is None:
+                # Waiting for a keyframe, the frames before it are of no use
+                keyframes = [sequence for sequence, assembly in state.frames.items() if assembly.header.keyframe]
+                if not keyframes:
+                    if now >= state.lost_time + RESYNC_INTERVAL:
+                        state.lost_time = now  # The keyframe was lost as a whole, or never sent
+                        self.on_lost(stream_id)
+                    continue
+                first = min(keyframes, key=lambda sequence: (sequence - keyframes[0] + 0x80000000) & 0xFFFFFFFF)
+                state.advance((first - 1) & 0xFFFFFFFF)
+
+            assembly = state.frames.get(state.expected)
+            if assembly is not None and assembly.complete:
+                return self._deliver(state, assembly, now)
+            if assembly is None:
+                if not any(datagrams.follows(sequence, state.expected) for sequence in state.frames):
+                    continue  # Nothing lost as far as we know
+                if state.gap_time is None:
+                    state.gap_time = now
+                stall_time = state.gap_time
+            else:
+                stall_time = assembly.last_time
+            if now < stall_time + self.loss_wait:
+                continue
+
+            if assembly is not None and assembly.header.flags & protocol.FLAG_TILE_UNITS:
+                # The tiles of the units that arrived are applied, unless they depend on the lost copies
+                if not assembly.header.flags & protocol.FLAG_COPIES or assembly.first_unit_complete():
+                    self.partial_frames_total.inc()
+                    return self._deliver(state, assembly, now)
+            if state.nacks >= MAX_NACKS:
+                if now >= state.next_nack_time:
+                    self._give_up(state, stream_id, now)
+                continue
+            if now >= state.next_nack_time:
+                indices = assembly.missing_indices()[:datagrams.MAX_NACK_INDICES] if assembly is not None else []
+                nack = protocol.MessageHeader(protocol.MSG_NACK, stream_id=stream_id)
+                self._send(nack.pack() + datagrams.NACK.pack(state.expected) +
+                           b''.join(datagrams.NACK_INDEX.pack(index) for index in indices))
+                state.nacks += 1
+                state.next_nack_time = now + NACK_INTERVAL
+        return None
+
+    def _deliver(self, state, assembly, now):
+        """
+        Take a frame out of the ones being assembled and continue with the next one.
+
+        Returns:
+            ReceivedFrame: The frame.
+        """
+        del state.frames[assembly.sequence]
+        state.advance(assembly.sequence)
+        tiles_x, tiles_y = tile_delta.tile_grid(assembly.header.width, assembly.header.height)
+        units, lost_tiles = assembly.units(tiles_x * tiles_y)
+        return ReceivedFrame(assembly.header, units, lost_tiles, now)
+
+    def _give_up(self, state, stream_id, now):
+        """
+        Drop the frames of a stream and wait for a keyframe of it, keeping the keyframes that follow.
+        """
+        self.lost_frames_total.inc()
+        lost = state.expected
+        state.frames = {sequence: assembly for sequence, assembly in state.frames.items()
+                        if assembly.header.keyframe and (lost is None or datagrams.follows(sequence, lost))}
+        state.expected = None
+        state.lost_time = now
+        state.gap_time = None
+        state.nacks = 0
+        self.on_lost(stream_id)
+
+    def _send(self, datagram):
+        """
+        Send a datagram to the server, losing it like any other if the network doesn't deliver it.
+        """
+        try:
+            self.datagram_socket.send(datagram)
+        except (BlockingIOError, ConnectionRefusedError):
+            pass
+
+    def close(self):
+        """
+        Close the UDP socket.
+        """
+        self.datagram_socket.close()
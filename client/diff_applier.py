@@ -0,0 +1,432 @@
+import time
+import numpy as np
+import cv2
+
+from common import tile_delta
+
+APPLIERS = ("auto", "opencl", "numpy")
+DISPLAY_CHANNELS = 3  # Frames are displayed in BGR, without the alpha channel
+SCALE_BITS = 5  # Fractional bits of the sampling positions, the precision cv2.remap interpolates with
+MAX_PENDING_RECTS = 64  # Changed rectangles remembered per output before it is updated completely instead
+
+
+class _CompletedEvent:
+    """
+    Stand-in for the event of work that finished synchronously.
+    """
+
+    def wait(self):
+        pass
+
+
+_COMPLETED = _CompletedEvent()
+
+
+def _changes_nothing(delta):
+    """
+    Check whether a tile delta leaves the frame as it is.
+
+    Args:
+        delta (TileDelta): The decoded keyframe or tile delta.
+
+    Returns:
+        bool: True if the delta has no tiles and no copies.
+    """
+    return not delta.keyframe and len(delta.indices) == 0 and len(delta.cached_indices) == 0 and \
+        len(delta.copies) == 0
+
+
+def scale_table(source_size, display_size):
+    """
+    Calculate where the display pixels along one axis sample the source frame.
+
+    The sampling positions are those of cv2.resize with INTER_LINEAR, rounded to SCALE_BITS
+    fractional bits like cv2.remap does. A display pixel interpolates between the source pixels
+    first and first + 1, clamped to the frame.
+
+    Args:
+        source_size (int): The width or height of the frame.
+        display_size (int): The width or height of the display.
+
+    Returns:
+        tuple: The int32 first source pixel of each display pixel, -1 before the center of the first one, and
+            the int32 weight of the second source pixel in 1 / 2 ** SCALE_BITS.
+    """
+    positions = (np.arange(display_size) + 0.5) * (source_size / display_size) - 0.5
+    fixed = np.rint(positions * (1 << SCALE_BITS)).astype(np.int32)
+    return fixed >> SCALE_BITS, fixed & ((1 << SCALE_BITS) - 1)
+
+
+def _merge_rects(rects):
+    """
+    Merge rectangles sharing rows into their bounding rectangles, so each row is covered at most once.
+
+    Args:
+        rects (list): The (x0, y0, x1, y1) rectangles.
+
+    Returns:
+        list: The merged rectangles, top to bottom.
+    """
+    merged = []
+    for x0, y0, x1, y1 in sorted(rects, key=lambda rect: rect[1]):
+        if merged and y0 < merged[-1][3]:
+            last = merged[-1]
+            merged[-1] = (min(last[0], x0), last[1], max(last[2], x1), max(last[3], y1))
+        else:
+            merged.append((x0, y0, x1, y1))
+    return merged
+
+
+class DiffApplier:
+    """
+    DiffApplier is the interface for applying keyframes and tile deltas to the client's back buffer.
+
+    Frames are displayed through submit_display(), which scales the back buffer to the display
+    size and converts it to BGR. Only the display pixels a delta changes are written, so the
+    output buffers are persistent: each one is updated in place with the rectangles changed since
+    it was last written, which also covers the deltas written to the other outputs meanwhile.
+
+    Attributes:
+        frame_width (int): The width of the frame.
+        frame_height (int): The height of the frame.
+        back_buffer (np.ndarray): The back buffer for storing processed frames.
+        display_width (int): The width frames are scaled to for display, or None before set_display_size().
+        display_height (int): The height frames are scaled to for display, or None before set_display_size().
+        scale_x (tuple): The first source column and weight of each display column, see scale_table().
+        scale_y (tuple): The first source row and weight of each display row, see scale_table().
+        output_damage (dict): The display rectangles each output buffer misses by its address, None if it has
+            to be updated completely. Outputs not in it were never written.
+    """
+
+    def __init__(self, frame_width, frame_height):
+        self.frame_width = frame_width
+        self.frame_height = frame_height
+        self.display_width = None
+        self.display_height = None
+        self.scale_x = None
+        self.scale_y = None
+        self.display_maps = None  # The cv2.remap maps of the display pixels, created when first used
+        self.output_damage = {}
+
+    def resize(self, frame_width, frame_height):
+        """
+        Reallocate the back buffer for a new frame size.
+
+        Args:
+            frame_width (int): The new width of the frames.
+            frame_height (int): The new height of the frames.
+        """
+        raise NotImplementedError
+
+    def _match_frame_size(self, delta):
+        """
+        Follow a change of the stream resolution, which the server announces with a keyframe.
+
+        Args:
+            delta (TileDelta): The decoded keyframe or tile delta.
+
+        Raises:
+            ValueError: If a tile delta does not match the frame size.
+        """
+        if (delta.frame_width, delta.frame_height) == (self.frame_width, self.frame_height):
+            return
+        if not delta.keyframe:
+            raise ValueError("Tile delta does not match the frame size")
+        self.resize(delta.frame_width, delta.frame_height)
+        if self.display_width is not None:
+            self._resize_display()
+
+    def set_display_size(self, display_width, display_height):
+        """
+        Set the size submit_display() scales the frames to. The display keeps its size when the stream
+        resolution changes.
+
+        Args:
+            display_width (int): The width of the display.
+            display_height (int): The height of the display.
+        """
+        self.display_width = display_width
+        self.display_height = display_height
+        self._resize_display()
+
+    def _resize_display(self):
+        """
+        Recalculate the scaling after the frame or the display size changed. Every output buffer is
+        updated completely the next time it is written.
+        """
+        self.scale_x = scale_table(self.frame_width, self.display_width)
+        self.scale_y = scale_table(self.frame_height, self.display_height)
+        self.display_maps = None
+        self.output_damage = {}
+
+    def _damaged_rects(self, delta):
+        """
+        Find the display pixels a keyframe or tile delta changes, i.e. the ones interpolating from a changed pixel.
+
+        Args:
+            delta (TileDelta): The decoded keyframe or tile delta, matching the frame size.
+
+        Returns:
+            list: The (x0, y0, x1, y1) display rectangles, end exclusive, or None for the whole display.
+        """
+        if delta.keyframe:
+            return None
+        tile_size = delta.tile_size
+        tiles_x, _ = tile_delta.tile_grid(self.frame_width, self.frame_height, tile_size)
+        indices = np.sort(np.concatenate((delta.indices, delta.cached_indices)).astype(np.int64))
+        rows = indices // tiles_x
+        columns = indices % tiles_x
+        # One rectangle per tile row, from its first to its last dirty tile
+        starts = np.flatnonzero(np.diff(rows, prepend=-1))
+        ends = np.append(starts[1:], len(indices)) - 1
+        row_y = rows[starts] * tile_size
+        source_rects = [
+            columns[starts] * tile_size, row_y,
+            np.minimum((columns[ends] + 1) * tile_size, self.frame_width),
+            np.minimum(row_y + tile_size, self.frame_height),
+        ]
+        copies = delta.copies.astype(np.int64)  # The moved content lands on the destination rectangles
+        source_rects = [np.concatenate((rects, copied)) for rects, copied in
+                        zip(source_rects, (copies[:, 2], copies[:, 3], copies[:, 2] + copies[:, 4],
+                                           copies[:, 3] + copies[:, 5]))]
+
+        # A display pixel changes if either source pixel it interpolates between did, the first ones are ascending
+        first_x, first_y = self.scale_x[0], self.scale_y[0]
+        display_rects = np.stack([
+            np.searchsorted(first_x, source_rects[0] - 1, "left"),
+            np.searchsorted(first_y, source_rects[1] - 1, "left"),
+            np.searchsorted(first_x, source_rects[2] - 1, "right"),
+            np.searchsorted(first_y, source_rects[3] - 1, "right"),
+        ], axis=1)
+        display_rects = display_rects[(display_rects[:, 0] < display_rects[:, 2]) &
+                                      (display_rects[:, 1] < display_rects[:, 3])]
+        return _merge_rects(map(tuple, display_rects.tolist()))
+
+    def _output_rects(self, output, rects):
+        """
+        Record the display rectangles a delta changed and find the ones to write to an output buffer: those, and
+        the ones changed since the output was last written.
+
+        Args:
+            output (np.ndarray): The output buffer to write.
+            rects (list): The (x0, y0, x1, y1) display rectangles the delta changed, or None for the whole display.
+
+        Returns:
+            list: The display rectangles to write to the output.
+        """
+        key = output.ctypes.data  # Outputs are told apart by their memory, views of the same buffer are the same
+        for other_key, pending in self.output_damage.items():
+            if other_key == key or pending is None:
+                continue
+            if rects is None or len(pending) + len(rects) > MAX_PENDING_RECTS:
+                self.output_damage[other_key] = None
+            else:
+                pending.extend(rects)
+        pending = self.output_damage.get(key)
+        self.output_damage[key] = []
+        if rects is None or pending is None:  # Changed completely, or never written
+            return [(0, 0, self.display_width, self.display_height)]
+        return _merge_rects(pending + rects)
+
+    def process_frame(self, delta):
+        """
+        Apply a keyframe or tile delta to the back buffer.
+
+        Args:
+            delta (TileDelta): The decoded keyframe or tile delta.
+        """
+        raise NotImplementedError
+
+    def submit(self, delta, output):
+        """
+        Apply a keyframe or tile delta and copy the updated frame to an output buffer.
+
+        Implementations may return before the work is done, see OpenCLHandler.
+
+        Args:
+            delta (TileDelta): The decoded keyframe or tile delta.
+            output (np.ndarray): The buffer the updated frame is copied to.
+
+        Returns:
+            object: An object whose wait() blocks until output is ready, or None if the delta changed nothing.
+        """
+        if _changes_nothing(delta):
+            return None
+        self.process_frame(delta)
+        np.copyto(output, self.back_buffer)
+        return _COMPLETED
+
+    def submit_display(self, delta, output):
+        """
+        Apply a keyframe or tile delta and update an output buffer with the frame scaled to the display size and
+        converted to BGR, for FrameDisplay. Only the changed rectangles of the output are written.
+
+        Implementations may return before the work is done, see OpenCLHandler.
+
+        Args:
+            delta (TileDelta): The decoded keyframe or tile delta.
+            output (np.ndarray): The persistent (display_height, display_width, DISPLAY_CHANNELS) uint8 buffer.
+
+        Returns:
+            object: An object whose wait() blocks until output is ready, or None if the delta changed nothing.
+        """
+        if _changes_nothing(delta):
+            return None
+        self.process_frame(delta)
+        if self.display_maps is None:
+            # The fixed-point maps cv2.remap takes: the first source pixels and the weights of the second ones
+            first_x, weight_x = self.scale_x
+            first_y, weight_y = self.scale_y
+            source_pixels = np.empty((self.display_height, self.display_width, 2), dtype=np.int16)
+            source_pixels[..., 0] = first_x
+            source_pixels[..., 1] = first_y[:, None]
+            weights = ((weight_y[:, None] << SCALE_BITS) | weight_x).astype(np.uint16)
+            self.display_maps = source_pixels, weights
+        source = self.back_buffer.view(np.uint8).reshape((self.frame_height, self.frame_width, 4))
+        source_pixels, weights = self.display_maps
+        for x0, y0, x1, y1 in self._output_rects(output, self._damaged_rects(delta)):
+            scaled = cv2.remap(source, source_pixels[y0:y1, x0:x1], weights[y0:y1, x0:x1], cv2.INTER_LINEAR,
+                               borderMode=cv2.BORDER_REPLICATE)
+            np.copyto(output[y0:y1, x0:x1], scaled[..., :DISPLAY_CHANNELS])
+        return _COMPLETED
+
+    def allocate_host_buffer(self, shape, dtype):
+        """
+        Allocate a host buffer suitable for receiving frames and for submit outputs.
+
+        Args:
+            shape (tuple): The shape of the buffer.
+            dtype (np.dtype): The data type of the buffer.
+
+        Returns:
+            np.ndarray: The buffer.
+        """
+        return np.empty(shape, dtype=dtype)
+
+    def get_processed_frame(self):
+        """
+        Get the processed frame.
+
+        Returns:
+            np.ndarray: The processed frame.
+        """
+        return self.back_buffer
+
+
+class NumPyDiffApplier(DiffApplier):
+    """
+    NumPyDiffApplier applies frame updates on the CPU with NumPy slice copies. Every tile is a
+    single block copy straight into the back buffer, with no upload or readback.
+
+    Attributes:
+        tile_cache (np.ndarray): The tiles the server told to cache, allocated with the first delta using them.
+    """
+
+    def __init__(self, frame_width, frame_height):
+        super().__init__(frame_width, frame_height)
+        self.tile_cache = None
+        self.resize(frame_width, frame_height)
+
+    def resize(self, frame_width, frame_height):
+        self.frame_width = frame_width
+        self.frame_height = frame_height
+        self.back_buffer = np.zeros((frame_height * frame_width,), dtype=np.uint32)
+        self.back_buffer_2d = self.back_buffer.reshape((frame_height, frame_width))
+
+    def process_frame(self, delta):
+        self._match_frame_size(delta)
+        if delta.keyframe:
+            tile_delta.unpack_pixels(delta, self.back_buffer)
+        else:
+            tile_delta.apply_copies(self.back_buffer_2d, delta.copies)  # Moved content first, the tiles go on top
+            if delta.stored_slots is None:
+                tile_delta.unpack_tiles(self.back_buffer_2d, delta)
+                return
+            if self.tile_cache is None or self.tile_cache.shape[1] != delta.tile_size * delta.tile_size:
+                self.tile_cache = tile_delta.allocate_tile_cache(delta.tile_size)
+            tile_delta.apply_cached_tiles(self.back_buffer_2d, delta, self.tile_cache)
+            tile_delta.unpack_tiles(self.back_buffer_2d, delta)
+            tile_delta.store_cached_tiles(self.back_buffer_2d, delta, self.tile_cache)
+
+
+def _benchmark_deltas(frame_width, frame_height, dirty_ratio=0.1, count=8):
+    """
+    Build a keyframe and a few tile deltas resembling regular desktop activity.
+
+    Args:
+        frame_width (int): The width of the frame.
+        frame_height (int): The height of the frame.
+        dirty_ratio (float, optional): The share of dirty tiles per delta. Defaults to 0.1.
+        count (int, optional): The number of deltas. Defaults to 8.
+
+    Returns:
+        tuple: The keyframe and the list of deltas.
+    """
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 2 ** 32, (frame_height, frame_width), dtype=np.uint32)
+    keyframe = tile_delta.decode(tile_delta.encode_keyframe(frame), frame_width, frame_height)
+
+    tiles_x, tiles_y = tile_delta.tile_grid(frame_width, frame_height)
+    tile_count = tiles_x * tiles_y
+    deltas = []
+    for _ in range(count):
+        indices = np.sort(rng.choice(tile_count, max(1, int(tile_count * dirty_ratio)), replace=False))
+        payload = tile_delta.encode_tiles(frame, indices.astype(np.uint32))
+        deltas.append(tile_delta.decode(payload, frame_width, frame_height))
+    return keyframe, deltas
+
+
+def _measure(applier, keyframe, deltas):
+    """
+    Measure the time an applier needs per delta, including updating a display buffer at the frame size.
+
+    Returns:
+        float: The median time per delta in seconds.
+    """
+    applier.set_display_size(applier.frame_width, applier.frame_height)
+    output = applier.allocate_host_buffer((applier.frame_height, applier.frame_width, DISPLAY_CHANNELS), np.uint8)
+    applier.submit_display(keyframe, output).wait()
+    timings = []
+    for delta in deltas:
+        start_time = time.perf_counter()
+        applier.submit_display(delta, output).wait()
+        timings.append(time.perf_counter() - start_time)
+    return float(np.median(timings))
+
+
+def create_diff_applier(frame_width, frame_height, applier="auto"):
+    """
+    Create the diff applier for the client.
+
+    "auto" benchmarks the OpenCL and NumPy appliers at the stream resolution and picks the faster
+    one, falling back to NumPy when no OpenCL runtime is available.
+
+    Args:
+        frame_width (int): The width of the frames to be processed.
+        frame_height (int): The height of the frames to be processed.
+        applier (str, optional): One of APPLIERS. Defaults to "auto".
+
+    Returns:
+        DiffApplier: The diff applier.
+    """
+    if applier not in APPLIERS:
+        raise ValueError(f"Unknown diff applier {applier!r}, expected one of {', '.join(APPLIERS)}")
+    if applier == "numpy":
+        return NumPyDiffApplier(frame_width, frame_height)
+    if applier == "opencl":
+        from opencl_handler import OpenCLHandler
+        return OpenCLHandler(frame_width, frame_height)
+
+    try:
+        from opencl_handler import OpenCLHandler
+        opencl_applier = OpenCLHandler(frame_width, frame_height)
+    except Exception as e:  # pyopencl missing, no platform or no device
+        print(f"OpenCL is not available ({e}), using NumPy")
+        return NumPyDiffApplier(frame_width, frame_height)
+
+    numpy_applier = NumPyDiffApplier(frame_width, frame_height)
+    keyframe, deltas = _benchmark_deltas(frame_width, frame_height)
+    opencl_time = _measure(opencl_applier, keyframe, deltas)
+    numpy_time = _measure(numpy_applier, keyframe, deltas)
+    print(f"Diff applier benchmark: OpenCL {opencl_time * 1000:.2f} ms, NumPy {numpy_time * 1000:.2f} ms")
+    return opencl_applier if opencl_time < numpy_time else numpy_applier
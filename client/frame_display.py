@@ -1,19 +1,20 @@
-import numpy as np
 import cv2
 
 
 class FrameDisplay:
     """
-    FrameDisplay is responsible for displaying frames using OpenCV.
+    FrameDisplay is responsible for displaying frames using OpenCV. The diff applier scales the
+    frames to the display size, the window only shows them.
 
     Attributes:
         frame_width (int): The width of the frame.
         frame_height (int): The height of the frame.
         display_width (int): The width of the display window.
         display_height (int): The height of the display window.
+        window_name (str): The title of the display window.
     """
 
-    def __init__(self, frame_width, frame_height, display_width=None, display_height=None):
+    def __init__(self, frame_width, frame_height, display_width=None, display_height=None, window_name="Screen"):
         """
         Initializes the FrameDisplay with the given frame width, frame height, display width, and display height.
 
@@ -22,27 +23,35 @@ class FrameDisplay:
             frame_height (int): The height of the frames to be displayed.
             display_width (int, optional): The width of the display window. Defaults to frame_width.
             display_height (int, optional): The height of the display window. Defaults to frame_height.
+            window_name (str, optional): The title of the display window. Defaults to "Screen".
         """
         self.frame_width = frame_width
         self.frame_height = frame_height
         self.display_width = display_width if display_width is not None else frame_width
         self.display_height = display_height if display_height is not None else frame_height
+        self.window_name = window_name
+
+    def set_frame_size(self, frame_width, frame_height):
+        """
+        Change the size of the frames to be displayed, e.g. when the server downscales the stream.
+        The display window keeps its size.
+
+        Args:
+            frame_width (int): The width of the frames to be displayed.
+            frame_height (int): The height of the frames to be displayed.
+        """
+        self.frame_width = frame_width
+        self.frame_height = frame_height
 
     def display_frame(self, frame):
         """
         Display the frame using OpenCV.
 
         Args:
-            frame (np.ndarray): The frame to display. The frame should be in a format
-                                that can be reshaped into (frame_height, frame_width, 4).
+            frame (np.ndarray): The (display_height, display_width, 3) BGR frame to display, already scaled and
+                converted by the diff applier, see DiffApplier.submit_display().
         """
-        display_frame = frame.astype(np.uint32)  # Ensure the frame is in the correct data type
-        # Reshape the frame to have the correct dimensions and 4 channels (e.g., RGBA).
-        reshaped_frame = display_frame.view(np.uint8).reshape((self.frame_height, self.frame_width, 4))
-        # Resize the frame to the display resolution.
-        resized_frame = cv2.resize(reshaped_frame, (self.display_width, self.display_height), interpolation=cv2.INTER_LINEAR)
-        # Display the resized frame.
-        cv2.imshow("Screen", resized_frame)
+        cv2.imshow(self.window_name, frame)
 
     def wait_for_quit(self):
         """
@@ -55,6 +64,9 @@ class FrameDisplay:
 
     def close(self):
         """
-        Close all OpenCV windows.
+        Close the display window.
         """
-        cv2.destroyAllWindows()
+        try:
+            cv2.destroyWindow(self.window_name)
+        except cv2.error:
+            pass  # Never shown
@@ -1,73 +1,485 @@
 import socket
-import pickle
-import lz4.frame
+import threading
+import time
 import numpy as np
+import lz4.frame
+
+from common import compression, metrics, protocol, tile_delta
+from datagram_receiver import DatagramReceiver
+from video_decoder import VIDEO_DECODERS, VideoDecoder
+
+TRANSPORTS = ("tcp", "udp")  # Whether frames are received over the TCP connection, or over UDP
+MAX_TILE_RANGES = 32  # Tile ranges per request, the server accepts messages of up to 256 bytes
 
 
 class FrameReceiver:
     """
     FrameReceiver is responsible for receiving and decompressing frames from a socket connection.
 
+    The server announces its streams, e.g. one per monitor, and only sends the ones the receiver
+    subscribed to. The frames of all subscribed streams arrive on the one connection.
+
+    In video mode the server sends a stream as lossy video packets, which are decoded by a
+    VideoDecoder per stream and passed on as keyframes.
+
+    zstd payloads refer to the payloads of the stream received before them, so the receiver keeps
+    the same compression history per stream as the server.
+
+    Frames are received into a ring of reusable buffers, so once the buffers have grown to the
+    largest frame seen, receiving a frame does not allocate any new buffers. A decoded frame
+    stays valid until its ring slot is reused, ring_size frames later.
+
+    Over UDP (see DatagramReceiver) a lost packet doesn't hold up the frames behind it. A tile
+    delta that lost some of its tiles on the way is applied without them, and they are requested
+    from the server, which sends them with its next delta. Until then they are marked as lost, so
+    copies moving their content pass the loss on to the tiles they move it to.
+
     Attributes:
         host (str): The host address to connect to.
         port (int): The port number to connect to.
         client_socket (socket.socket): The socket used for the connection.
-        frame_width (int): The width of the frame.
-        frame_height (int): The height of the frame.
+        streams (dict): The largest width and height of the frames of each stream by stream id, announced
+            by the server.
+        subscriptions (frozenset): The ids of the streams the receiver subscribed to.
+        frame_width (int): The largest width of the frames of all streams.
+        frame_height (int): The largest height of the frames of all streams.
+        last_header (MessageHeader): The header of the last received frame.
+        last_receive_time (float): The time.perf_counter() time the last frame was completely received.
+        ring_size (int): The number of receive buffer slots.
+        max_frame_size (int): The size of the largest possible decompressed frame update.
+        allocation_count (int): The number of receive and decompression buffers allocated so far.
+        compression_histories (dict): The CompressionHistory of each stream receiving zstd payloads by stream id.
+        datagrams (DatagramReceiver): The receiver of the frames over UDP, or None to receive them over TCP.
+        lost_tiles (dict): The tiles of each stream by stream id that were lost and not received since, as a
+            boolean array over the tiles of the frame.
     """
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, ring_size=2, transport="tcp"):
         """
         Initializes the FrameReceiver with the given host and port.
 
         Args:
             host (str): The host address to connect to.
             port (int): The port number to connect to.
+            ring_size (int, optional): The number of receive buffer slots. Defaults to 2.
+            transport (str, optional): "tcp" to receive the frames over the connection, or "udp" to receive them
+                as datagrams if the server offers it. Defaults to "tcp".
         """
         self.host = host
         self.port = port
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.client_socket.connect((self.host, self.port))
-        self.frame_width, self.frame_height = self._receive_resolution()
+        self.header_buffer = bytearray(protocol.HEADER.size)
+        self.server_flags = 0
+        self.streams = self._receive_hello()
+        self.send_lock = threading.Lock()  # Requests are sent from the receiving thread, acknowledgements from others
+        self.subscriptions = frozenset()
+        self.frame_width = max(width for width, _ in self.streams.values())
+        self.frame_height = max(height for _, height in self.streams.values())
+        self.max_payload_length = 2 * 4 * self.frame_width * self.frame_height + 65536  # Worst case LZ4 expansion
+        self.last_header = None
+        self.last_receive_time = None
+        self.receive_timer = metrics.REGISTRY.stage("client", "receive")
+        self.decompress_timer = metrics.REGISTRY.stage("client", "decompress")
+        self.received_bytes_total = metrics.REGISTRY.counter("client_received_bytes_total", "Bytes received")
+
+        # Receive buffers grow to the largest payload seen, decompression buffers fit the largest possible frame
+        self.ring_size = ring_size
+        self.ring_index = 0
+        self.allocation_count = 0
+        self.payload_buffers = [self._allocate(65536) for _ in range(ring_size)]
+        self.max_frame_size = tile_delta.max_encoded_size(self.frame_width, self.frame_height)
+        self.frame_buffers = [self._allocate(self.max_frame_size) for _ in range(ring_size)]
+        self.video_decoders = {}  # Created when a stream first switches to video mode
+        self.compression_histories = {}  # Created with the first zstd payload of a stream, always a keyframe
+        self.datagrams = None
+        self.lost_tiles = {}
+        if transport == "udp":
+            if self.server_flags & protocol.FLAG_DATAGRAMS:
+                self.datagrams = DatagramReceiver((host, port), self.client_socket, self.request_keyframe)
+            else:
+                print("The server doesn't send frames over UDP, receiving them over TCP.")
+        self.lost_tiles_total = metrics.REGISTRY.counter("client_lost_tiles_total",
+                                                         "Tiles lost on the way and requested again")
 
-    def _receive_resolution(self):
+    def _allocate(self, size):
         """
-        Receive the initial resolution message from the server.
+        Allocate a receive or decompression buffer.
+
+        Args:
+            size (int): The size of the buffer.
 
         Returns:
-            tuple: A tuple containing the width and height of the frame.
+            bytearray: The new buffer.
+        """
+        self.allocation_count += 1
+        return bytearray(size)
+
+    def use_frame_buffers(self, buffers):
+        """
+        Replace the decompression buffers, e.g. with page-locked buffers from the diff applier.
+
+        Args:
+            buffers (list): One uint8 buffer of at least max_frame_size bytes per ring slot.
+        """
+        if len(buffers) != self.ring_size or any(len(buffer) < self.max_frame_size for buffer in buffers):
+            raise ValueError("Expected one buffer of max_frame_size bytes per ring slot")
+        self.frame_buffers = list(buffers)
+
+    def _receive_hello(self):
+        """
+        Receive the initial hello message from the server.
+
+        Returns:
+            dict: The width and height of each stream by stream id.
+
+        Raises:
+            ProtocolError: If the server did not start with a hello message.
+        """
+        header = protocol.recv_header(self.client_socket, self.header_buffer)
+        if header is None or header.msg_type != protocol.MSG_HELLO:
+            raise protocol.ProtocolError("Expected a hello message from the server")
+        if header.payload_length > 256 * protocol.STREAM_INFO.size:
+            raise protocol.ProtocolError("Hello message is too large")
+        payload = protocol.recv_exact(self.client_socket, header.payload_length)
+        if payload is None:
+            raise protocol.ProtocolError("Connection closed during the hello message")
+        self.server_flags = header.flags
+        return protocol.unpack_streams(payload)
+
+    def subscribe(self, stream_ids):
         """
-        resolution_data = self.client_socket.recv(1024).decode('utf-8')
-        width, height = map(int, resolution_data.split('x'))
-        return width, height
+        Ask the server to send the given streams, and only those.
 
-    def receive_data(self):
+        Args:
+            stream_ids (iterable): The ids of the streams to receive.
+
+        Raises:
+            ValueError: If the server doesn't have one of the streams.
+        """
+        stream_ids = frozenset(stream_ids)
+        unknown = stream_ids - set(self.streams)
+        if unknown:
+            raise ValueError(f"The server has no stream {', '.join(map(str, sorted(unknown)))}")
+        payload = bytes(sorted(stream_ids))
+        header = protocol.MessageHeader(protocol.MSG_SUBSCRIBE, payload_length=len(payload))
+        if self.datagrams is not None:
+            header.flags = protocol.FLAG_DATAGRAMS
+            header.frame_id = self.datagrams.token  # Registered with over UDP
+        self._send(header, payload)
+        self.subscriptions = stream_ids
+
+    def receive_data(self, slot=None):
         """
         Receive and decompress data from the socket.
 
+        Args:
+            slot (int, optional): The ring slot to receive into. Defaults to the next slot of the ring.
+
         Returns:
-            np.ndarray: The decompressed and deserialized frame.
+            TileDelta: The decoded keyframe or tile delta, or None if the connection was closed.
+
+        Raises:
+            ProtocolError: If the server sent an invalid message.
         """
-        size_data = self.client_socket.recv(4)
-        if not size_data:
+        if slot is None:
+            slot = self.ring_index
+            self.ring_index = (slot + 1) % self.ring_size
+        if self.datagrams is not None:
+            return self._receive_datagram_frame(slot)
+
+        while True:
+            header = protocol.recv_header(self.client_socket, self.header_buffer)
+            if header is None:
+                return None
+            if header.msg_type != protocol.MSG_FRAME:
+                raise protocol.ProtocolError(f"Unexpected message type {header.msg_type}")
+            if header.payload_length > self.max_payload_length:
+                raise protocol.ProtocolError(f"Payload of {header.payload_length} bytes is too large")
+            if header.stream_id in self.subscriptions:
+                break
+            # Sent before the server got our latest subscription, skip it
+            if protocol.recv_exact(self.client_socket, header.payload_length) is None:
+                return None
+        self._check_frame_size(header)
+
+        if header.payload_length > len(self.payload_buffers[slot]):
+            # Grow with some headroom, so slowly growing frames don't reallocate every time
+            self.payload_buffers[slot] = self._allocate(header.payload_length + header.payload_length // 4)
+        payload_buffer = self.payload_buffers[slot]
+
+        payload = memoryview(payload_buffer)[:header.payload_length]
+        start_time = time.perf_counter()  # The header arrived, time the transfer of the payload
+        if not protocol.recv_exact_into(self.client_socket, payload):
             return None
+        self.last_receive_time = time.perf_counter()
+        self.receive_timer.observe(self.last_receive_time - start_time)
+        self.received_bytes_total.inc(protocol.HEADER.size + header.payload_length)
+        return self._decode_payload(header, payload_buffer, header.payload_length, slot)
+
+    def _check_frame_size(self, header):
+        """
+        Check that a frame fits the size its stream was announced with.
+
+        Args:
+            header (MessageHeader): The header of the frame.
+
+        Raises:
+            ProtocolError: If the frame is larger than announced.
+        """
+        stream_width, stream_height = self.streams[header.stream_id]
+        if not (0 < header.width <= stream_width and 0 < header.height <= stream_height):
+            raise protocol.ProtocolError(f"Frame size {header.width}x{header.height} exceeds the announced size")
+
+    def _decode_payload(self, header, payload_buffer, length, slot):
+        """
+        Decompress and decode the payload of a frame.
+
+        Args:
+            header (MessageHeader): The header of the frame.
+            payload_buffer (bytearray): The buffer holding the payload.
+            length (int): The length of the payload.
+            slot (int): The ring slot to decompress into.
+
+        Returns:
+            TileDelta: The decoded keyframe or tile delta.
+
+        Raises:
+            ProtocolError: If the payload is invalid.
+        """
+        payload = memoryview(payload_buffer)[:length]
+        if header.codec == protocol.CODEC_RAW:
+            data = payload
+        elif header.codec in (protocol.CODEC_LZ4_BLOCK, protocol.CODEC_LZ4_CHUNKS):
+            frame_buffer = self.frame_buffers[slot]
+            try:
+                if header.codec == protocol.CODEC_LZ4_BLOCK:
+                    length = compression.decompress_into(payload_buffer, length, frame_buffer)
+                else:
+                    length = compression.decompress_chunks_into(payload_buffer, length, frame_buffer)
+            except ValueError as e:
+                raise protocol.ProtocolError(str(e)) from e
+            if not compression.ZERO_COPY_DECOMPRESSION:
+                self.allocation_count += 1  # The fallback decompresses into a temporary buffer
+            data = memoryview(frame_buffer)[:length]
+        elif header.codec == protocol.CODEC_ZSTD:
+            if not compression.ZSTD_AVAILABLE:
+                raise protocol.ProtocolError("Receiving zstd payloads needs the zstandard package")
+            history = self.compression_histories.setdefault(header.stream_id, compression.CompressionHistory())
+            frame_buffer = self.frame_buffers[slot]
+            try:
+                length = compression.decompress_zstd_into(payload_buffer, length, frame_buffer,
+                                                          None if header.keyframe else history)
+            except ValueError as e:
+                raise protocol.ProtocolError(str(e)) from e
+            data = memoryview(frame_buffer)[:length]
+        elif header.codec == protocol.CODEC_LZ4:
+            data = lz4.frame.decompress(payload)
+            self.allocation_count += 1
+        elif header.codec in VIDEO_DECODERS:
+            self.last_header = header
+            return self._decode_video(header, payload)
+        else:
+            raise protocol.ProtocolError(f"Unsupported codec {header.codec}")
+
+        self.last_header = header
+        history = self.compression_histories.get(header.stream_id)
+        if history is not None:
+            history.update(header, data)  # Before decoding, the data stays valid until the ring slot is reused
+        try:
+            delta = tile_delta.decode(data, header.width, header.height)
+        except ValueError as e:
+            raise protocol.ProtocolError(str(e)) from e
+        self.decompress_timer.observe(time.perf_counter() - self.last_receive_time)
+        return delta
+
+    def _receive_datagram_frame(self, slot):
+        """
+        Receive the next frame over UDP and decode the units of it that arrived.
 
-        size = int.from_bytes(size_data, 'big')  # Convert the size from bytes to an integer
-        data = b""
+        Args:
+            slot (int): The ring slot to receive into.
+
+        Returns:
+            TileDelta: The decoded keyframe or tile delta, or None if the connection was closed.
 
-        # Receive the complete data based on the size
-        while len(data) < size:
-            packet = self.client_socket.recv(size - len(data))
-            if not packet:
+        Raises:
+            ProtocolError: If the server sent an invalid frame.
+        """
+        while True:
+            frame = self.datagrams.receive()
+            if frame is None:
                 return None
-            data += packet
+            if frame.header.stream_id in self.subscriptions:
+                break
+        header = frame.header
+        self._check_frame_size(header)
+        self.last_receive_time = frame.receive_time
+        self.received_bytes_total.inc(sum(len(data) for _, _, data in frame.units))
+
+        if header.flags & protocol.FLAG_TILE_UNITS:
+            delta = self._decode_units(header, frame.units, slot)
+        elif len(frame.units) == 1:
+            data = frame.units[0][2]  # Assembled into a buffer of its own, which the decoded delta may refer to
+            self.allocation_count += 1
+            delta = self._decode_payload(header, data, len(data), slot)
+        else:
+            raise protocol.ProtocolError("Frame without tile units in several units")
+        self._track_lost_tiles(header, delta, frame.lost_tiles)
+        return delta
+
+    def _decode_units(self, header, units, slot):
+        """
+        Decode the units of a tile delta that arrived into one delta.
+
+        Each unit is a tile delta on its own, decompressed one after the other into the ring slot.
+
+        Args:
+            header (MessageHeader): The header of the frame.
+            units (list): The (first tile, last tile, data) of each unit that arrived.
+            slot (int): The ring slot to decompress into.
+
+        Returns:
+            TileDelta: The delta of the tiles that arrived.
+
+        Raises:
+            ProtocolError: If a unit is invalid.
+        """
+        frame_buffer = self.frame_buffers[slot]
+        deltas = []
+        offset = 0
+        try:
+            for _, _, data in units:
+                length = compression.decompress_into(data, len(data), frame_buffer, destination_offset=offset)
+                delta = tile_delta.decode(memoryview(frame_buffer)[offset:offset + length], header.width,
+                                          header.height)
+                if delta.keyframe or delta.stored_slots is not None:
+                    raise ValueError("Tile units are plain tile deltas")
+                deltas.append(delta)
+                offset += -(-length // 4) * 4  # Keeps the pixels of the next unit aligned
+            if not deltas:
+                empty = np.zeros(0, dtype=np.uint32)
+                return tile_delta.TileDelta(False, tile_delta.TILE_SIZE, empty, empty, empty, header.width,
+                                            header.height)
+            delta = tile_delta.merge(deltas)
+        except ValueError as e:
+            raise protocol.ProtocolError(str(e)) from e
+        finally:
+            self.last_header = header
+        self.decompress_timer.observe(time.perf_counter() - self.last_receive_time)
+        return delta
+
+    def _track_lost_tiles(self, header, delta, lost_ranges):
+        """
+        Update the lost tiles of a stream with a received frame, and request the newly lost ones.
+
+        Args:
+            header (MessageHeader): The header of the frame.
+            delta (TileDelta): The decoded frame.
+            lost_ranges (list): The (first tile, last tile) ranges of the tiles of the frame that were lost.
+        """
+        tile_size = delta.tile_size
+        tiles_x, tiles_y = tile_delta.tile_grid(header.width, header.height, tile_size)
+        lost = self.lost_tiles.get(header.stream_id)
+        if delta.keyframe or lost is None or lost.shape != (tiles_y, tiles_x):
+            lost = self.lost_tiles[header.stream_id] = np.zeros((tiles_y, tiles_x), dtype=bool)
+        requested = np.zeros_like(lost)
+        if len(delta.copies) and lost.any():
+            # Copies are applied before the tiles, moving the content of lost tiles onto others
+            for source_x, source_y, x, y, width, height in delta.copies.tolist():
+                if lost[source_y // tile_size:(source_y + height - 1) // tile_size + 1,
+                        source_x // tile_size:(source_x + width - 1) // tile_size + 1].any():
+                    destination = (slice(y // tile_size, (y + height - 1) // tile_size + 1),
+                                   slice(x // tile_size, (x + width - 1) // tile_size + 1))
+                    requested[destination] |= ~lost[destination]
+                    lost[destination] = True
+        flat_lost, flat_requested = lost.reshape(-1), requested.reshape(-1)
+        flat_lost[delta.indices] = False
+        for first, last in lost_ranges:
+            flat_requested[first:last + 1] |= ~flat_lost[first:last + 1]
+            flat_lost[first:last + 1] = True
+        if requested.any():
+            self.lost_tiles_total.inc(int(np.count_nonzero(requested)))
+            edges = np.flatnonzero(np.diff(flat_requested.astype(np.int8), prepend=0, append=0))
+            self.request_tiles(header.stream_id, list(zip(edges[::2].tolist(), (edges[1::2] - 1).tolist())))
+
+    def _decode_video(self, header, payload):
+        """
+        Decode a video packet of a stream in video mode.
 
-        # Decompress and deserialize the received data
-        data = lz4.frame.decompress(data)
-        return pickle.loads(data).astype(np.uint32)
+        Args:
+            header (MessageHeader): The header of the message.
+            payload (memoryview): The encoded packet.
+
+        Returns:
+            TileDelta: The decoded frame as a keyframe, or an empty delta if the decoder didn't output a frame.
+
+        Raises:
+            ProtocolError: If the packet is invalid.
+        """
+        decoder = self.video_decoders.get(header.stream_id)
+        if decoder is None or decoder.codec != header.codec:
+            decoder = self.video_decoders[header.stream_id] = VideoDecoder(header.codec)
+        try:
+            delta = decoder.decode(payload, header.width, header.height)
+        except ValueError as e:
+            raise protocol.ProtocolError(str(e)) from e
+        self.allocation_count += 1  # The decoded frame is a new array
+        self.decompress_timer.observe(time.perf_counter() - self.last_receive_time)
+        return delta
+
+    def send_ack(self, header, decode_time):
+        """
+        Acknowledge an applied frame, so the server can adapt the stream to the link.
+
+        Args:
+            header (MessageHeader): The header of the last applied frame.
+            decode_time (float): The time between receiving and applying the frame, in seconds.
+        """
+        payload = protocol.ACK_PAYLOAD.pack(min(int(decode_time * 1e6), 0xFFFFFFFF))
+        ack = protocol.MessageHeader(protocol.MSG_ACK, frame_id=header.frame_id, timestamp=header.timestamp,
+                                     payload_length=len(payload), stream_id=header.stream_id)
+        self._send(ack, payload)
+
+    def request_keyframe(self, stream_id):
+        """
+        Ask the server for a keyframe of a stream, e.g. after frames of it were lost.
+
+        Args:
+            stream_id (int): The stream id.
+        """
+        self._send(protocol.MessageHeader(protocol.MSG_KEYFRAME_REQUEST, stream_id=stream_id))
+
+    def request_tiles(self, stream_id, ranges):
+        """
+        Ask the server to send tiles of a stream again with its next delta, e.g. after they were lost.
+
+        Args:
+            stream_id (int): The stream id.
+            ranges (list): The (first tile, last tile) ranges of the tiles.
+        """
+        if len(ranges) > MAX_TILE_RANGES:
+            self.request_keyframe(stream_id)  # Scattered losses, simpler to start over
+            return
+        payload = b''.join(protocol.TILE_RANGE.pack(first, last) for first, last in ranges)
+        self._send(protocol.MessageHeader(protocol.MSG_TILE_REQUEST, stream_id=stream_id,
+                                          payload_length=len(payload)), payload)
+
+    def _send(self, header, payload=b''):
+        """
+        Send a message to the server, from any thread.
+
+        Args:
+            header (MessageHeader): The header of the message.
+            payload (bytes-like, optional): The payload of the message. Defaults to b''.
+        """
+        with self.send_lock:
+            protocol.send_message(self.client_socket, header.pack(), payload)
 
     def close(self):
         """
         Close the socket connection.
         """
+        if self.datagrams is not None:
+            self.datagrams.close()
         self.client_socket.close()
@@ -1,6 +1,13 @@
+import os
+import sys
 import tkinter as tk
 from tkinter import messagebox
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # Make the shared "common" package importable
+
 from client_handler import ClientHandler
+from diff_applier import APPLIERS
+from frame_receiver import TRANSPORTS
 
 
 class ClientGUI:
@@ -35,18 +42,43 @@ class ClientGUI:
         self.height_entry.grid(row=3, column=1, padx=10, pady=5)
         self.height_entry.insert(0, "1080")
 
+        # Diff Applier
+        tk.Label(self.root, text="Diff Applier:").grid(row=4, column=0, padx=10, pady=5)
+        self.applier_var = tk.StringVar(self.root, "auto")
+        tk.OptionMenu(self.root, self.applier_var, *APPLIERS).grid(row=4, column=1, padx=10, pady=5, sticky="ew")
+
+        # Metrics Port, empty to not serve metrics
+        tk.Label(self.root, text="Metrics Port:").grid(row=5, column=0, padx=10, pady=5)
+        self.metrics_entry = tk.Entry(self.root)
+        self.metrics_entry.grid(row=5, column=1, padx=10, pady=5)
+
+        # Streams, comma separated ids of the server's monitors to show, empty for the first one
+        tk.Label(self.root, text="Streams:").grid(row=6, column=0, padx=10, pady=5)
+        self.streams_entry = tk.Entry(self.root)
+        self.streams_entry.grid(row=6, column=1, padx=10, pady=5)
+
+        # Transport of the frames, UDP if the server offers it
+        tk.Label(self.root, text="Transport:").grid(row=7, column=0, padx=10, pady=5)
+        self.transport_var = tk.StringVar(self.root, "tcp")
+        tk.OptionMenu(self.root, self.transport_var, *TRANSPORTS).grid(row=7, column=1, padx=10, pady=5, sticky="ew")
+
         # Connect Button
         self.connect_button = tk.Button(self.root, text="Connect", command=self.connect_to_server)
-        self.connect_button.grid(row=4, column=0, columnspan=2, pady=10)
+        self.connect_button.grid(row=8, column=0, columnspan=2, pady=10)
 
     def connect_to_server(self):
         host = self.host_entry.get()
         port = int(self.port_entry.get())
         frame_width = int(self.width_entry.get())
         frame_height = int(self.height_entry.get())
+        applier = self.applier_var.get()
+        metrics_port = int(self.metrics_entry.get()) if self.metrics_entry.get() else None
+        streams = [int(stream) for stream in self.streams_entry.get().split(",")] if self.streams_entry.get() else None
+        transport = self.transport_var.get()
 
         try:
-            client_handler = ClientHandler(host, port, frame_width, frame_height)
+            client_handler = ClientHandler(host, port, frame_width, frame_height, applier, metrics_port=metrics_port,
+                                           streams=streams, transport=transport)
             client_handler.start()
         except Exception as e:
             messagebox.showerror("Error", f"Failed to connect to server: {e}")
@@ -1,88 +1,543 @@
 import numpy as np
 import pyopencl as cl
 
+from common import pixel_formats, tile_delta
+from diff_applier import DISPLAY_CHANNELS, SCALE_BITS, DiffApplier
 
-class OpenCLHandler:
+_FIRST_TILE = np.zeros(1, dtype=np.uint32)  # The index and offset of a keyframe applied like a single tile
+SCALE_RUN = 16  # Display pixels scaled per work item, sharing the row's sampling position
+
+
+class OpenCLHandler(DiffApplier):
     """
     OpenCLHandler is responsible for processing frames using OpenCL.
 
+    Frame updates are submitted without blocking: uploads, the kernel and the readback are
+    chained with events on an out-of-order queue (where the device supports one), and the
+    uploads of one frame use a different set of device buffers than the frame before, so they
+    can overlap with its kernel.
+
+    For display, a kernel scales the changed rectangles of the display from the back buffer and
+    converts them to BGR right after the delta is applied, into a display buffer on the device.
+    Only those rectangles are read back, instead of the whole frame at the stream resolution.
+
     Attributes:
         frame_width (int): The width of the frame.
         frame_height (int): The height of the frame.
         context (cl.Context): The OpenCL context.
         queue (cl.CommandQueue): The OpenCL command queue.
-        program_add_diff (cl.Program): The compiled OpenCL program for processing image differences.
+        program_apply_tiles (cl.Program): The compiled OpenCL program for applying dirty tiles, in BGRA or
+            unpacking them from a compact pixel format.
         back_buffer (np.ndarray): The back buffer for storing processed frames.
         back_buffer_cl (cl.Buffer): The OpenCL buffer for the back buffer.
-        diff_buffer_cl (cl.Buffer): The OpenCL buffer for the difference buffer.
+        scratch_cl (cl.Buffer): The OpenCL buffer copied rectangles pass through, as they may overlap their source.
+        upload_sets (list): The device buffers for tile pixels, indices and offsets, one set per frame in flight.
+        tile_cache_cl (cl.Buffer): The tiles the server told to cache, allocated with the first delta using them.
+        display_cl (cl.Buffer): The frame scaled to the display size in BGR, updated with every delta submitted
+            with submit_display().
+        scale_cl (cl.Buffer): The first source pixel and weight of each display column and then each display row.
     """
 
-    def __init__(self, frame_width, frame_height):
+    def __init__(self, frame_width, frame_height, upload_set_count=2):
         """
         Initializes the OpenCLHandler with the given frame width and frame height.
 
         Args:
             frame_width (int): The width of the frames to be processed.
             frame_height (int): The height of the frames to be processed.
+            upload_set_count (int, optional): The number of device buffer sets for uploads. Defaults to 2.
         """
-        self.frame_width = frame_width
-        self.frame_height = frame_height
+        super().__init__(frame_width, frame_height)
 
         # OpenCL setup
         platform = cl.get_platforms()[0]  # Select the first platform
         device = platform.get_devices()[0]  # Select the first device
         self.context = cl.Context([device])
-        self.queue = cl.CommandQueue(self.context, device)
+        try:
+            self.queue = cl.CommandQueue(self.context, device,
+                                         properties=cl.command_queue_properties.OUT_OF_ORDER_EXEC_MODE_ENABLE)
+        except cl.Error:
+            self.queue = cl.CommandQueue(self.context, device)  # Events keep the order on in-order queues too
 
-        # OpenCL kernel code for processing image differences
+        # OpenCL kernel code for copying dirty tiles into the back buffer, one work item per tile pixel
         kernel_code = """
-        __kernel void AddDiffKernel(__global unsigned int *BackBuffer, __global unsigned int *DiffBuffer, 
-                                    unsigned int BufferWidth, unsigned int BufferHeight) {
-            unsigned int LinearIndex = get_global_id(0);
+        __kernel void ApplyTilesKernel(__global unsigned int *BackBuffer, __global const unsigned int *TileData,
+                                       __global const unsigned int *TileIndices, __global const unsigned int *TileOffsets,
+                                       unsigned int BufferWidth, unsigned int BufferHeight, unsigned int TileSize) {
+            unsigned int Tile = get_global_id(0);
+            unsigned int Pixel = get_global_id(1);
+
+            unsigned int TilesX = (BufferWidth + TileSize - 1) / TileSize;
+            unsigned int TileX = (TileIndices[Tile] % TilesX) * TileSize;
+            unsigned int TileY = (TileIndices[Tile] / TilesX) * TileSize;
+            unsigned int TileWidth = min(TileSize, BufferWidth - TileX);
+            unsigned int TileHeight = min(TileSize, BufferHeight - TileY);
+
+            if(Pixel >= TileWidth * TileHeight) return;
+
+            unsigned int X = TileX + Pixel % TileWidth;
+            unsigned int Y = TileY + Pixel / TileWidth;
+            BackBuffer[Y * BufferWidth + X] = TileData[TileOffsets[Tile] + Pixel];
+        }
+
+        // The same, for tiles in a compact pixel format with byte offsets, computing what pixel_formats.unpack() does
+        __kernel void ApplyPackedTilesKernel(__global unsigned int *BackBuffer, __global const uchar *TileData,
+                                             __global const unsigned int *TileIndices,
+                                             __global const unsigned int *TileOffsets, unsigned int BufferWidth,
+                                             unsigned int BufferHeight, unsigned int TileSize, unsigned int PixelFormat) {
+            unsigned int Tile = get_global_id(0);
+            unsigned int Pixel = get_global_id(1);
+
+            unsigned int TilesX = (BufferWidth + TileSize - 1) / TileSize;
+            unsigned int TileX = (TileIndices[Tile] % TilesX) * TileSize;
+            unsigned int TileY = (TileIndices[Tile] / TilesX) * TileSize;
+            unsigned int TileWidth = min(TileSize, BufferWidth - TileX);
+            unsigned int TileHeight = min(TileSize, BufferHeight - TileY);
+
+            if(Pixel >= TileWidth * TileHeight) return;
 
-            if(LinearIndex >= (BufferWidth * BufferHeight)) return;
+            unsigned int LocalX = Pixel % TileWidth;
+            unsigned int LocalY = Pixel / TileWidth;
+            __global const uchar *Data = TileData + TileOffsets[Tile];
+            int Blue, Green, Red;
+            if(PixelFormat == PIXEL_BGR24) {
+                Blue = Data[3 * Pixel];
+                Green = Data[3 * Pixel + 1];
+                Red = Data[3 * Pixel + 2];
+            } else if(PixelFormat == PIXEL_RGB565) {
+                unsigned int Value = Data[2 * Pixel] | (Data[2 * Pixel + 1] << 8);
+                Blue = Value & 0x1F;
+                Green = (Value >> 5) & 0x3F;
+                Red = Value >> 11;
+                Blue = (Blue << 3) | (Blue >> 2);  // Spread the levels over the full range
+                Green = (Green << 2) | (Green >> 4);
+                Red = (Red << 3) | (Red >> 2);
+            } else {  // YUV420: the luma plane, then the chroma planes of the 2x2 pixel blocks
+                unsigned int ChromaWidth = (TileWidth + 1) / 2;
+                unsigned int ChromaPlaneSize = ChromaWidth * ((TileHeight + 1) / 2);
+                unsigned int Chroma = TileWidth * TileHeight + (LocalY / 2) * ChromaWidth + LocalX / 2;
+                int Luma = Data[Pixel];
+                int ChromaU = Data[Chroma] - 128;
+                int ChromaV = Data[Chroma + ChromaPlaneSize] - 128;
+                // OpenCV's fixed-point YCrCb to BGR conversion, biased so only positive values are shifted
+                Red = clamp(Luma + ((ChromaV * 22987 + 8192 + (256 << 14)) >> 14) - 256, 0, 255);
+                Green = clamp(Luma + ((ChromaU * -5636 + ChromaV * -11698 + 8192 + (256 << 14)) >> 14) - 256, 0, 255);
+                Blue = clamp(Luma + ((ChromaU * 29049 + 8192 + (256 << 14)) >> 14) - 256, 0, 255);
+            }
+            BackBuffer[(TileY + LocalY) * BufferWidth + TileX + LocalX] =
+                0xFF000000 | ((unsigned int)Red << 16) | ((unsigned int)Green << 8) | (unsigned int)Blue;
+        }
+
+        // Copies tiles from the tile cache to the back buffer, or stores them the other way
+        __kernel void CacheTilesKernel(__global unsigned int *BackBuffer, __global unsigned int *TileCache,
+                                       __global const unsigned int *TileIndices, __global const unsigned int *TileSlots,
+                                       unsigned int BufferWidth, unsigned int BufferHeight, unsigned int TileSize,
+                                       unsigned int Store) {
+            unsigned int Tile = get_global_id(0);
+            unsigned int Pixel = get_global_id(1);
+            unsigned int Slot = TileSlots[Tile];
+            if(Slot == NO_SLOT) return;
+
+            unsigned int TilesX = (BufferWidth + TileSize - 1) / TileSize;
+            unsigned int TileX = (TileIndices[Tile] % TilesX) * TileSize;
+            unsigned int TileY = (TileIndices[Tile] / TilesX) * TileSize;
+            unsigned int TileWidth = min(TileSize, BufferWidth - TileX);
+            unsigned int TileHeight = min(TileSize, BufferHeight - TileY);
+
+            if(Pixel >= TileWidth * TileHeight) return;
+
+            unsigned int Cached = Slot * TileSize * TileSize + Pixel;
+            unsigned int Framed = (TileY + Pixel / TileWidth) * BufferWidth + TileX + Pixel % TileWidth;
+            if(Store) TileCache[Cached] = BackBuffer[Framed];
+            else BackBuffer[Framed] = TileCache[Cached];
+        }
 
-            unsigned char Alpha = (DiffBuffer[LinearIndex] >> 24) & 0xFF;
+        // Scales a rectangle of the display from the back buffer and converts it to BGR, one work item per run of
+        // SCALE_RUN display pixels of a row. Interpolates like cv2.remap with the maps of
+        // DiffApplier.submit_display(), in the same fixed point
+        __kernel void ScaleToDisplayKernel(__global const unsigned int *BackBuffer, __global uchar *Display,
+                                           __global const int *Scale, unsigned int BufferWidth,
+                                           unsigned int BufferHeight, unsigned int DisplayWidth, unsigned int RectX,
+                                           unsigned int RectY, unsigned int RectWidth) {
+            unsigned int Start = RectX + get_global_id(0) * SCALE_RUN;
+            unsigned int End = min(Start + SCALE_RUN, RectX + RectWidth);
+            unsigned int Y = RectY + get_global_id(1);
 
-            if(Alpha) {
-                BackBuffer[LinearIndex] = DiffBuffer[LinearIndex];
+            // The first source pixel and the weight of the second one, of the columns and then of the rows
+            int FirstY = Scale[2 * (DisplayWidth + Y)];
+            unsigned int WeightY = Scale[2 * (DisplayWidth + Y) + 1];
+            int LastRow = BufferHeight - 1;
+            __global const unsigned int *Top = BackBuffer + clamp(FirstY, 0, LastRow) * BufferWidth;
+            __global const unsigned int *Bottom = BackBuffer + clamp(FirstY + 1, 0, LastRow) * BufferWidth;
+            __global uchar *Pixel = Display + DISPLAY_CHANNELS * (Y * DisplayWidth + Start);
+            unsigned int One = 1 << SCALE_BITS;
+            for(unsigned int X = Start; X < End; X++, Pixel += DISPLAY_CHANNELS) {
+                int FirstX = Scale[2 * X];
+                unsigned int WeightX = Scale[2 * X + 1];
+                unsigned int Left = clamp(FirstX, 0, (int)BufferWidth - 1);
+                uchar4 Scaled = as_uchar4(Top[Left]);
+                if(WeightX | WeightY) {  // Between source pixels, unless the display has the frame size
+                    unsigned int Right = clamp(FirstX + 1, 0, (int)BufferWidth - 1);
+                    // All channels at once, the weights of the four pixels add up to 1 << (2 * SCALE_BITS)
+                    uint4 Sum = convert_uint4(Scaled) * ((One - WeightX) * (One - WeightY)) +
+                                convert_uint4(as_uchar4(Top[Right])) * (WeightX * (One - WeightY)) +
+                                convert_uint4(as_uchar4(Bottom[Left])) * ((One - WeightX) * WeightY) +
+                                convert_uint4(as_uchar4(Bottom[Right])) * (WeightX * WeightY);
+                    Scaled = convert_uchar4((Sum + (1 << (2 * SCALE_BITS - 1))) >> (2 * SCALE_BITS));
+                }
+                Pixel[0] = Scaled.x;  // Blue, the lowest byte of the back buffer pixels
+                Pixel[1] = Scaled.y;
+                Pixel[2] = Scaled.z;
             }
         }
         """
-        self.program_add_diff = cl.Program(self.context, kernel_code).build()
+        build_options = [f"-DPIXEL_BGR24={pixel_formats.BGR24}", f"-DPIXEL_RGB565={pixel_formats.RGB565}",
+                         f"-DNO_SLOT={tile_delta.NO_SLOT}u", f"-DSCALE_BITS={SCALE_BITS}",
+                         f"-DDISPLAY_CHANNELS={DISPLAY_CHANNELS}", f"-DSCALE_RUN={SCALE_RUN}"]
+        self.program_apply_tiles = cl.Program(self.context, kernel_code).build(options=build_options)
+        self.apply_tiles_kernel = cl.Kernel(self.program_apply_tiles, "ApplyTilesKernel")
+        self.apply_packed_tiles_kernel = cl.Kernel(self.program_apply_tiles, "ApplyPackedTilesKernel")
+        self.cache_tiles_kernel = cl.Kernel(self.program_apply_tiles, "CacheTilesKernel")
+        self.scale_to_display_kernel = cl.Kernel(self.program_apply_tiles, "ScaleToDisplayKernel")
+        self.display_cl = None
+        self.scale_cl = None
+        self.tile_cache_cl = None
+        self.tile_cache_tile_size = None
+
+        self.upload_set_count = upload_set_count
+        self.upload_set_index = 0
+        self.host_buffers = []  # Device buffers backing the pinned host buffers, kept alive while mapped
+        self.last_event = None  # The last command that touched the back buffer
+        self.resize(frame_width, frame_height)
+
+    def resize(self, frame_width, frame_height):
+        """
+        Reallocate the back buffer and the upload buffers for a new frame size.
+
+        Args:
+            frame_width (int): The new width of the frames.
+            frame_height (int): The new height of the frames.
+        """
+        self.queue.finish()  # Nothing may still use the old buffers
+        self.frame_width = frame_width
+        self.frame_height = frame_height
 
-        # OpenCL buffers initialization
+        # OpenCL buffers initialization, sized for the worst case of every tile being dirty
         mf = cl.mem_flags
         self.back_buffer = np.zeros((frame_height * frame_width,), dtype=np.uint32)
         self.back_buffer_cl = cl.Buffer(self.context, mf.READ_WRITE | mf.COPY_HOST_PTR, hostbuf=self.back_buffer)
-        self.diff_buffer_cl = cl.Buffer(self.context, mf.READ_ONLY, self.back_buffer.nbytes)
+        self.scratch_cl = cl.Buffer(self.context, mf.READ_WRITE, 4 * frame_width * frame_height)
+        tiles_x, tiles_y = tile_delta.tile_grid(frame_width, frame_height, tile_delta.TILE_SIZE)
+        self.max_tiles = tiles_x * tiles_y
+        self.upload_sets = [self._create_upload_set() for _ in range(self.upload_set_count)]
+        self.last_event = None
+
+    def _resize_display(self):
+        """
+        Recalculate the scaling and reallocate the display buffer after the frame or the display size changed.
+        """
+        super()._resize_display()
+        self.queue.finish()  # Nothing may still use the old buffers
+        mf = cl.mem_flags
+        scale = np.concatenate([np.stack(table, axis=1).ravel() for table in (self.scale_x, self.scale_y)])
+        self.scale_cl = cl.Buffer(self.context, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=scale.astype(np.int32))
+        self.display_cl = cl.Buffer(self.context, mf.READ_WRITE,
+                                    DISPLAY_CHANNELS * self.display_width * self.display_height)
+
+    def _create_upload_set(self):
+        """
+        Create a set of device buffers for uploading one frame's tiles.
+
+        Returns:
+            dict: The tile pixel, index, offset and cache slot buffers and the event of the last kernel reading them.
+        """
+        mf = cl.mem_flags
+        return {
+            "data": cl.Buffer(self.context, mf.READ_ONLY, 4 * self.frame_width * self.frame_height),
+            "indices": cl.Buffer(self.context, mf.READ_ONLY, 4 * self.max_tiles),
+            "offsets": cl.Buffer(self.context, mf.READ_ONLY, 4 * self.max_tiles),
+            "stored_slots": cl.Buffer(self.context, mf.READ_ONLY, 4 * self.max_tiles),
+            "cached_indices": cl.Buffer(self.context, mf.READ_ONLY, 4 * self.max_tiles),
+            "cached_slots": cl.Buffer(self.context, mf.READ_ONLY, 4 * self.max_tiles),
+            "event": None,
+        }
 
-    def process_frame(self, received_frame):
+    def allocate_host_buffer(self, shape, dtype):
         """
-        Process the received frame using OpenCL.
+        Allocate a page-locked host buffer, which the device can transfer to and from without staging copies.
 
         Args:
-            received_frame (np.ndarray): The frame to process.
+            shape (tuple): The shape of the buffer.
+            dtype (np.dtype): The data type of the buffer.
+
+        Returns:
+            np.ndarray: The mapped host buffer.
+        """
+        mf = cl.mem_flags
+        buffer = cl.Buffer(self.context, mf.READ_WRITE | mf.ALLOC_HOST_PTR, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        host_array, _ = cl.enqueue_map_buffer(self.queue, buffer, cl.map_flags.READ | cl.map_flags.WRITE, 0, shape,
+                                              dtype, is_blocking=True)
+        self.host_buffers.append(buffer)
+        return host_array
+
+    def submit(self, delta, output):
+        """
+        Enqueue applying a keyframe or tile delta and reading the result back, without waiting.
+
+        The delta's buffers must stay untouched until the returned event completes.
+
+        Args:
+            delta (TileDelta): The decoded keyframe or tile delta.
+            output (np.ndarray): The host buffer the updated frame is read back to.
+
+        Returns:
+            cl.Event: The event of the readback, or None if the delta changed nothing.
+        """
+        applied = self._enqueue_apply(delta)
+        if applied is None:
+            return None  # Nothing changed, the back buffer is already up to date
+        self.last_event = cl.enqueue_copy(self.queue, output, self.back_buffer_cl, is_blocking=False, wait_for=applied)
+        return self.last_event
+
+    def submit_display(self, delta, output):
         """
-        # Copy the received frame to the OpenCL buffer
-        cl.enqueue_copy(self.queue, self.diff_buffer_cl, received_frame).wait()
+        Enqueue applying a keyframe or tile delta, scaling the changed display rectangles and reading them back,
+        without waiting.
+
+        The display buffer on the device is kept up to date with each delta, only the rectangles the output misses
+        are read back, see DiffApplier.submit_display(). The delta's buffers must stay untouched until the returned
+        event completes.
+
+        Args:
+            delta (TileDelta): The decoded keyframe or tile delta.
+            output (np.ndarray): The persistent (display_height, display_width, DISPLAY_CHANNELS) uint8 host buffer.
+
+        Returns:
+            cl.Event: An event completing with the readbacks, or None if the delta changed nothing.
+        """
+        applied = self._enqueue_apply(delta)
+        if applied is None:
+            return None
+        damaged = self._damaged_rects(delta)
+        full_display = [(0, 0, self.display_width, self.display_height)]
+        kernel = self.scale_to_display_kernel
+        kernel.set_arg(0, self.back_buffer_cl)
+        kernel.set_arg(1, self.display_cl)
+        kernel.set_arg(2, self.scale_cl)
+        kernel.set_arg(3, np.uint32(self.frame_width))
+        kernel.set_arg(4, np.uint32(self.frame_height))
+        kernel.set_arg(5, np.uint32(self.display_width))
+        scaled = []
+        for x0, y0, x1, y1 in full_display if damaged is None else damaged:
+            kernel.set_arg(6, np.uint32(x0))
+            kernel.set_arg(7, np.uint32(y0))
+            kernel.set_arg(8, np.uint32(x1 - x0))
+            global_size = (-(-(x1 - x0) // SCALE_RUN), y1 - y0)
+            scaled.append(cl.enqueue_nd_range_kernel(self.queue, kernel, global_size, None, wait_for=applied))
+
+        row_pitch = DISPLAY_CHANNELS * self.display_width
+        readbacks = []
+        for x0, y0, x1, y1 in self._output_rects(output, damaged):
+            origin = (DISPLAY_CHANNELS * x0, y0, 0)
+            readbacks.append(cl.enqueue_copy(self.queue, output, self.display_cl, buffer_origin=origin,
+                                             host_origin=origin, region=(DISPLAY_CHANNELS * (x1 - x0), y1 - y0, 1),
+                                             buffer_pitches=(row_pitch, 0), host_pitches=(row_pitch, 0),
+                                             is_blocking=False, wait_for=scaled))
+        # The next delta may only change the back buffer and the display buffer once these are done
+        self.last_event = cl.enqueue_marker(self.queue, wait_for=readbacks)
+        return self.last_event
+
+    def _enqueue_apply(self, delta):
+        """
+        Enqueue applying a keyframe or tile delta to the back buffer, after the commands of the previous one.
+
+        Args:
+            delta (TileDelta): The decoded keyframe or tile delta.
+
+        Returns:
+            list: The events after which the back buffer is up to date, or None if the delta changed nothing.
+        """
+        self._match_frame_size(delta)
+        previous = [self.last_event] if self.last_event is not None else []
+
+        if delta.keyframe and delta.pixel_format == pixel_formats.BGRA32:
+            return [cl.enqueue_copy(self.queue, self.back_buffer_cl, delta.pixels, is_blocking=False,
+                                    wait_for=previous)]
+        if delta.keyframe:
+            # Unpacked like a single tile covering the frame
+            tile_size = max(self.frame_width, self.frame_height)
+            upload_set, in_use = self._next_upload_set()
+            kernel_event = self._enqueue_tiles(delta, upload_set, in_use, _FIRST_TILE, _FIRST_TILE, tile_size,
+                                               (1, self.frame_width * self.frame_height), previous)
+            upload_set["event"] = kernel_event
+            return [kernel_event]
+
+        tile_count = len(delta.indices)
+        cached_count = len(delta.cached_indices)
+        if tile_count == 0 and cached_count == 0 and len(delta.copies) == 0:
+            return None
+
+        previous = self._enqueue_copies(delta.copies, previous)  # Moved content first, the tiles go on top
+        if tile_count == 0 and cached_count == 0:
+            return previous
+
+        if max(tile_count, cached_count) > self.max_tiles:
+            # A smaller tile size than expected, grow the index buffers to match
+            self.queue.finish()
+            self.max_tiles = max(tile_count, cached_count)
+            self.upload_sets = [self._create_upload_set() for _ in self.upload_sets]
+
+        upload_set, in_use = self._next_upload_set()
+        if cached_count:
+            # The cached tiles first, the sent tiles may be stored in their slots afterwards
+            uploads = [
+                cl.enqueue_copy(self.queue, upload_set["cached_indices"], delta.cached_indices, is_blocking=False,
+                                wait_for=in_use),
+                cl.enqueue_copy(self.queue, upload_set["cached_slots"], delta.cached_slots, is_blocking=False,
+                                wait_for=in_use),
+            ]
+            previous = [self._enqueue_cache_tiles(upload_set["cached_indices"], upload_set["cached_slots"],
+                                                  cached_count, delta.tile_size, False, uploads + previous)]
+        if tile_count:
+            previous = [self._enqueue_tiles(delta, upload_set, in_use, delta.indices, delta.offsets, delta.tile_size,
+                                            (tile_count, delta.tile_size * delta.tile_size), previous)]
+            if delta.stored_slots is not None:
+                upload = cl.enqueue_copy(self.queue, upload_set["stored_slots"], delta.stored_slots, is_blocking=False,
+                                         wait_for=in_use)
+                previous = [self._enqueue_cache_tiles(upload_set["indices"], upload_set["stored_slots"], tile_count,
+                                                      delta.tile_size, True, [upload] + previous)]
+        upload_set["event"] = previous[0]  # The last kernel reading the set, after the others
+        return previous
+
+    def _next_upload_set(self):
+        """
+        Take the next set of upload buffers in turn.
+
+        Returns:
+            tuple: The upload set and the events the uploads to it have to wait for.
+        """
+        upload_set = self.upload_sets[self.upload_set_index]
+        self.upload_set_index = (self.upload_set_index + 1) % len(self.upload_sets)
+        in_use = [upload_set["event"]] if upload_set["event"] is not None else []  # The kernel still reading it
+        return upload_set, in_use
+
+    def _enqueue_tiles(self, delta, upload_set, in_use, indices, offsets, tile_size, global_size, wait_for):
+        """
+        Enqueue uploading tiles and the kernel writing them to the back buffer, unpacking compact pixel formats.
+
+        Args:
+            delta (TileDelta): The delta the tile pixels come from.
+            upload_set (dict): The upload buffers to use.
+            in_use (list): The events of the kernels still reading the upload buffers.
+            indices (np.ndarray): The uint32 tile indices.
+            offsets (np.ndarray): The uint32 offsets of the tiles, in pixels, or bytes in compact pixel formats.
+            tile_size (int): The tile size.
+            global_size (tuple): The number of tiles and the work items per tile.
+            wait_for (list): The events the kernel waits for besides the uploads.
+
+        Returns:
+            cl.Event: The event of the kernel.
+        """
+        # Copy the dirty tiles to the OpenCL buffers
+        uploads = [
+            cl.enqueue_copy(self.queue, upload_set["data"], delta.pixels, is_blocking=False, wait_for=in_use),
+            cl.enqueue_copy(self.queue, upload_set["indices"], indices, is_blocking=False, wait_for=in_use),
+            cl.enqueue_copy(self.queue, upload_set["offsets"], offsets, is_blocking=False, wait_for=in_use),
+        ]
 
         # Set kernel arguments
-        add_diff_kernel = self.program_add_diff.AddDiffKernel
-        add_diff_kernel.set_arg(0, self.back_buffer_cl)
-        add_diff_kernel.set_arg(1, self.diff_buffer_cl)
-        add_diff_kernel.set_arg(2, np.uint32(self.frame_width))
-        add_diff_kernel.set_arg(3, np.uint32(self.frame_height))
+        if delta.pixel_format == pixel_formats.BGRA32:
+            kernel = self.apply_tiles_kernel
+        else:
+            kernel = self.apply_packed_tiles_kernel
+            kernel.set_arg(7, np.uint32(delta.pixel_format))
+        kernel.set_arg(0, self.back_buffer_cl)
+        kernel.set_arg(1, upload_set["data"])
+        kernel.set_arg(2, upload_set["indices"])
+        kernel.set_arg(3, upload_set["offsets"])
+        kernel.set_arg(4, np.uint32(self.frame_width))
+        kernel.set_arg(5, np.uint32(self.frame_height))
+        kernel.set_arg(6, np.uint32(tile_size))
+
+        # Execute the kernel once the uploads are done and the previous frame was read back
+        return cl.enqueue_nd_range_kernel(self.queue, kernel, global_size, None, wait_for=uploads + wait_for)
+
+    def _enqueue_cache_tiles(self, indices_cl, slots_cl, tile_count, tile_size, store, wait_for):
+        """
+        Enqueue the kernel copying tiles from the tile cache to the back buffer, or storing them in it.
+
+        Args:
+            indices_cl (cl.Buffer): The uploaded tile indices.
+            slots_cl (cl.Buffer): The uploaded cache slot of each tile.
+            tile_count (int): The number of tiles.
+            tile_size (int): The tile size.
+            store (bool): Whether to store the tiles instead of taking them from the cache.
+            wait_for (list): The events the kernel waits for.
+
+        Returns:
+            cl.Event: The event of the kernel.
+        """
+        if self.tile_cache_tile_size != tile_size:
+            self.queue.finish()  # Nothing may still use the old cache
+            self.tile_cache_cl = cl.Buffer(self.context, cl.mem_flags.READ_WRITE,
+                                           4 * tile_delta.tile_cache_slots(tile_size) * tile_size * tile_size)
+            self.tile_cache_tile_size = tile_size
 
-        # Execute the kernel
-        cl.enqueue_nd_range_kernel(self.queue, add_diff_kernel, (self.frame_width * self.frame_height,), None)
-        cl.enqueue_copy(self.queue, self.back_buffer, self.back_buffer_cl).wait()
+        kernel = self.cache_tiles_kernel
+        kernel.set_arg(0, self.back_buffer_cl)
+        kernel.set_arg(1, self.tile_cache_cl)
+        kernel.set_arg(2, indices_cl)
+        kernel.set_arg(3, slots_cl)
+        kernel.set_arg(4, np.uint32(self.frame_width))
+        kernel.set_arg(5, np.uint32(self.frame_height))
+        kernel.set_arg(6, np.uint32(tile_size))
+        kernel.set_arg(7, np.uint32(store))
+        return cl.enqueue_nd_range_kernel(self.queue, kernel, (tile_count, tile_size * tile_size), None,
+                                          wait_for=wait_for)
+
+    def _enqueue_copies(self, copies, wait_for):
+        """
+        Enqueue copying rectangles within the back buffer, one after another.
+
+        Args:
+            copies (np.ndarray): The (source x, source y, destination x, destination y, width, height) rectangles.
+            wait_for (list): The events the first copy waits for.
+
+        Returns:
+            list: The events the following commands have to wait for.
+        """
+        row_pitch = 4 * self.frame_width
+        for source_x, source_y, x, y, width, height in copies.tolist():
+            region = (4 * width, height, 1)
+            # Through the scratch buffer, a buffer can't be copied onto an overlapping part of itself
+            to_scratch = cl.enqueue_copy(self.queue, self.scratch_cl, self.back_buffer_cl,
+                                         src_origin=(4 * source_x, source_y, 0), dst_origin=(4 * x, y, 0),
+                                         region=region, src_pitches=(row_pitch, 0), dst_pitches=(row_pitch, 0),
+                                         wait_for=wait_for)
+            wait_for = [cl.enqueue_copy(self.queue, self.back_buffer_cl, self.scratch_cl, src_origin=(4 * x, y, 0),
+                                        dst_origin=(4 * x, y, 0), region=region, src_pitches=(row_pitch, 0),
+                                        dst_pitches=(row_pitch, 0), wait_for=[to_scratch])]
+        return wait_for
+
+    def process_frame(self, delta):
+        """
+        Apply a keyframe or tile delta to the back buffer using OpenCL and wait for the result.
+
+        Args:
+            delta (TileDelta): The decoded keyframe or tile delta.
+        """
+        event = self.submit(delta, self.back_buffer)
+        if event is not None:
+            event.wait()
 
     def get_processed_frame(self):
         """
-        Get the processed frame.
+        Read the back buffer back from the device, once the submitted deltas are applied. submit_display() only
+        reads back the display rectangles.
 
         Returns:
             np.ndarray: The processed frame.
         """
+        previous = [self.last_event] if self.last_event is not None else []
+        cl.enqueue_copy(self.queue, self.back_buffer, self.back_buffer_cl, is_blocking=True, wait_for=previous)
         return self.back_buffer
@@ -0,0 +1,73 @@
+import numpy as np
+
+try:
+    import av
+except ImportError:  # PyAV is optional, only needed when the server streams in video mode
+    av = None
+
+from common import protocol, tile_delta
+
+# FFmpeg decoder of each video codec id
+VIDEO_DECODERS = {
+    protocol.CODEC_H264: "h264",
+    protocol.CODEC_VP8: "vp8",
+    protocol.CODEC_VP9: "vp9",
+}
+
+
+class VideoDecoder:
+    """
+    VideoDecoder decodes the video packets of one stream into frames, which it hands to the diff
+    applier as keyframes, so applying and displaying work the same in both stream modes.
+
+    Attributes:
+        codec (int): The codec id of the packets.
+    """
+
+    def __init__(self, codec):
+        """
+        Initializes the VideoDecoder and opens the decoder.
+
+        Args:
+            codec (int): The codec id of the packets, one of VIDEO_DECODERS.
+
+        Raises:
+            RuntimeError: If PyAV is not installed.
+            ValueError: If the codec is not a video codec.
+        """
+        if av is None:
+            raise RuntimeError("The server streams video, which requires PyAV, install it with pip install av")
+        if codec not in VIDEO_DECODERS:
+            raise ValueError(f"Codec {codec} is not a video codec")
+        self.codec = codec
+        self.context = av.CodecContext.create(VIDEO_DECODERS[codec], "r")
+
+    def decode(self, payload, frame_width, frame_height):
+        """
+        Decode a packet.
+
+        Args:
+            payload (bytes-like): The encoded packet.
+            frame_width (int): The width of the frame announced in the message header.
+            frame_height (int): The height of the frame announced in the message header.
+
+        Returns:
+            TileDelta: The frame as a keyframe, or an empty delta if the decoder didn't output a frame.
+
+        Raises:
+            ValueError: If the packet is invalid or the frame has a different size than announced.
+        """
+        try:
+            frames = self.context.decode(av.Packet(bytes(payload)))
+        except av.FFmpegError as e:
+            raise ValueError(f"Invalid video packet: {e}") from e
+        if not frames:
+            empty = np.empty(0, np.uint32)
+            return tile_delta.TileDelta(False, tile_delta.TILE_SIZE, empty, empty, empty, frame_width, frame_height)
+
+        frame = frames[-1]
+        if (frame.width, frame.height) != (frame_width, frame_height):
+            raise ValueError(f"Video frame of {frame.width}x{frame.height} doesn't match the announced size")
+        pixels = frame.to_ndarray(format="bgra").view(np.uint32).ravel()
+        empty = np.empty(0, np.uint32)
+        return tile_delta.TileDelta(True, tile_delta.TILE_SIZE, empty, empty, pixels, frame_width, frame_height)
@@ -0,0 +1,282 @@
+import ctypes
+import ctypes.util
+import struct
+import lz4.block
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, without it frames are compressed with LZ4
+    zstandard = None
+
+from common import protocol
+
+# Chunked payloads start with the chunk count, followed by the compressed and raw length of each chunk
+_CHUNK_COUNT = struct.Struct('<I')
+_CHUNK_ENTRY = struct.Struct('<II')
+
+
+def _load_liblz4():
+    """
+    Load the system LZ4 library, which can decompress straight into an existing buffer.
+
+    Returns:
+        ctypes.CDLL: The loaded library, or None if it is not available.
+    """
+    path = ctypes.util.find_library('lz4')
+    if path is None:
+        return None
+    try:
+        library = ctypes.CDLL(path)
+    except OSError:
+        return None
+    library.LZ4_decompress_safe.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_int]
+    library.LZ4_decompress_safe.restype = ctypes.c_int
+    return library
+
+
+_liblz4 = _load_liblz4()
+
+# Whether decompress_into writes into the destination without allocating intermediate buffers
+ZERO_COPY_DECOMPRESSION = _liblz4 is not None
+
+# Whether zstd payloads can be compressed and decompressed
+ZSTD_AVAILABLE = zstandard is not None
+
+HISTORY_SIZE = 256 * 1024  # Bytes of past payloads a zstd payload may refer to
+
+
+class CompressionHistory:
+    """
+    CompressionHistory holds the last uncompressed payloads of a stream. Tile deltas are compressed
+    with zstd using it as their dictionary, so a delta can refer to the deltas sent before it,
+    e.g. a glyph typed again, instead of starting with an empty window like an LZ4 block.
+
+    The packets of a stream are shared by all its clients, so the server and every client keep a
+    history per stream and update it the same way from the packets, see update(). Keyframes are
+    compressed without it and start it over, which keeps the history of a client joining with a
+    keyframe the same as the one of the clients that were there before.
+
+    Attributes:
+        size (int): The most bytes kept.
+        data (bytearray): The last bytes of the payloads since the history started over, oldest first.
+    """
+
+    def __init__(self, size=HISTORY_SIZE):
+        """
+        Initializes an empty CompressionHistory.
+
+        Args:
+            size (int, optional): The most bytes kept. Defaults to HISTORY_SIZE.
+        """
+        self.size = size
+        self.data = bytearray()
+        self._dictionary = None
+
+    def reset(self):
+        """
+        Start the history over.
+        """
+        self.data = bytearray()
+        self._dictionary = None
+
+    def extend(self, data):
+        """
+        Append a payload, dropping the oldest bytes beyond the size.
+
+        Args:
+            data (bytes-like): The uncompressed payload.
+        """
+        if len(data) >= self.size:
+            self.data = bytearray(data[len(data) - self.size:])
+        else:
+            self.data += data
+            if len(self.data) > self.size:
+                del self.data[:len(self.data) - self.size]
+        self._dictionary = None
+
+    def update(self, header, data):
+        """
+        Update the history with a tile packet of the stream, after it was compressed or decompressed.
+
+        Keyframes and deltas flagged with protocol.FLAG_RESETS_HISTORY start the history over,
+        other zstd payloads are appended to it unless flagged with protocol.FLAG_DETACHED.
+
+        Args:
+            header (MessageHeader): The header of the packet.
+            data (bytes-like): The uncompressed payload.
+        """
+        if header.keyframe or header.flags & protocol.FLAG_RESETS_HISTORY:
+            self.reset()
+        elif header.codec == protocol.CODEC_ZSTD and not header.flags & protocol.FLAG_DETACHED:
+            self.extend(data)
+
+    def dictionary(self):
+        """
+        Get the history as a zstd dictionary.
+
+        Returns:
+            zstandard.ZstdCompressionDict: The dictionary, or None if the history is empty.
+        """
+        if self._dictionary is None and self.data:
+            self._dictionary = zstandard.ZstdCompressionDict(bytes(self.data),
+                                                             dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+        return self._dictionary
+
+
+def compress_block(data, acceleration=1):
+    """
+    Compress data into a raw LZ4 block.
+
+    Args:
+        data (bytes-like): The data to compress.
+        acceleration (int, optional): The LZ4 acceleration, higher is faster but compresses less. Defaults to 1.
+
+    Returns:
+        bytes: The compressed block, without the uncompressed size prefix.
+    """
+    return lz4.block.compress(data, store_size=False, acceleration=acceleration)
+
+
+def compress_zstd(data, level=1, history=None):
+    """
+    Compress data into a zstd frame.
+
+    Args:
+        data (bytes-like): The data to compress.
+        level (int, optional): The zstd level, negative levels are faster but compress less. Defaults to 1.
+        history (CompressionHistory, optional): The history the frame may refer to, or None for a frame
+            decompressing on its own, e.g. a keyframe. Defaults to None.
+
+    Returns:
+        bytes: The compressed frame.
+    """
+    dictionary = history.dictionary() if history is not None else None
+    compressor = zstandard.ZstdCompressor(level=level, dict_data=dictionary, write_checksum=False,
+                                          write_dict_id=False)
+    return compressor.compress(data)
+
+
+def decompress_zstd_into(source, source_length, destination, history=None):
+    """
+    Decompress a zstd frame into a preallocated buffer.
+
+    Args:
+        source (bytes-like): The buffer holding the compressed frame at its start.
+        source_length (int): The length of the compressed frame.
+        destination (bytearray): The buffer to decompress into. Its size bounds the decompressed size.
+        history (CompressionHistory, optional): The history the frame was compressed with, or None.
+            Defaults to None.
+
+    Returns:
+        int: The number of decompressed bytes.
+
+    Raises:
+        ValueError: If the frame is corrupted or does not fit the destination.
+    """
+    frame = memoryview(source)[:source_length]
+    try:
+        length = zstandard.frame_content_size(frame)
+        if not 0 <= length <= len(destination):
+            raise ValueError("zstd frame does not fit the destination")
+        dictionary = history.dictionary() if history is not None else None
+        reader = zstandard.ZstdDecompressor(dict_data=dictionary).stream_reader(frame)
+        view = memoryview(destination)[:length]
+        filled = 0
+        while filled < length:
+            count = reader.readinto(view[filled:])
+            if not count:
+                raise ValueError("Truncated zstd frame")
+            filled += count
+    except zstandard.ZstdError as e:
+        raise ValueError(f"Corrupted zstd frame: {e}") from e
+    return length
+
+
+def decompress_into(source, source_length, destination, source_offset=0, destination_offset=0):
+    """
+    Decompress a raw LZ4 block into a preallocated buffer.
+
+    Args:
+        source (bytearray): The buffer holding the compressed block.
+        source_length (int): The length of the compressed block.
+        destination (bytearray): The buffer to decompress into. Its size bounds the decompressed size.
+        source_offset (int, optional): The offset of the block in the source. Defaults to 0.
+        destination_offset (int, optional): The offset to decompress to. Defaults to 0.
+
+    Returns:
+        int: The number of decompressed bytes.
+
+    Raises:
+        ValueError: If the block is corrupted or does not fit the destination.
+    """
+    capacity = len(destination) - destination_offset
+    if source_offset + source_length > len(source) or capacity < 0:
+        raise ValueError("LZ4 block out of bounds")
+
+    if _liblz4 is not None:
+        source_address = ctypes.addressof(ctypes.c_char.from_buffer(source)) + source_offset
+        destination_address = ctypes.addressof(ctypes.c_char.from_buffer(destination)) + destination_offset
+        length = _liblz4.LZ4_decompress_safe(source_address, destination_address, source_length, capacity)
+        if length < 0:
+            raise ValueError("Corrupted LZ4 block")
+        return length
+
+    # No system library, fall back to python-lz4 and copy its result
+    try:
+        data = lz4.block.decompress(memoryview(source)[source_offset:source_offset + source_length],
+                                    uncompressed_size=capacity)
+    except lz4.block.LZ4BlockError as e:
+        raise ValueError(f"Corrupted LZ4 block: {e}") from e
+    destination[destination_offset:destination_offset + len(data)] = data
+    return len(data)
+
+
+def join_chunks(chunks):
+    """
+    Join independently compressed LZ4 blocks into one payload. The blocks decompress to
+    consecutive parts of the original data, so they can be compressed in parallel.
+
+    Args:
+        chunks (list): Tuples of a compressed block and its decompressed length, in order.
+
+    Returns:
+        bytes: The chunked payload.
+    """
+    table = [_CHUNK_COUNT.pack(len(chunks))]
+    table.extend(_CHUNK_ENTRY.pack(len(compressed), raw_length) for compressed, raw_length in chunks)
+    return b''.join(table + [compressed for compressed, _ in chunks])
+
+
+def decompress_chunks_into(source, source_length, destination):
+    """
+    Decompress a payload made by join_chunks into a preallocated buffer.
+
+    Args:
+        source (bytearray): The buffer holding the chunked payload at its start.
+        source_length (int): The length of the chunked payload.
+        destination (bytearray): The buffer to decompress into.
+
+    Returns:
+        int: The number of decompressed bytes.
+
+    Raises:
+        ValueError: If the payload is corrupted or does not fit the destination.
+    """
+    if source_length < _CHUNK_COUNT.size:
+        raise ValueError("Truncated chunked payload")
+    chunk_count, = _CHUNK_COUNT.unpack_from(source, 0)
+    source_offset = _CHUNK_COUNT.size + chunk_count * _CHUNK_ENTRY.size
+    if source_offset > source_length:
+        raise ValueError("Truncated chunk table")
+
+    destination_offset = 0
+    for i in range(chunk_count):
+        compressed_length, raw_length = _CHUNK_ENTRY.unpack_from(source, _CHUNK_COUNT.size + i * _CHUNK_ENTRY.size)
+        if source_offset + compressed_length > source_length:
+            raise ValueError("Truncated chunk")
+        length = decompress_into(source, compressed_length, destination, source_offset, destination_offset)
+        if length != raw_length:
+            raise ValueError("Chunk length mismatch")
+        source_offset += compressed_length
+        destination_offset += length
+    return destination_offset
@@ -0,0 +1,293 @@
+import math
+import struct
+import numpy as np
+
+from common import compression, pixel_formats, protocol, tile_delta
+
+MAX_FRAGMENT_SIZE = 1200  # Bytes of unit data per datagram, so datagrams with their headers fit common path MTUs
+MAX_FRAGMENTS = 0xFFFF  # Fragments of one frame, data and parity, the indices are 16 bits
+UNIT_SIZE = 32 * 1024  # Bytes of tile pixels after which a delta starts a new unit, before compression
+FEC_RATIO = 0.2  # Parity fragments sent per data fragment by default
+NO_TILE = 0xFFFFFFFF  # The tile range of units that are not tiles, e.g. keyframes or the copies of a delta
+
+# sequence number of the frame among the ones sent to the client, fragment index, data count, parity count
+FRAGMENT = struct.Struct('!IHHH')
+# first fragment of the unit, fragment count of the unit, first tile, last tile, data length, starting data fragments
+UNIT = struct.Struct('!HHIIH')
+# sequence number of the frame, starting the NACK payload, followed by a NACK_INDEX per missing fragment, none for all
+NACK = struct.Struct('!I')
+NACK_INDEX = struct.Struct('!H')
+MAX_NACK_INDICES = 512  # Missing fragments requested in one NACK, the others with the next one
+
+# Codecs of deltas that can be split into units decoding on their own, the others are sent as one unit
+_SPLIT_CODECS = (protocol.CODEC_RAW, protocol.CODEC_LZ4_BLOCK, protocol.CODEC_LZ4_CHUNKS)
+
+
+def follows(sequence, previous):
+    """
+    Check whether a sequence number comes after another one, allowing for the numbers wrapping around.
+
+    Args:
+        sequence (int): The sequence number.
+        previous (int): The sequence number to compare to.
+
+    Returns:
+        bool: True if sequence is later than previous.
+    """
+    return 0 < (sequence - previous) & 0xFFFFFFFF < 0x80000000
+
+
+def split_units(packet, buffer, unit_size=UNIT_SIZE):
+    """
+    Split the payload of a frame message into the units it is sent in over UDP.
+
+    Tile deltas are split into tile deltas of consecutive tiles, each compressed on its own, so
+    a client applies the ones it received when others are lost. The copies of a delta come first,
+    in a unit of their own. Keyframes and payloads that depend on other payloads, like zstd and
+    video, are sent as one unit.
+
+    Args:
+        packet (Packet): The frame message.
+        buffer (bytearray): A buffer the payload is decompressed into, grown as needed.
+
+    Returns:
+        tuple: The codec and flags of the units, the (first tile, last tile, data) of each unit and the buffer.
+    """
+    header = packet.header
+    whole = header.codec, header.flags, [(NO_TILE, NO_TILE, packet.payload)], buffer
+    if header.keyframe or header.codec not in _SPLIT_CODECS:
+        return whole
+
+    size = tile_delta.max_encoded_size(header.width, header.height)
+    if len(buffer) < size:
+        buffer = bytearray(size)
+    # The LZ4 library only reads from writable buffers
+    source = packet.payload if isinstance(packet.payload, bytearray) else bytearray(packet.payload)
+    try:
+        if header.codec == protocol.CODEC_LZ4_BLOCK:
+            length = compression.decompress_into(source, len(source), buffer)
+        elif header.codec == protocol.CODEC_LZ4_CHUNKS:
+            length = compression.decompress_chunks_into(source, len(source), buffer)
+        else:
+            length = len(packet.payload)
+            buffer[:length] = packet.payload
+        delta = tile_delta.decode(memoryview(buffer)[:length], header.width, header.height)
+    except ValueError:
+        return whole  # Sent as it is, the client reports the error
+    if delta.stored_slots is not None or not len(delta.indices):
+        return whole  # Tile cache references only decode in order, empty deltas are tiny
+
+    flags = header.flags | protocol.FLAG_TILE_UNITS
+    units = []
+    if len(delta.copies):
+        flags |= protocol.FLAG_COPIES
+        copies = tile_delta.encode_tile_header(delta.indices[:0], delta.tile_size, delta.copies, delta.pixel_format)
+        units.append((NO_TILE, NO_TILE, compression.compress_block(copies)))
+
+    pixels = memoryview(delta.pixels).cast('B')
+    _, _, widths, heights, _ = tile_delta.tile_geometry(delta.indices, header.width, header.height, delta.tile_size)
+    if delta.pixel_format == pixel_formats.BGRA32:
+        sizes = 4 * widths * heights
+    else:
+        sizes = pixel_formats.packed_sizes(delta.pixel_format, widths, heights).astype(np.int64)
+    ends = np.cumsum(sizes)
+    # A unit ends with the tile its pixels reach the unit size with, and with the last tile
+    last_tiles = np.flatnonzero(np.diff((ends - 1) // unit_size, append=-1))
+    first = 0
+    for last in last_tiles.tolist():
+        start = int(ends[first] - sizes[first])
+        unit = tile_delta.encode_tile_header(delta.indices[first:last + 1], delta.tile_size,
+                                             pixel_format=delta.pixel_format)
+        unit += pixels[start:int(ends[last])]
+        units.append((int(delta.indices[first]), int(delta.indices[last]), compression.compress_block(unit)))
+        first = last + 1
+    return protocol.CODEC_LZ4_BLOCK, flags, units, buffer
+
+
+def fragment(units, fec_ratio=FEC_RATIO):
+    """
+    Cut units into the bodies of fragment datagrams and add XOR parity fragments.
+
+    Every data fragment starts with the UNIT fields of its unit. The parity fragments protect
+    interleaved groups of data fragments: parity fragment j is the XOR of the data fragments whose
+    index modulo the parity count is j, so losing any one fragment of a group, or a burst of as
+    many fragments in a row as there are parity fragments, is recovered without retransmission.
+
+    Args:
+        units (list): The (first tile, last tile, data) of each unit.
+        fec_ratio (float, optional): Parity fragments per data fragment, 0 for none. Defaults to FEC_RATIO.
+
+    Returns:
+        tuple: The bodies of the data fragments followed by the parity fragments, and the count of data fragments.
+
+    Raises:
+        ValueError: If the frame needs more than MAX_FRAGMENTS fragments.
+    """
+    counts = [max(1, -(-len(data) // MAX_FRAGMENT_SIZE)) for _, _, data in units]
+    data_count = sum(counts)
+    parity_count = min(data_count, math.ceil(data_count * fec_ratio)) if fec_ratio > 0 else 0
+    if data_count + parity_count > MAX_FRAGMENTS:
+        raise ValueError(f"A frame of {data_count} fragments is too large for datagrams")
+
+    bodies = []
+    for (first_tile, last_tile, data), count in zip(units, counts):
+        data = memoryview(data).cast('B')
+        start = len(bodies)
+        for offset in range(0, count * MAX_FRAGMENT_SIZE, MAX_FRAGMENT_SIZE):
+            chunk = data[offset:offset + MAX_FRAGMENT_SIZE]
+            bodies.append(UNIT.pack(start, count, first_tile, last_tile, len(chunk)) + chunk)
+    if parity_count:
+        lengths = np.array([len(body) for body in bodies])
+        matrix = np.zeros((data_count, int(lengths.max())), dtype=np.uint8)
+        for row, body in zip(matrix, bodies):
+            row[:len(body)] = np.frombuffer(body, dtype=np.uint8)
+        for group in range(parity_count):
+            parity = np.bitwise_xor.reduce(matrix[group::parity_count], axis=0)
+            bodies.append(parity[:int(lengths[group::parity_count].max())].tobytes())
+    return bodies, data_count
+
+
+class FrameAssembly:
+    """
+    FrameAssembly collects the fragments of one frame received over UDP, recovering lost data
+    fragments from the parity fragments where possible.
+
+    Attributes:
+        header (MessageHeader): The header of the frame, as carried by each of its fragments.
+        sequence (int): The sequence number of the frame.
+        data_count (int): The number of data fragments.
+        parity_count (int): The number of parity fragments.
+        bodies (list): The body of each fragment, None while missing.
+        missing (int): The number of data fragments neither received nor recovered.
+        recovered (int): The number of data fragments recovered from the parity.
+        last_time (float): The time.perf_counter() time the last fragment arrived.
+        nacks (int): The number of retransmission requests sent for the frame.
+    """
+
+    def __init__(self, header, sequence, data_count, parity_count, now):
+        self.header = header
+        self.sequence = sequence
+        self.data_count = data_count
+        self.parity_count = parity_count
+        self.bodies = [None] * (data_count + parity_count)
+        self.missing = data_count
+        self.recovered = 0
+        self.last_time = now
+        self.nacks = 0
+
+    @property
+    def complete(self):
+        """
+        bool: Whether all data fragments were received or recovered.
+        """
+        return not self.missing
+
+    def add(self, index, body, now):
+        """
+        Add a received fragment.
+
+        Args:
+            index (int): The index of the fragment.
+            body (bytes): The body of the fragment.
+            now (float): The current time.perf_counter() time.
+        """
+        self.last_time = now
+        if index >= len(self.bodies) or self.bodies[index] is not None:
+            return  # Invalid, or a retransmitted fragment that was recovered meanwhile
+        if index < self.data_count and (len(body) < UNIT.size or UNIT.size + UNIT.unpack_from(body)[4] != len(body)):
+            return
+        self.bodies[index] = body
+        if index < self.data_count:
+            self.missing -= 1
+        if self.parity_count:
+            self._recover(index % self.parity_count if index < self.data_count else index - self.data_count)
+
+    def _recover(self, group):
+        """
+        Recover the missing data fragment of a parity group, if only one is missing and the parity was received.
+
+        Args:
+            group (int): The index of the parity group.
+        """
+        parity = self.bodies[self.data_count + group]
+        members = range(group, self.data_count, self.parity_count)
+        missing = [index for index in members if self.bodies[index] is None]
+        if parity is None or len(missing) != 1:
+            return
+        recovered = np.frombuffer(parity, dtype=np.uint8).copy()
+        for index in members:
+            body = self.bodies[index]
+            if body is not None:
+                if len(body) > len(recovered):
+                    return  # Parity of another length, corrupted
+                recovered[:len(body)] ^= np.frombuffer(body, dtype=np.uint8)
+        if len(recovered) >= UNIT.size:
+            length = UNIT.size + UNIT.unpack_from(recovered)[4]
+            if length <= len(recovered):
+                self.bodies[missing[0]] = recovered[:length].tobytes()
+                self.missing -= 1
+                self.recovered += 1
+
+    def first_unit_complete(self):
+        """
+        Check whether the first unit arrived, e.g. the copies the other units of a delta depend on.
+
+        Returns:
+            bool: True if all fragments of the first unit were received or recovered.
+        """
+        if self.bodies[0] is None:
+            return False
+        count = UNIT.unpack_from(self.bodies[0])[1]
+        return all(body is not None for body in self.bodies[:min(count, self.data_count)])
+
+    def missing_indices(self):
+        """
+        Get the data fragments to request again.
+
+        Returns:
+            list: The indices of the data fragments neither received nor recovered.
+        """
+        return [index for index in range(self.data_count) if self.bodies[index] is None]
+
+    def units(self, tile_count):
+        """
+        Collect the received units and the tiles of the lost ones.
+
+        The tiles of a lost unit are known from any of its fragments that arrived. Otherwise they lie
+        between the tiles of the units before and after it, which are all marked as lost, whether
+        they were sent or not.
+
+        Args:
+            tile_count (int): The number of tiles of the frame.
+
+        Returns:
+            tuple: The (first tile, last tile, data) of each complete unit in order, and the (first tile, last tile)
+                ranges of tiles that were lost.
+        """
+        known = {}
+        for body in self.bodies[:self.data_count]:
+            if body is not None:
+                start, count, first_tile, last_tile, _ = UNIT.unpack_from(body)
+                known[start] = (count, first_tile, last_tile)
+
+        units, lost = [], []
+        end = 0  # The fragment after the last unit seen
+        next_tile = 0  # The tile after the last tile of the last unit seen
+        for start in sorted(known):
+            count, first_tile, last_tile = known[start]
+            if start < end or start + count > self.data_count:
+                continue  # Corrupted
+            if start > end and first_tile != NO_TILE and first_tile > next_tile:
+                lost.append((next_tile, first_tile - 1))  # Units were lost in between
+            fragments = self.bodies[start:start + count]
+            if all(body is not None for body in fragments):
+                data = bytearray().join(memoryview(body)[UNIT.size:] for body in fragments)
+                units.append((first_tile, last_tile, data))
+            elif first_tile != NO_TILE:
+                lost.append((first_tile, last_tile))
+            end = start + count
+            if last_tile != NO_TILE:
+                next_tile = last_tile + 1
+        if end < self.data_count and next_tile < tile_count:
+            lost.append((next_tile, tile_count - 1))
+        return units, lost
@@ -0,0 +1,401 @@
+import bisect
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of the default histogram buckets in seconds, from 50 us to 1 s
+TIME_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# Upper bounds of the buckets for ratios between 0 and 1
+RATIO_BUCKETS = (0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 0.75, 1.0)
+
+
+def _format_labels(labels):
+    """
+    Format labels the way Prometheus does, e.g. {stage="capture"}.
+    """
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in sorted(labels.items())) + "}"
+
+
+class Counter:
+    """
+    Counter is a monotonically increasing value, e.g. the number of bytes sent.
+
+    Attributes:
+        name (str): The metric name.
+        help_text (str): The description of the metric.
+        labels (dict): The labels distinguishing this counter from others with the same name.
+        value (float): The current value.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """
+        Increase the counter.
+
+        Args:
+            amount (float, optional): The amount to add. Defaults to 1.
+        """
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, self.labels, self.value)]
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(Counter):
+    """
+    Gauge is a value that can go up and down, e.g. the number of connected clients.
+    """
+
+    kind = "gauge"
+
+    def set(self, value):
+        """
+        Set the gauge.
+
+        Args:
+            value (float): The new value.
+        """
+        self.value = value
+
+
+class Histogram:
+    """
+    Histogram counts observations in fixed buckets, e.g. the time spent in a pipeline stage.
+    Observing a value is a bisection and two additions, cheap enough to do for every frame.
+
+    Attributes:
+        name (str): The metric name.
+        help_text (str): The description of the metric.
+        labels (dict): The labels distinguishing this histogram from others with the same name.
+        buckets (tuple): The ascending upper bounds of the buckets, an implicit +Inf bucket follows.
+        counts (list): The number of observations per bucket, not cumulative.
+        count (int): The number of observations.
+        sum (float): The sum of all observations.
+        max (float): The largest observation.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        """
+        Record an observation.
+
+        Args:
+            value (float): The observed value.
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, q):
+        """
+        Estimate a quantile by linear interpolation within its bucket.
+
+        Args:
+            q (float): The quantile between 0 and 1.
+
+        Returns:
+            float: The estimated quantile, 0 without observations.
+        """
+        with self.lock:
+            counts, count, maximum = list(self.counts), self.count, self.max
+        if count == 0:
+            return 0.0
+
+        rank = q * count
+        cumulative = 0
+        for index, bucket_count in enumerate(counts):
+            if bucket_count and cumulative + bucket_count >= rank:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else maximum
+                return min(maximum, lower + (upper - lower) * (rank - cumulative) / bucket_count)
+            cumulative += bucket_count
+        return maximum
+
+    def samples(self):
+        with self.lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            labels = dict(self.labels, le="+Inf" if bound == float("inf") else repr(bound))
+            samples.append((self.name + "_bucket", labels, cumulative))
+        samples.append((self.name + "_sum", self.labels, total))
+        samples.append((self.name + "_count", self.labels, count))
+        return samples
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+        }
+
+
+class MetricsRegistry:
+    """
+    MetricsRegistry holds the metrics of a process and exports them as Prometheus text or JSON.
+
+    Metrics are created on first use and cached, so hot code should look them up once and keep
+    the returned object.
+
+    Attributes:
+        prefix (str): The prefix of all metric names.
+        metrics (dict): The metrics by name and labels.
+    """
+
+    def __init__(self, prefix="screenshare"):
+        self.prefix = prefix
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, metric_class, name, help_text, labels, **options):
+        full_name = f"{self.prefix}_{name}" if self.prefix else name
+        key = (full_name, tuple(sorted(labels.items())))
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = self.metrics[key] = metric_class(full_name, help_text, labels, **options)
+            elif not isinstance(metric, metric_class):
+                raise ValueError(f"Metric {full_name} is already registered as a {metric.kind}")
+            return metric
+
+    def counter(self, name, help_text="", **labels):
+        """
+        Get or create a counter.
+
+        Args:
+            name (str): The metric name without the prefix.
+            help_text (str, optional): The description of the metric. Defaults to "".
+            **labels: The labels of the counter.
+
+        Returns:
+            Counter: The counter.
+        """
+        return self._get(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text="", **labels):
+        """
+        Get or create a gauge.
+
+        Args:
+            name (str): The metric name without the prefix.
+            help_text (str, optional): The description of the metric. Defaults to "".
+            **labels: The labels of the gauge.
+
+        Returns:
+            Gauge: The gauge.
+        """
+        return self._get(Gauge, name, help_text, labels)
+
+    def histogram(self, name, help_text="", buckets=TIME_BUCKETS, **labels):
+        """
+        Get or create a histogram.
+
+        Args:
+            name (str): The metric name without the prefix.
+            help_text (str, optional): The description of the metric. Defaults to "".
+            buckets (tuple, optional): The upper bounds of the buckets. Defaults to TIME_BUCKETS.
+            **labels: The labels of the histogram.
+
+        Returns:
+            Histogram: The histogram.
+        """
+        return self._get(Histogram, name, help_text, labels, buckets=buckets)
+
+    def stage(self, side, stage):
+        """
+        Get the histogram timing a pipeline stage.
+
+        Args:
+            side (str): "server" or "client".
+            stage (str): The name of the stage, e.g. "capture".
+
+        Returns:
+            Histogram: The histogram of the stage's duration in seconds.
+        """
+        return self.histogram(f"{side}_stage_seconds", f"Time spent per frame in each {side} pipeline stage",
+                              stage=stage)
+
+    def to_prometheus(self):
+        """
+        Export all metrics in the Prometheus text exposition format.
+
+        Returns:
+            str: The exported metrics.
+        """
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        described = set()
+        for metric in metrics:
+            if metric.name not in described:
+                described.add(metric.name)
+                if metric.help_text:
+                    lines.append(f"# HELP {metric.name} {metric.help_text}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """
+        Export all metrics as a flat dictionary, histograms summarized by count, mean and quantiles.
+
+        Returns:
+            dict: The metric values by name and labels.
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {metric.name + _format_labels(metric.labels): metric.snapshot() for metric in metrics}
+
+
+REGISTRY = MetricsRegistry()  # The registry of this process
+
+
+class PrometheusExporter:
+    """
+    PrometheusExporter serves the metrics of a registry over HTTP, for Prometheus to scrape.
+
+    Attributes:
+        registry (MetricsRegistry): The exported registry.
+        server (ThreadingHTTPServer): The HTTP server.
+    """
+
+    def __init__(self, registry, port, host="0.0.0.0"):
+        """
+        Initializes the PrometheusExporter and starts serving in a background thread.
+
+        Args:
+            registry (MetricsRegistry): The registry to export.
+            port (int): The port to serve the metrics on.
+            host (str, optional): The address to bind. Defaults to "0.0.0.0".
+        """
+        self.registry = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                body = registry.to_prometheus().encode()
+                handler.send_response(200)
+                handler.send_header("Content-Type", "text/plain; version=0.0.4")
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args):
+                pass  # Don't log every scrape
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """
+        Stop serving the metrics.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class JsonLinesExporter:
+    """
+    JsonLinesExporter periodically appends a snapshot of a registry to a JSON-lines file, one
+    object with a timestamp and the metric values per line.
+
+    Attributes:
+        registry (MetricsRegistry): The exported registry.
+        path (str): The file the snapshots are appended to.
+        interval (float): The seconds between snapshots.
+    """
+
+    def __init__(self, registry, path, interval=1.0):
+        """
+        Initializes the JsonLinesExporter and starts writing in a background thread.
+
+        Args:
+            registry (MetricsRegistry): The registry to export.
+            path (str): The file the snapshots are appended to.
+            interval (float, optional): The seconds between snapshots. Defaults to 1.0.
+        """
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write_snapshot(self):
+        """
+        Append a snapshot of the registry to the file.
+        """
+        line = json.dumps({"time": time.time(), "metrics": self.registry.snapshot()})
+        with open(self.path, "a") as file:
+            file.write(line + "\n")
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.write_snapshot()
+
+    def close(self):
+        """
+        Stop writing and append a final snapshot.
+        """
+        self.stopped.set()
+        self.thread.join()
+        self.write_snapshot()
+
+
+def start_exporters(registry=REGISTRY, port=None, path=None, interval=1.0):
+    """
+    Start the requested exporters.
+
+    Args:
+        registry (MetricsRegistry, optional): The registry to export. Defaults to REGISTRY.
+        port (int, optional): The port to serve Prometheus metrics on, or None. Defaults to None.
+        path (str, optional): The JSON-lines file to write snapshots to, or None. Defaults to None.
+        interval (float, optional): The seconds between JSON-lines snapshots. Defaults to 1.0.
+
+    Returns:
+        list: The started exporters, each with a close() method.
+    """
+    exporters = []
+    if port:
+        exporters.append(PrometheusExporter(registry, port))
+    if path:
+        exporters.append(JsonLinesExporter(registry, path, interval))
+    return exporters
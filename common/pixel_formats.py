@@ -0,0 +1,185 @@
+import numpy as np
+import cv2
+
+# Wire pixel formats of the tile pixels, stored in the upper bits of the tile delta flags
+BGRA32 = 0  # 4 bytes per pixel, as captured
+BGR24 = 1  # 3 bytes per pixel without the alpha byte, lossless for opaque frames
+RGB565 = 2  # 2 bytes per pixel: 5 bits of red, 6 of green and 5 of blue, lossy
+YUV420 = 3  # 1.5 bytes per pixel: full-range BT.601 luma and chroma of 2x2 pixel blocks, lossy, for photos and video
+
+# The pixel format id of each pixel format name
+PIXEL_FORMATS = {"bgra32": BGRA32, "bgr24": BGR24, "rgb565": RGB565, "yuv420": YUV420}
+
+
+def _rgb565_tables():
+    """
+    Build the tables converting between BGRA and RGB565.
+
+    The levels are spread over the full range by repeating their top bits, so white stays white.
+    Packing rounds each channel to the level closest after unpacking, left-aligned in its byte.
+
+    Returns:
+        tuple: The (1, 256, 4) uint8 table of the left-aligned level of each channel value, and the
+            uint32 table of the opaque BGRA pixel of every RGB565 value.
+    """
+    values = np.arange(256)
+    levels = np.empty((1, 256, 4), dtype=np.uint8)
+    levels[0, :, 0] = levels[0, :, 2] = (values * 31 + 127) // 255 << 3
+    levels[0, :, 1] = (values * 63 + 127) // 255 << 2
+    levels[0, :, 3] = 255
+
+    packed = np.arange(1 << 16, dtype=np.uint32)
+    red, green, blue = packed >> 11, (packed >> 5) & 0x3F, packed & 0x1F
+    pixels = ((red << 3 | red >> 2) << 16) | ((green << 2 | green >> 4) << 8) | (blue << 3 | blue >> 2) | 0xFF000000
+    return levels, pixels
+
+
+_RGB565_LEVELS, _RGB565_PIXELS = _rgb565_tables()
+
+
+def chroma_size(widths, heights):
+    """
+    Calculate the size of the chroma planes of YUV420 tiles, which have one sample per 2x2 pixel block.
+
+    Args:
+        widths (np.ndarray): The width of each tile.
+        heights (np.ndarray): The height of each tile.
+
+    Returns:
+        tuple: The width and height of each tile's chroma planes.
+    """
+    return (widths + 1) // 2, (heights + 1) // 2
+
+
+def packed_sizes(pixel_format, widths, heights):
+    """
+    Calculate the size of each tile's pixels in a pixel format.
+
+    Args:
+        pixel_format (int): The pixel format.
+        widths (np.ndarray): The width of each tile.
+        heights (np.ndarray): The height of each tile.
+
+    Returns:
+        np.ndarray: The size of each tile in bytes.
+
+    Raises:
+        ValueError: If the pixel format is unknown.
+    """
+    widths = np.asarray(widths, dtype=np.int64)
+    heights = np.asarray(heights, dtype=np.int64)
+    if pixel_format == BGRA32:
+        return 4 * widths * heights
+    if pixel_format == BGR24:
+        return 3 * widths * heights
+    if pixel_format == RGB565:
+        return 2 * widths * heights
+    if pixel_format == YUV420:
+        chroma_widths, chroma_heights = chroma_size(widths, heights)
+        return widths * heights + 2 * chroma_widths * chroma_heights
+    raise ValueError(f"Unknown pixel format {pixel_format}")
+
+
+def _yuv420_planes(data, width, height):
+    """
+    Get the planes of a YUV420 tile: its luma plane followed by its two chroma planes.
+
+    Returns:
+        tuple: The (height, width) Y plane and the (chroma height, chroma width) U and V planes.
+    """
+    chroma_width, chroma_height = chroma_size(width, height)
+    luma_end = width * height
+    chroma_end = luma_end + chroma_width * chroma_height
+    return (data[:luma_end].reshape((height, width)),
+            data[luma_end:chroma_end].reshape((chroma_height, chroma_width)),
+            data[chroma_end:2 * chroma_end - luma_end].reshape((chroma_height, chroma_width)))
+
+
+def pack(pixel_format, pixels, widths, heights, out):
+    """
+    Convert BGRA tiles stored one after another to a pixel format. A YUV420 tile is a small I420
+    image: its luma plane followed by its two chroma planes, each one tile after another.
+
+    Args:
+        pixel_format (int): The pixel format.
+        pixels (np.ndarray): The uint32 pixels of the tiles, one tile after another.
+        widths (np.ndarray): The width of each tile.
+        heights (np.ndarray): The height of each tile.
+        out (np.ndarray): The uint8 array to write the packed tiles to, large enough to hold them.
+
+    Returns:
+        int: The number of bytes written.
+    """
+    count = len(pixels)
+    if not count:
+        return 0
+    bgra = pixels.view(np.uint8).reshape((1, count, 4))  # The pixels as one row, converted in one go
+    if pixel_format == BGRA32:
+        out[:4 * count] = pixels.view(np.uint8)
+        return 4 * count
+    if pixel_format == BGR24:
+        cv2.cvtColor(bgra, cv2.COLOR_BGRA2BGR, dst=out[:3 * count].reshape((1, count, 3)))
+        return 3 * count
+    if pixel_format == RGB565:
+        cv2.cvtColor(cv2.LUT(bgra, _RGB565_LEVELS), cv2.COLOR_BGRA2BGR565,
+                     dst=out[:2 * count].reshape((1, count, 2)))
+        return 2 * count
+    if pixel_format != YUV420:
+        raise ValueError(f"Unknown pixel format {pixel_format}")
+
+    sizes = packed_sizes(pixel_format, widths, heights)
+    pixel_offset = byte_offset = 0
+    for width, height, size in zip(np.asarray(widths).tolist(), np.asarray(heights).tolist(), sizes.tolist()):
+        tile = pixels[pixel_offset:pixel_offset + width * height].view(np.uint8).reshape((height, width, 4))
+        luma, chroma_u, chroma_v = _yuv420_planes(out[byte_offset:byte_offset + size], width, height)
+        cv2.cvtColor(tile, cv2.COLOR_BGRA2GRAY, dst=luma)  # BT.601 luma
+        # Average the 2x2 blocks before converting, blocks on the odd edges of a tile are smaller
+        block_means = cv2.resize(tile, chroma_u.shape[::-1], interpolation=cv2.INTER_AREA)
+        chroma = cv2.cvtColor(block_means.reshape(chroma_u.shape + (4,)), cv2.COLOR_BGR2YCrCb)
+        chroma_u[:] = chroma[..., 2]
+        chroma_v[:] = chroma[..., 1]
+        pixel_offset += width * height
+        byte_offset += size
+    return byte_offset
+
+
+def unpack(pixel_format, data, widths, heights, out):
+    """
+    Convert tiles in a pixel format back to BGRA, the inverse of pack(). The pixels are opaque.
+
+    The conversion of each format is exact, OpenCLHandler computes the same pixels.
+
+    Args:
+        pixel_format (int): The pixel format.
+        data (np.ndarray): The uint8 packed tiles.
+        widths (np.ndarray): The width of each tile.
+        heights (np.ndarray): The height of each tile.
+        out (np.ndarray): The uint32 array to write the pixels to, one tile after another.
+    """
+    count = len(out)
+    if not count:
+        return
+    if pixel_format == BGRA32:
+        out[:] = data[:4 * count].view(np.uint32)
+        return
+    if pixel_format == BGR24:
+        cv2.cvtColor(data[:3 * count].reshape((1, count, 3)), cv2.COLOR_BGR2BGRA,
+                     dst=out.view(np.uint8).reshape((1, count, 4)))
+        return
+    if pixel_format == RGB565:
+        out[:] = _RGB565_PIXELS[data[:2 * count].view('<u2')]
+        return
+    if pixel_format != YUV420:
+        raise ValueError(f"Unknown pixel format {pixel_format}")
+
+    sizes = packed_sizes(pixel_format, widths, heights)
+    pixel_offset = byte_offset = 0
+    for width, height, size in zip(np.asarray(widths).tolist(), np.asarray(heights).tolist(), sizes.tolist()):
+        luma, chroma_u, chroma_v = _yuv420_planes(data[byte_offset:byte_offset + size], width, height)
+        # Nearest neighbour upscaling repeats each chroma sample over its 2x2 block
+        chroma = [cv2.resize(plane, (width, height), interpolation=cv2.INTER_NEAREST)
+                  for plane in (chroma_v, chroma_u)]
+        tile = out[pixel_offset:pixel_offset + width * height].view(np.uint8).reshape((height, width, 4))
+        cv2.cvtColor(cv2.merge([luma] + chroma), cv2.COLOR_YCrCb2BGR, dst=tile, dstCn=4)
+        pixel_offset += width * height
+        byte_offset += size
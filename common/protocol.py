@@ -0,0 +1,302 @@
+import struct
+import time
+
+MAGIC = b'SSHR'
+VERSION = 4
+
+# Message types
+MSG_HELLO = 1  # Server -> client: the available streams and their resolutions, sent once after connecting
+MSG_FRAME = 2  # Server -> client: encoded keyframe or tile delta of one stream
+MSG_ACK = 3  # Client -> server: id and echoed timestamp of the last applied frame, see ACK_PAYLOAD
+MSG_SUBSCRIBE = 4  # Client -> server: the ids of the streams to receive, one byte each
+MSG_KEYFRAME_REQUEST = 5  # Client -> server: resynchronize the client with a keyframe of the stream in the header
+MSG_TILE_REQUEST = 6  # Client -> server: send tiles again that were lost in transit, see TILE_RANGE
+# Datagram messages of the UDP transport, see common.datagrams
+MSG_FRAGMENT = 7  # Server -> client: one fragment of a frame, or parity of its fragments
+MSG_REGISTER = 8  # Client -> server: the address to send the fragments to, with the client's token as frame id
+MSG_NACK = 9  # Client -> server: fragments of a frame to send again
+
+# Payload codecs
+CODEC_RAW = 0
+CODEC_LZ4 = 1  # LZ4 frame format
+CODEC_LZ4_BLOCK = 2  # Raw LZ4 block, can be decompressed into a preallocated buffer
+CODEC_LZ4_CHUNKS = 3  # Raw LZ4 blocks compressed in parallel, see compression.join_chunks
+CODEC_H264 = 4  # One H.264 access unit in Annex B format, lossy
+CODEC_VP8 = 5  # One VP8 frame, lossy
+CODEC_VP9 = 6  # One VP9 frame, lossy
+CODEC_ZSTD = 7  # zstd frame, compressed with the stream's compression.CompressionHistory as its dictionary
+
+# The codec id of each video codec name
+VIDEO_CODECS = {"h264": CODEC_H264, "vp8": CODEC_VP8, "vp9": CODEC_VP9}
+
+# Header flags
+FLAG_KEYFRAME = 0x01  # Of MSG_FRAME: the frame is a keyframe
+FLAG_NO_TILE_CACHE = 0x02  # Of MSG_SUBSCRIBE: send deltas without tile cache references, e.g. to a relay
+FLAG_DETACHED = 0x04  # Of MSG_FRAME: not appended to the compression history, e.g. one of two variants of a delta
+FLAG_RESETS_HISTORY = 0x08  # Of MSG_FRAME: the compression history starts over after the delta
+FLAG_DATAGRAMS = 0x10  # Of MSG_HELLO: frames can be received over UDP. Of MSG_SUBSCRIBE: send them over UDP
+FLAG_TILE_UNITS = 0x20  # Of MSG_FRAGMENT: the frame is split into tile deltas decoding on their own
+FLAG_COPIES = 0x40  # Of MSG_FRAGMENT: the first unit of the frame holds the copies of the tile delta
+
+# magic, version, message type, codec, flags, stream id, frame id, timestamp (us), width, height, payload length
+HEADER = struct.Struct('!4sBBBBBIQHHI')
+
+# decode time (us)
+ACK_PAYLOAD = struct.Struct('!I')
+ACK_INTERVAL = 0.05  # Seconds between acknowledgements sent by the client
+
+# first tile, last tile of each range of tiles in the tile request payload
+TILE_RANGE = struct.Struct('!II')
+
+# stream id, width, height, repeated for each stream in the hello payload
+STREAM_INFO = struct.Struct('!BHH')
+
+
+class ProtocolError(Exception):
+    """
+    Raised when the peer sends data that does not follow the protocol.
+    """
+
+
+class MessageHeader:
+    """
+    MessageHeader is the fixed-size header preceding every message.
+
+    Attributes:
+        msg_type (int): The message type.
+        codec (int): The codec of the payload.
+        flags (int): The message flags.
+        stream_id (int): The stream the message belongs to, e.g. one per captured monitor.
+        frame_id (int): The id of the frame the message belongs to, counted per stream.
+        timestamp (int): The capture time of the frame in microseconds since the epoch.
+        width (int): The width of the frame.
+        height (int): The height of the frame.
+        payload_length (int): The length of the payload following the header.
+    """
+
+    def __init__(self, msg_type, codec=CODEC_RAW, flags=0, frame_id=0, timestamp=0, width=0, height=0,
+                 payload_length=0, stream_id=0):
+        self.msg_type = msg_type
+        self.codec = codec
+        self.flags = flags
+        self.stream_id = stream_id
+        self.frame_id = frame_id
+        self.timestamp = timestamp
+        self.width = width
+        self.height = height
+        self.payload_length = payload_length
+
+    @property
+    def keyframe(self):
+        """
+        bool: Whether the message carries a keyframe.
+        """
+        return bool(self.flags & FLAG_KEYFRAME)
+
+    def pack(self):
+        """
+        Serialize the header.
+
+        Returns:
+            bytes: The packed header.
+        """
+        return HEADER.pack(MAGIC, VERSION, self.msg_type, self.codec, self.flags, self.stream_id, self.frame_id,
+                           self.timestamp, self.width, self.height, self.payload_length)
+
+    @classmethod
+    def unpack(cls, data):
+        """
+        Parse and validate a header.
+
+        Args:
+            data (bytes-like): At least HEADER.size bytes of data.
+
+        Returns:
+            MessageHeader: The parsed header.
+
+        Raises:
+            ProtocolError: If the magic or the version do not match.
+        """
+        (magic, version, msg_type, codec, flags, stream_id, frame_id, timestamp, width, height,
+         payload_length) = HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ProtocolError("Invalid message magic")
+        if version != VERSION:
+            raise ProtocolError(f"Unsupported protocol version {version}, expected {VERSION}")
+        return cls(msg_type, codec, flags, frame_id, timestamp, width, height, payload_length, stream_id)
+
+
+class Packet:
+    """
+    Packet is an encoded message ready to be sent, shared by all clients receiving it.
+
+    Attributes:
+        header (MessageHeader): The message header.
+        header_bytes (bytes): The packed message header.
+        payload (bytes-like): The message payload.
+    """
+
+    def __init__(self, header, payload=b''):
+        header.payload_length = len(payload)
+        self.header = header
+        self.header_bytes = header.pack()
+        self.payload = payload
+
+    @property
+    def keyframe(self):
+        """
+        bool: Whether the packet carries a keyframe.
+        """
+        return self.header.keyframe
+
+    def with_timestamp(self, timestamp):
+        """
+        Copy the packet with another timestamp, sharing the payload.
+
+        Args:
+            timestamp (int): The new timestamp.
+
+        Returns:
+            Packet: The copy.
+        """
+        header = self.header
+        return Packet(MessageHeader(header.msg_type, header.codec, header.flags, header.frame_id, timestamp,
+                                    header.width, header.height, stream_id=header.stream_id), self.payload)
+
+
+def hello_packet(streams, flags=0):
+    """
+    Build the hello message listing the available streams.
+
+    Args:
+        streams (dict): The width and height of each stream by stream id.
+        flags (int, optional): The hello flags, FLAG_DATAGRAMS if the server sends frames over UDP. Defaults to 0.
+
+    Returns:
+        Packet: The hello message. Its header carries the resolution of the first stream.
+    """
+    payload = b''.join(STREAM_INFO.pack(stream_id, width, height) for stream_id, (width, height) in streams.items())
+    first_width, first_height = next(iter(streams.values()))
+    return Packet(MessageHeader(MSG_HELLO, flags=flags, width=first_width, height=first_height), payload)
+
+
+def unpack_streams(payload):
+    """
+    Parse the streams listed by a hello message.
+
+    Args:
+        payload (bytes-like): The hello payload.
+
+    Returns:
+        dict: The width and height of each stream by stream id.
+
+    Raises:
+        ProtocolError: If the payload does not list any streams.
+    """
+    if not payload or len(payload) % STREAM_INFO.size:
+        raise ProtocolError("Invalid stream list")
+    streams = {}
+    for offset in range(0, len(payload), STREAM_INFO.size):
+        stream_id, width, height = STREAM_INFO.unpack_from(payload, offset)
+        streams[stream_id] = (width, height)
+    return streams
+
+
+def timestamp_now():
+    """
+    Get the current time in the unit used by message timestamps.
+
+    Returns:
+        int: The current time in microseconds since the epoch.
+    """
+    return time.time_ns() // 1000
+
+
+def send_message(sock, header_bytes, payload=b''):
+    """
+    Send a header and a payload without concatenating them.
+
+    Uses scatter-gather I/O where the platform supports it (sendmsg is missing on Windows).
+
+    Args:
+        sock (socket.socket): The socket to send the message through.
+        header_bytes (bytes): The packed message header.
+        payload (bytes-like, optional): The message payload. Defaults to b''.
+    """
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(header_bytes)
+        if len(payload):
+            sock.sendall(payload)
+        return
+
+    buffers = [memoryview(header_bytes).cast('B')]
+    if len(payload):
+        buffers.append(memoryview(payload).cast('B'))
+
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        # Drop the fully sent buffers and trim the partially sent one
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if sent:
+            buffers[0] = buffers[0][sent:]
+
+
+def recv_exact_into(sock, view):
+    """
+    Fill a buffer with data received from the socket.
+
+    Args:
+        sock (socket.socket): The socket to receive from.
+        view (memoryview): The buffer to fill.
+
+    Returns:
+        bool: True if the buffer was filled, False if the connection was closed.
+    """
+    size = len(view)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:], size - received)
+        if not count:
+            return False
+        received += count
+    return True
+
+
+def recv_exact(sock, size):
+    """
+    Receive exactly the given number of bytes.
+
+    Args:
+        sock (socket.socket): The socket to receive from.
+        size (int): The number of bytes to receive.
+
+    Returns:
+        bytearray: The received data, or None if the connection was closed.
+    """
+    data = bytearray(size)
+    if not recv_exact_into(sock, memoryview(data)):
+        return None
+    return data
+
+
+def recv_header(sock, buffer=None):
+    """
+    Receive and parse a message header.
+
+    Args:
+        sock (socket.socket): The socket to receive from.
+        buffer (bytearray, optional): A reusable buffer of HEADER.size bytes. Defaults to a new buffer.
+
+    Returns:
+        MessageHeader: The parsed header, or None if the connection was closed.
+
+    Raises:
+        ProtocolError: If the header is invalid.
+    """
+    if buffer is None:
+        buffer = bytearray(HEADER.size)
+    if not recv_exact_into(sock, memoryview(buffer)):
+        return None
+    return MessageHeader.unpack(buffer)
@@ -0,0 +1,331 @@
+import mmap
+import os
+
+import numpy as np
+
+from common import compression, protocol, tile_delta
+
+SEGMENT_SIZE = 256 * 1024 * 1024  # Bytes after which the recorder starts a new segment
+SEGMENT_NAME = "segment-{:06d}.rec"
+INDEX_NAME = "index.bin"
+
+# timestamp (us), offset in the segment, segment number, stream id of every recorded keyframe
+INDEX_DTYPE = np.dtype([('timestamp', '<u8'), ('offset', '<u8'), ('segment', '<u4'), ('stream_id', 'u1')])
+
+
+class RecordingWriter:
+    """
+    RecordingWriter appends encoded packets to a recording: a directory of segment files and a
+    keyframe index.
+
+    A segment holds messages in the wire format, starting with the hello message of the recorded
+    streams, so it can be read like a connection. The index holds an INDEX_DTYPE entry for every
+    keyframe, written after the keyframe itself is flushed, so it never points past the data. Both
+    are only appended to: a recording cut off by a crash is readable up to its last complete message.
+
+    Attributes:
+        path (str): The directory of the recording.
+        streams (dict): The width and height of each recorded stream by stream id.
+        segment_size (int): The bytes after which a new segment is started.
+        segment (int): The number of the segment being written.
+        segment_offset (int): The size of the segment being written.
+    """
+
+    def __init__(self, path, streams, segment_size=SEGMENT_SIZE):
+        """
+        Initializes the RecordingWriter, continuing a recording in the directory if it holds one.
+
+        Args:
+            path (str): The directory of the recording, created if it doesn't exist.
+            streams (dict): The width and height of each recorded stream by stream id.
+            segment_size (int, optional): The bytes after which a new segment is started. Defaults to SEGMENT_SIZE.
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.streams = streams
+        self.segment_size = segment_size
+        self.segment = len(_segment_paths(path))  # A new segment, the last one may end with a partial message
+        self.segment_file = None
+        self.segment_offset = 0
+        self.index_file = open(os.path.join(path, INDEX_NAME), 'ab')
+        self._open_segment()
+
+    def _open_segment(self):
+        """
+        Start the next segment with the hello message of the streams.
+        """
+        if self.segment_file is not None:
+            self.segment_file.close()
+            self.segment += 1
+        self.segment_file = open(os.path.join(self.path, SEGMENT_NAME.format(self.segment)), 'wb')
+        hello = protocol.hello_packet(self.streams)
+        self.segment_file.write(hello.header_bytes)
+        self.segment_file.write(hello.payload)
+        self.segment_offset = len(hello.header_bytes) + len(hello.payload)
+
+    def is_full(self):
+        """
+        Check whether the segment being written reached the segment size.
+
+        Returns:
+            bool: True if the next keyframes should go to a new segment.
+        """
+        return self.segment_offset >= self.segment_size
+
+    def next_segment(self):
+        """
+        Continue in a new segment. Every stream must continue with a keyframe, so segments can be
+        played back on their own.
+        """
+        self._open_segment()
+
+    def write(self, packet):
+        """
+        Append a packet to the segment being written.
+
+        Args:
+            packet (Packet): The encoded packet.
+        """
+        offset = self.segment_offset
+        self.segment_file.write(packet.header_bytes)
+        self.segment_file.write(packet.payload)
+        self.segment_offset += len(packet.header_bytes) + len(packet.payload)
+        if packet.keyframe:
+            self.segment_file.flush()
+            entry = np.array([(packet.header.timestamp, offset, self.segment, packet.header.stream_id)],
+                             dtype=INDEX_DTYPE)
+            self.index_file.write(entry.tobytes())
+            self.index_file.flush()
+
+    def flush(self):
+        """
+        Write buffered packets to the files.
+        """
+        self.segment_file.flush()
+        self.index_file.flush()
+
+    def close(self):
+        """
+        Flush and close the recording.
+        """
+        self.segment_file.close()
+        self.index_file.close()
+
+
+class RecordingReader:
+    """
+    RecordingReader plays back a recording made by RecordingWriter. The segments are memory-mapped,
+    so packets are read straight from the page cache without copies, and the keyframe index makes
+    seeking to a timestamp start at the nearest keyframe before it.
+
+    Attributes:
+        path (str): The directory of the recording.
+        streams (dict): The width and height of each recorded stream by stream id.
+        index (np.ndarray): The INDEX_DTYPE entries of the recorded keyframes, in recording order.
+        segments (list): The memory-mapped segments, None until first read.
+    """
+
+    def __init__(self, path):
+        """
+        Initializes the RecordingReader with the recording in the given directory.
+
+        Args:
+            path (str): The directory of the recording.
+
+        Raises:
+            ValueError: If the directory holds no recording.
+        """
+        self.path = path
+        self.segment_paths = _segment_paths(path)
+        if not self.segment_paths:
+            raise ValueError(f"{path} holds no recording")
+        index = np.fromfile(os.path.join(path, INDEX_NAME), dtype=np.uint8)
+        self.index = index[:len(index) - len(index) % INDEX_DTYPE.itemsize].view(INDEX_DTYPE)
+        self.segments = [None] * len(self.segment_paths)
+        self.streams = self._read_hello(0)
+
+    def _segment(self, number):
+        """
+        Get a memory-mapped segment.
+
+        Args:
+            number (int): The segment number.
+
+        Returns:
+            memoryview: The segment, empty if its file is.
+        """
+        if self.segments[number] is None:
+            with open(self.segment_paths[number], 'rb') as file:  # The mapping stays valid after closing the file
+                if os.fstat(file.fileno()).st_size:
+                    self.segments[number] = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    self.segments[number] = b''
+        return memoryview(self.segments[number])
+
+    def _read_hello(self, number):
+        """
+        Read the streams announced at the start of a segment.
+
+        Raises:
+            ValueError: If the segment doesn't start with a hello message.
+        """
+        header, payload, _ = _read_message(self._segment(number), 0)
+        if header is None or header.msg_type != protocol.MSG_HELLO:
+            raise ValueError(f"{self.segment_paths[number]} doesn't start with a hello message")
+        return protocol.unpack_streams(payload)
+
+    def keyframes(self, stream_id):
+        """
+        Get the index entries of the keyframes of a stream.
+
+        Args:
+            stream_id (int): The stream id.
+
+        Returns:
+            np.ndarray: The INDEX_DTYPE entries, in recording order.
+        """
+        return self.index[self.index['stream_id'] == stream_id]
+
+    def seek(self, timestamp, stream_id=0):
+        """
+        Find the keyframe of a stream to start playing back from, to show the frame at a timestamp.
+
+        Args:
+            timestamp (int): The timestamp in microseconds since the epoch.
+            stream_id (int, optional): The stream id. Defaults to 0.
+
+        Returns:
+            tuple: The segment number and offset of the last keyframe at or before the timestamp, or of the
+                first keyframe if the timestamp is before the recording.
+
+        Raises:
+            ValueError: If the stream has no keyframes.
+        """
+        keyframes = self.keyframes(stream_id)
+        if not len(keyframes):
+            raise ValueError(f"Stream {stream_id} has no keyframes")
+        # Appended in recording order, so the timestamps are sorted
+        position = max(int(np.searchsorted(keyframes['timestamp'], timestamp, side='right')) - 1, 0)
+        return int(keyframes['segment'][position]), int(keyframes['offset'][position])
+
+    def packets(self, stream_id=None, start=None):
+        """
+        Iterate over the recorded packets, across segments.
+
+        The payloads are views of the memory-mapped segments, valid until the reader is closed.
+
+        Args:
+            stream_id (int, optional): The stream to play back, or None for all streams. Defaults to None.
+            start (tuple, optional): The segment number and offset to start at, see seek(). Defaults to the
+                start of the recording.
+
+        Yields:
+            tuple: The MessageHeader and the payload of each frame message.
+        """
+        number, offset = start if start is not None else (0, 0)
+        for number in range(number, len(self.segment_paths)):
+            segment = self._segment(number)
+            while True:
+                header, payload, offset = _read_message(segment, offset)
+                if header is None:
+                    break  # The end of the segment, or a message cut off when recording stopped
+                if header.msg_type == protocol.MSG_FRAME and (stream_id is None or header.stream_id == stream_id):
+                    yield header, payload
+            offset = 0
+
+    def frame_at(self, timestamp, stream_id=0):
+        """
+        Reconstruct the frame of a stream shown at a timestamp, decoding from the nearest keyframe before it.
+
+        Args:
+            timestamp (int): The timestamp in microseconds since the epoch.
+            stream_id (int, optional): The stream id. Defaults to 0.
+
+        Returns:
+            tuple: The MessageHeader of the last applied packet and the frame as a (height, width) uint32 array.
+
+        Raises:
+            ValueError: If the stream was recorded in video mode around the timestamp, which needs a video decoder.
+        """
+        stream_width, stream_height = self.streams[stream_id]
+        frame_buffer = bytearray(tile_delta.max_encoded_size(stream_width, stream_height))
+        frame = last_header = None
+        history = compression.CompressionHistory()
+        for header, payload in self.packets(stream_id, self.seek(timestamp, stream_id)):
+            if last_header is not None and header.timestamp > timestamp:
+                break
+            if header.codec in protocol.VIDEO_CODECS.values():
+                raise ValueError("Frames recorded in video mode need a video decoder")
+            data = _decompress(header, payload, frame_buffer, history)
+            history.update(header, data)
+            delta = tile_delta.decode(data, header.width, header.height)
+            if delta.keyframe:
+                frame = tile_delta.unpack_pixels(delta, np.empty(header.width * header.height, dtype=np.uint32))
+                frame = frame.reshape((header.height, header.width))
+            elif frame is not None:
+                tile_delta.apply_copies(frame, delta.copies)
+                tile_delta.unpack_tiles(frame, delta)
+            last_header = header
+        return last_header, frame
+
+    def close(self):
+        """
+        Unmap the segments. Segments with payloads still referenced are unmapped once those are released.
+        """
+        for segment in self.segments:
+            if isinstance(segment, mmap.mmap):
+                try:
+                    segment.close()
+                except BufferError:
+                    pass  # Exported payload views keep the mapping alive
+        self.segments = [None] * len(self.segment_paths)
+
+
+def _segment_paths(path):
+    """
+    List the segment files of a recording in order.
+    """
+    names = sorted(name for name in os.listdir(path) if name.startswith("segment-") and name.endswith(".rec"))
+    return [os.path.join(path, name) for name in names]
+
+
+def _read_message(segment, offset):
+    """
+    Read the message at an offset of a segment.
+
+    Returns:
+        tuple: The header, the payload and the offset of the next message, or None for the header at the end.
+    """
+    if offset + protocol.HEADER.size > len(segment):
+        return None, None, offset
+    try:
+        header = protocol.MessageHeader.unpack(segment[offset:offset + protocol.HEADER.size])
+    except protocol.ProtocolError:
+        return None, None, offset
+    start = offset + protocol.HEADER.size
+    end = start + header.payload_length
+    if end > len(segment):
+        return None, None, offset
+    return header, segment[start:end], end
+
+
+def _decompress(header, payload, frame_buffer, history):
+    """
+    Decompress the payload of a recorded packet, with the compression history of the packets before it.
+
+    Returns:
+        bytes-like: The encoded keyframe or tile delta.
+    """
+    if header.codec == protocol.CODEC_RAW:
+        return payload
+    source = bytearray(payload)  # Decompressing needs a writable source, the segments are mapped read-only
+    if header.codec == protocol.CODEC_LZ4_BLOCK:
+        length = compression.decompress_into(source, len(source), frame_buffer)
+    elif header.codec == protocol.CODEC_LZ4_CHUNKS:
+        length = compression.decompress_chunks_into(source, len(source), frame_buffer)
+    elif header.codec == protocol.CODEC_ZSTD:
+        length = compression.decompress_zstd_into(source, len(source), frame_buffer,
+                                                  None if header.keyframe else history)
+    else:
+        raise ValueError(f"Unsupported codec {header.codec}")
+    return memoryview(frame_buffer)[:length]
@@ -0,0 +1,597 @@
+import struct
+import numpy as np
+
+from common import pixel_formats
+
+TILE_SIZE = 64  # Default tile edge length in pixels
+
+FLAG_KEYFRAME = 0x01
+FLAG_TILE_CACHE = 0x02  # The delta takes tiles from the client's tile cache and stores tiles in it
+PIXEL_FORMAT_SHIFT = 4  # The pixel format of the tile pixels is stored in the upper bits of the flags
+
+# flags, copy count, tile size, tile count
+_HEADER = struct.Struct('<BBHI')
+# cached tile count, following the header of deltas using the tile cache
+_CACHE_HEADER = struct.Struct('<I')
+
+TILE_CACHE_SIZE = 16 * 1024 * 1024  # Bytes of tile pixels a client caches, 1024 tiles of the default size
+NO_SLOT = 0xFFFFFFFF  # The cache slot of tiles that are not stored in the tile cache
+
+# source x, source y, destination x, destination y, width, height of each copy, following the header
+COPY_FIELDS = 6
+MAX_COPIES = 255
+
+
+class TileDelta:
+    """
+    TileDelta is a decoded frame update: either a full keyframe or the pixels of the dirty tiles.
+    A tile delta may start with copies of rectangles within the frame, e.g. of scrolled content,
+    which are applied before the tiles. Next come the tiles taken from the client's tile cache,
+    then the tiles sent with their pixels, which may be stored in the tile cache afterwards.
+
+    The pixel arrays are views into the buffer the delta was decoded from, so they are only
+    valid as long as that buffer is not reused. In the compact pixel formats they hold the packed
+    bytes, see unpack_pixels().
+
+    Attributes:
+        keyframe (bool): Whether the update is a full frame.
+        tile_size (int): The tile edge length in pixels.
+        indices (np.ndarray): The indices of the dirty tiles in row-major tile order.
+        offsets (np.ndarray): The offset of each tile's pixels in the pixel array, in bytes in the compact formats.
+        pixels (np.ndarray): The full frame for keyframes, otherwise the tile pixels one tile after another,
+            as uint32 BGRA pixels or as uint8 bytes in a compact pixel format.
+        frame_width (int): The width of the frame the update applies to.
+        frame_height (int): The height of the frame the update applies to.
+        copies (np.ndarray): The (count, COPY_FIELDS) rectangles to copy before applying the tiles.
+        pixel_format (int): The pixel format of the pixels, see pixel_formats.
+        cached_indices (np.ndarray): The indices of the tiles taken from the tile cache.
+        cached_slots (np.ndarray): The tile cache slot of each of those tiles.
+        stored_slots (np.ndarray): The tile cache slot each tile sent with its pixels is stored in, NO_SLOT for
+            tiles not stored, or None if the delta does not use the tile cache.
+    """
+
+    def __init__(self, keyframe, tile_size, indices, offsets, pixels, frame_width, frame_height, copies=None,
+                 pixel_format=pixel_formats.BGRA32, cached_indices=None, cached_slots=None, stored_slots=None):
+        self.keyframe = keyframe
+        self.tile_size = tile_size
+        self.indices = indices
+        self.offsets = offsets
+        self.pixels = pixels
+        self.frame_width = frame_width
+        self.frame_height = frame_height
+        self.copies = copies if copies is not None else np.zeros((0, COPY_FIELDS), dtype=np.uint32)
+        self.pixel_format = pixel_format
+        self.cached_indices = cached_indices if cached_indices is not None else np.zeros(0, dtype=np.uint32)
+        self.cached_slots = cached_slots if cached_slots is not None else np.zeros(0, dtype=np.uint32)
+        self.stored_slots = stored_slots
+
+
+def tile_grid(frame_width, frame_height, tile_size=TILE_SIZE):
+    """
+    Calculate the number of tile columns and rows covering a frame.
+
+    Args:
+        frame_width (int): The width of the frame.
+        frame_height (int): The height of the frame.
+        tile_size (int, optional): The tile edge length. Defaults to TILE_SIZE.
+
+    Returns:
+        tuple: The number of tile columns and rows.
+    """
+    return -(-frame_width // tile_size), -(-frame_height // tile_size)
+
+
+def tile_cache_slots(tile_size=TILE_SIZE):
+    """
+    Calculate the number of tiles the tile cache of a client holds.
+
+    Args:
+        tile_size (int, optional): The tile edge length. Defaults to TILE_SIZE.
+
+    Returns:
+        int: The number of cache slots.
+    """
+    return TILE_CACHE_SIZE // (4 * tile_size * tile_size)
+
+
+def allocate_tile_cache(tile_size=TILE_SIZE):
+    """
+    Allocate the tile cache of a client.
+
+    Args:
+        tile_size (int, optional): The tile edge length. Defaults to TILE_SIZE.
+
+    Returns:
+        np.ndarray: The (tile_cache_slots(), tile_size * tile_size) uint32 cached tiles.
+    """
+    return np.zeros((tile_cache_slots(tile_size), tile_size * tile_size), dtype=np.uint32)
+
+
+def max_encoded_size(frame_width, frame_height, tile_size=TILE_SIZE):
+    """
+    Calculate the largest possible size of an encoded keyframe or tile delta.
+
+    Args:
+        frame_width (int): The width of the frame.
+        frame_height (int): The height of the frame.
+        tile_size (int, optional): The tile edge length. Defaults to TILE_SIZE.
+
+    Returns:
+        int: The size in bytes.
+    """
+    tiles_x, tiles_y = tile_grid(frame_width, frame_height, tile_size)
+    # Tiles taken from the tile cache take less space than tiles sent and stored in it
+    return tile_header_size(tiles_x * tiles_y, MAX_COPIES, cached_count=0) + 4 * frame_width * frame_height
+
+
+def tile_header_size(tile_count, copy_count=0, cached_count=None):
+    """
+    Calculate the size of the part of a tile delta preceding the tile pixels.
+
+    Args:
+        tile_count (int): The number of dirty tiles sent with their pixels.
+        copy_count (int, optional): The number of copies. Defaults to 0.
+        cached_count (int, optional): The number of tiles taken from the tile cache, or None if the delta
+            does not use the tile cache. Defaults to None.
+
+    Returns:
+        int: The size in bytes.
+    """
+    size = _HEADER.size + 4 * COPY_FIELDS * copy_count + 4 * tile_count
+    if cached_count is not None:
+        size += _CACHE_HEADER.size + 8 * cached_count + 4 * tile_count  # Plus the cached tiles and stored slots
+    return size
+
+
+def tile_geometry(indices, frame_width, frame_height, tile_size=TILE_SIZE):
+    """
+    Calculate the position, size and data offset of each tile. Tiles on the right and bottom
+    edges are cropped to the frame.
+
+    Args:
+        indices (np.ndarray): The tile indices.
+        frame_width (int): The width of the frame.
+        frame_height (int): The height of the frame.
+        tile_size (int, optional): The tile edge length. Defaults to TILE_SIZE.
+
+    Returns:
+        tuple: Arrays of tile x, y, width, height and the offset of each tile's pixels.
+    """
+    tiles_x, _ = tile_grid(frame_width, frame_height, tile_size)
+    tile_y, tile_x = np.divmod(indices.astype(np.int64), tiles_x)
+    x = tile_x * tile_size
+    y = tile_y * tile_size
+    widths = np.minimum(tile_size, frame_width - x)
+    heights = np.minimum(tile_size, frame_height - y)
+    sizes = widths * heights
+    offsets = np.zeros_like(sizes)
+    np.cumsum(sizes[:-1], out=offsets[1:])
+    return x, y, widths, heights, offsets
+
+
+def find_dirty_tiles(old_frame, new_frame, tile_size=TILE_SIZE):
+    """
+    Find the tiles that differ between two frames.
+
+    Args:
+        old_frame (np.ndarray): The previous frame of shape (height, width).
+        new_frame (np.ndarray): The current frame of shape (height, width).
+        tile_size (int, optional): The tile edge length. Defaults to TILE_SIZE.
+
+    Returns:
+        np.ndarray: The indices of the dirty tiles.
+    """
+    frame_height, frame_width = old_frame.shape
+    changed = old_frame != new_frame
+    # Collapse the per-pixel mask into one flag per tile: first over tile rows, then over tile columns
+    changed_rows = np.logical_or.reduceat(changed, np.arange(0, frame_height, tile_size), axis=0)
+    changed_tiles = np.logical_or.reduceat(changed_rows, np.arange(0, frame_width, tile_size), axis=1)
+    return np.flatnonzero(changed_tiles).astype(np.uint32)
+
+
+def region_tile_bounds(region, frame_width, frame_height, tile_size=TILE_SIZE):
+    """
+    Calculate the range of tiles covering a rectangle.
+
+    Args:
+        region (tuple): The (x, y, width, height) rectangle.
+        frame_width (int): The width of the frame.
+        frame_height (int): The height of the frame.
+        tile_size (int, optional): The tile edge length. Defaults to TILE_SIZE.
+
+    Returns:
+        tuple: The first tile column, first tile row, and the column and row after the last, clipped to the frame.
+    """
+    tiles_x, tiles_y = tile_grid(frame_width, frame_height, tile_size)
+    x, y, width, height = region
+    return (max(x // tile_size, 0), max(y // tile_size, 0),
+            min(-(-(x + width) // tile_size), tiles_x), min(-(-(y + height) // tile_size), tiles_y))
+
+
+def find_dirty_tiles_in_regions(old_frame, new_frame, regions, tile_size=TILE_SIZE):
+    """
+    Find the tiles that differ between two frames, only looking at the tiles covering the given
+    rectangles. The caller guarantees that nothing changed outside of them.
+
+    Args:
+        old_frame (np.ndarray): The previous frame of shape (height, width).
+        new_frame (np.ndarray): The current frame of shape (height, width).
+        regions (list): The (x, y, width, height) rectangles that may have changed.
+        tile_size (int, optional): The tile edge length. Defaults to TILE_SIZE.
+
+    Returns:
+        np.ndarray: The sorted indices of the dirty tiles.
+    """
+    frame_height, frame_width = old_frame.shape
+    tiles_x, _ = tile_grid(frame_width, frame_height, tile_size)
+    dirty_tiles = []
+    for region in regions:
+        left, top, right, bottom = region_tile_bounds(region, frame_width, frame_height, tile_size)
+        if left >= right or top >= bottom:
+            continue
+        block = (slice(top * tile_size, bottom * tile_size), slice(left * tile_size, right * tile_size))
+        local_tiles = find_dirty_tiles(old_frame[block], new_frame[block], tile_size)
+        tile_y, tile_x = np.divmod(local_tiles, right - left)
+        dirty_tiles.append((tile_y + top) * tiles_x + tile_x + left)
+    if not dirty_tiles:
+        return np.zeros(0, dtype=np.uint32)
+    return np.unique(np.concatenate(dirty_tiles)).astype(np.uint32)  # Overlapping regions find tiles twice
+
+
+def encode_keyframe(frame, tile_size=TILE_SIZE, pixel_format=pixel_formats.BGRA32):
+    """
+    Encode a full frame.
+
+    Args:
+        frame (np.ndarray): The frame of shape (height, width).
+        tile_size (int, optional): The tile size used by the following deltas. Defaults to TILE_SIZE.
+        pixel_format (int, optional): The pixel format of the encoded pixels. Defaults to BGRA32.
+
+    Returns:
+        bytearray: The encoded keyframe.
+    """
+    frame_height, frame_width = frame.shape
+    flags = FLAG_KEYFRAME | pixel_format << PIXEL_FORMAT_SHIFT
+    if pixel_format == pixel_formats.BGRA32:
+        payload = bytearray(_HEADER.size + frame.nbytes)
+        _HEADER.pack_into(payload, 0, flags, 0, tile_size, 0)
+        np.frombuffer(payload, dtype=np.uint32, offset=_HEADER.size).reshape(frame.shape)[:] = frame
+        return payload
+
+    # The whole frame is packed like a single tile
+    payload = bytearray(_HEADER.size + int(pixel_formats.packed_sizes(pixel_format, frame_width, frame_height)))
+    _HEADER.pack_into(payload, 0, flags, 0, tile_size, 0)
+    pixel_formats.pack(pixel_format, np.ascontiguousarray(frame).reshape(-1), [frame_width], [frame_height],
+                       np.frombuffer(payload, dtype=np.uint8, offset=_HEADER.size))
+    return payload
+
+
+def encode_tile_header(indices, tile_size=TILE_SIZE, copies=(), pixel_format=pixel_formats.BGRA32):
+    """
+    Encode the part of a tile delta preceding the tile pixels.
+
+    Args:
+        indices (np.ndarray): The indices of the dirty tiles.
+        tile_size (int, optional): The tile edge length. Defaults to TILE_SIZE.
+        copies (list, optional): The (source x, source y, destination x, destination y, width, height)
+            rectangles the client copies before applying the tiles. Defaults to none.
+        pixel_format (int, optional): The pixel format of the tile pixels. Defaults to BGRA32.
+
+    Returns:
+        bytearray: The encoded header, copies and tile indices.
+    """
+    header = bytearray(tile_header_size(len(indices), len(copies)))
+    _write_tile_header(header, indices, tile_size, copies, pixel_format)
+    return header
+
+
+def _write_tile_header(payload, indices, tile_size, copies, pixel_format, stored_slots=None, cached_indices=(),
+                       cached_slots=()):
+    """
+    Write the delta header, the copies, the cached tiles, the tile indices and the slots they are
+    stored in to the start of a payload buffer.
+    """
+    if len(copies) > MAX_COPIES:
+        raise ValueError(f"At most {MAX_COPIES} copies fit a tile delta")
+    flags = pixel_format << PIXEL_FORMAT_SHIFT
+    offset = _HEADER.size
+    if stored_slots is not None:
+        flags |= FLAG_TILE_CACHE
+        _CACHE_HEADER.pack_into(payload, offset, len(cached_indices))
+        offset += _CACHE_HEADER.size
+    _HEADER.pack_into(payload, 0, flags, len(copies), tile_size, len(indices))
+    sections = [np.asarray(copies, dtype=np.uint32).reshape(-1)]
+    if stored_slots is not None:
+        sections += [cached_indices, cached_slots]
+    sections.append(indices)
+    if stored_slots is not None:
+        sections.append(stored_slots)
+    for values in sections:
+        np.frombuffer(payload, dtype=np.uint32, count=len(values), offset=offset)[:] = values
+        offset += 4 * len(values)
+
+
+def apply_copies(frame, copies):
+    """
+    Copy rectangles within a frame, one after another. A copy may overlap its source.
+
+    Args:
+        frame (np.ndarray): The frame of shape (height, width) to update in place.
+        copies (iterable): The (source x, source y, destination x, destination y, width, height) rectangles.
+    """
+    copies = np.asarray(copies, dtype=np.int64).reshape((-1, COPY_FIELDS))
+    for source_x, source_y, x, y, width, height in copies.tolist():
+        # NumPy buffers overlapping assignments, so scrolling within the frame is safe
+        frame[y:y + height, x:x + width] = frame[source_y:source_y + height, source_x:source_x + width]
+
+
+def pack_tiles(frame, indices, pixels, tile_size=TILE_SIZE):
+    """
+    Copy the pixels of the given tiles one tile after another.
+
+    Args:
+        frame (np.ndarray): The frame of shape (height, width).
+        indices (np.ndarray): The indices of the tiles to copy.
+        pixels (np.ndarray): The uint32 array to copy the pixels to, large enough to hold them.
+        tile_size (int, optional): The tile edge length. Defaults to TILE_SIZE.
+
+    Returns:
+        int: The number of pixels copied.
+    """
+    if not len(indices):
+        return 0
+
+    frame_height, frame_width = frame.shape
+    x, y, widths, heights, offsets = tile_geometry(indices, frame_width, frame_height, tile_size)
+    for i in range(len(indices)):
+        tile_x, tile_y, tile_w, tile_h = int(x[i]), int(y[i]), int(widths[i]), int(heights[i])
+        offset = int(offsets[i])
+        pixels[offset:offset + tile_w * tile_h].reshape((tile_h, tile_w))[:] = \
+            frame[tile_y:tile_y + tile_h, tile_x:tile_x + tile_w]
+    return int(offsets[-1] + widths[-1] * heights[-1])
+
+
+def unpack_pixels(delta, out=None):
+    """
+    Get the pixels of a keyframe or tile delta as BGRA, converting them from a compact pixel format.
+
+    Args:
+        delta (TileDelta): The decoded keyframe or tile delta.
+        out (np.ndarray, optional): The uint32 array to write the pixels to, or None to return the delta's
+            BGRA32 pixels as they are or a new array. Defaults to None.
+
+    Returns:
+        np.ndarray: The full frame for keyframes, otherwise the tile pixels one tile after another.
+    """
+    if delta.pixel_format == pixel_formats.BGRA32:
+        if out is None:
+            return delta.pixels
+        np.copyto(out, delta.pixels)
+        return out
+    if delta.keyframe:
+        widths, heights = np.array([delta.frame_width]), np.array([delta.frame_height])
+    else:
+        _, _, widths, heights, _ = tile_geometry(delta.indices, delta.frame_width, delta.frame_height,
+                                                 delta.tile_size)
+    if out is None:
+        out = np.empty(int((widths * heights).sum()), dtype=np.uint32)
+    pixel_formats.unpack(delta.pixel_format, delta.pixels, widths, heights, out)
+    return out
+
+
+def unpack_tiles(frame, delta):
+    """
+    Copy the pixels of a tile delta into a frame, the inverse of pack_tiles.
+
+    Args:
+        frame (np.ndarray): The frame of shape (height, width) to update in place.
+        delta (TileDelta): The decoded tile delta.
+    """
+    frame_height, frame_width = frame.shape
+    x, y, widths, heights, offsets = tile_geometry(delta.indices, frame_width, frame_height, delta.tile_size)
+    pixels = unpack_pixels(delta)
+    for i in range(len(delta.indices)):
+        tile_x, tile_y, tile_w, tile_h = int(x[i]), int(y[i]), int(widths[i]), int(heights[i])
+        offset = int(offsets[i])
+        frame[tile_y:tile_y + tile_h, tile_x:tile_x + tile_w] = \
+            pixels[offset:offset + tile_w * tile_h].reshape((tile_h, tile_w))
+
+
+def _copy_cached_tiles(frame, tile_cache, indices, slots, tile_size, store):
+    """
+    Copy tiles between a frame and a tile cache, in either direction. Tiles with NO_SLOT are skipped.
+    """
+    frame_height, frame_width = frame.shape
+    x, y, widths, heights, _ = tile_geometry(indices, frame_width, frame_height, tile_size)
+    for i, slot in enumerate(slots.tolist()):
+        if slot == NO_SLOT:
+            continue
+        tile_x, tile_y, tile_w, tile_h = int(x[i]), int(y[i]), int(widths[i]), int(heights[i])
+        cached = tile_cache[slot, :tile_w * tile_h].reshape((tile_h, tile_w))
+        if store:
+            cached[:] = frame[tile_y:tile_y + tile_h, tile_x:tile_x + tile_w]
+        else:
+            frame[tile_y:tile_y + tile_h, tile_x:tile_x + tile_w] = cached
+
+
+def apply_cached_tiles(frame, delta, tile_cache):
+    """
+    Copy the tiles a tile delta takes from the tile cache into a frame. Applied after the copies
+    and before the tiles sent with their pixels.
+
+    Args:
+        frame (np.ndarray): The frame of shape (height, width) to update in place.
+        delta (TileDelta): The decoded tile delta.
+        tile_cache (np.ndarray): The (tile_cache_slots(), tile_size * tile_size) uint32 cached tiles.
+    """
+    _copy_cached_tiles(frame, tile_cache, delta.cached_indices, delta.cached_slots, delta.tile_size, False)
+
+
+def store_cached_tiles(frame, delta, tile_cache):
+    """
+    Store the tiles of a tile delta in the tile cache, from a frame the delta was applied to.
+
+    Args:
+        frame (np.ndarray): The frame of shape (height, width) the delta was applied to.
+        delta (TileDelta): The decoded tile delta.
+        tile_cache (np.ndarray): The (tile_cache_slots(), tile_size * tile_size) uint32 cached tiles.
+    """
+    if delta.stored_slots is not None:
+        _copy_cached_tiles(frame, tile_cache, delta.indices, delta.stored_slots, delta.tile_size, True)
+
+
+def encode_tiles(frame, indices, tile_size=TILE_SIZE, copies=(), pixel_format=pixel_formats.BGRA32,
+                 stored_slots=None, cached_indices=(), cached_slots=()):
+    """
+    Encode the given tiles of a frame.
+
+    Args:
+        frame (np.ndarray): The frame of shape (height, width).
+        indices (np.ndarray): The indices of the tiles to encode.
+        tile_size (int, optional): The tile edge length. Defaults to TILE_SIZE.
+        copies (list, optional): The (source x, source y, destination x, destination y, width, height)
+            rectangles the client copies before applying the tiles. Defaults to none.
+        pixel_format (int, optional): The pixel format of the encoded pixels. Defaults to BGRA32.
+        stored_slots (np.ndarray, optional): The tile cache slot each tile is stored in, NO_SLOT to not store it,
+            or None to not use the tile cache. Defaults to None.
+        cached_indices (np.ndarray, optional): The indices of the tiles the client takes from its tile cache.
+            Defaults to none.
+        cached_slots (np.ndarray, optional): The tile cache slot of each of those tiles. Defaults to none.
+
+    Returns:
+        bytearray: The encoded copies and tiles.
+    """
+    frame_height, frame_width = frame.shape
+    _, _, widths, heights, _ = tile_geometry(indices, frame_width, frame_height, tile_size)
+    pixel_count = int((widths * heights).sum())
+
+    cache = (stored_slots, cached_indices, cached_slots)
+    header_size = tile_header_size(len(indices), len(copies), len(cached_indices) if stored_slots is not None else None)
+    if pixel_format == pixel_formats.BGRA32:
+        payload = bytearray(header_size + 4 * pixel_count)
+        _write_tile_header(payload, indices, tile_size, copies, pixel_format, *cache)
+        pack_tiles(frame, indices, np.frombuffer(payload, dtype=np.uint32, offset=header_size), tile_size)
+        return payload
+
+    # Gathered as BGRA first, then converted all at once
+    pixels = np.empty(pixel_count, dtype=np.uint32)
+    pack_tiles(frame, indices, pixels, tile_size)
+    payload = bytearray(header_size + int(pixel_formats.packed_sizes(pixel_format, widths, heights).sum()))
+    _write_tile_header(payload, indices, tile_size, copies, pixel_format, *cache)
+    pixel_formats.pack(pixel_format, pixels, widths, heights,
+                       np.frombuffer(payload, dtype=np.uint8, offset=header_size))
+    return payload
+
+
+def decode(payload, frame_width, frame_height):
+    """
+    Decode and validate a keyframe or tile delta without copying the pixel data.
+
+    Args:
+        payload (bytes-like): The encoded update.
+        frame_width (int): The width of the frame the update applies to.
+        frame_height (int): The height of the frame the update applies to.
+
+    Returns:
+        TileDelta: The decoded update.
+
+    Raises:
+        ValueError: If the update does not fit the frame.
+    """
+    if len(payload) < _HEADER.size:
+        raise ValueError("Truncated tile delta")
+    flags, copy_count, tile_size, tile_count = _HEADER.unpack_from(payload, 0)
+    if tile_size == 0:
+        raise ValueError("Invalid tile size")
+    pixel_format = flags >> PIXEL_FORMAT_SHIFT
+    if pixel_format not in pixel_formats.PIXEL_FORMATS.values():
+        raise ValueError("Unknown pixel format")
+
+    tiles_x, tiles_y = tile_grid(frame_width, frame_height, tile_size)
+    uses_tile_cache = bool(flags & FLAG_TILE_CACHE)
+    cached_count = None
+    if uses_tile_cache:
+        if flags & FLAG_KEYFRAME or len(payload) < _HEADER.size + _CACHE_HEADER.size:
+            raise ValueError("Invalid tile cache section")
+        cached_count, = _CACHE_HEADER.unpack_from(payload, _HEADER.size)
+    header_size = tile_header_size(tile_count, copy_count, cached_count)
+    if header_size > len(payload) or tile_count + (cached_count or 0) > tiles_x * tiles_y:
+        raise ValueError("Invalid tile count")
+
+    offset = _HEADER.size + (_CACHE_HEADER.size if uses_tile_cache else 0)
+    copies = np.frombuffer(payload, dtype=np.uint32, count=COPY_FIELDS * copy_count,
+                           offset=offset).reshape((copy_count, COPY_FIELDS))
+    offset += copies.nbytes
+    if copy_count:
+        source_x, source_y, x, y, width, height = copies.astype(np.int64).T
+        if (np.any(np.maximum(source_x, x) + width > frame_width) or
+                np.any(np.maximum(source_y, y) + height > frame_height)):
+            raise ValueError("Copy out of range")
+    cached_indices = cached_slots = stored_slots = None
+    if uses_tile_cache:
+        cached = np.frombuffer(payload, dtype=np.uint32, count=2 * cached_count, offset=offset)
+        cached_indices, cached_slots = cached.reshape((2, cached_count))
+        offset += cached.nbytes
+    indices = np.frombuffer(payload, dtype=np.uint32, count=tile_count, offset=offset)
+    if uses_tile_cache:
+        stored_slots = np.frombuffer(payload, dtype=np.uint32, count=tile_count, offset=offset + indices.nbytes)
+        slot_count = tile_cache_slots(tile_size)
+        if cached_count and (int(cached_indices.max()) >= tiles_x * tiles_y or int(cached_slots.max()) >= slot_count):
+            raise ValueError("Cached tile out of range")
+        if tile_count and np.any((stored_slots >= slot_count) & (stored_slots != NO_SLOT)):
+            raise ValueError("Tile cache slot out of range")
+
+    if flags & FLAG_KEYFRAME:
+        widths, heights = np.array([frame_width]), np.array([frame_height])
+        offsets = indices
+    elif tile_count:
+        if int(indices.max()) >= tiles_x * tiles_y:
+            raise ValueError("Tile index out of range")
+        _, _, widths, heights, offsets = tile_geometry(indices, frame_width, frame_height, tile_size)
+    else:
+        widths = heights = offsets = indices
+    if pixel_format == pixel_formats.BGRA32:
+        pixels = np.frombuffer(payload, dtype=np.uint32, offset=header_size)
+        sizes = widths.astype(np.int64) * heights
+    else:
+        pixels = np.frombuffer(payload, dtype=np.uint8, offset=header_size)
+        sizes = pixel_formats.packed_sizes(pixel_format, widths, heights)
+        if tile_count and not flags & FLAG_KEYFRAME:
+            offsets = np.zeros_like(sizes)
+            np.cumsum(sizes[:-1], out=offsets[1:])
+    if len(pixels) != int(sizes.sum()):
+        raise ValueError("Tile delta size does not match the frame")
+    if not flags & FLAG_KEYFRAME:
+        offsets = offsets.astype(np.uint32)
+
+    return TileDelta(bool(flags & FLAG_KEYFRAME), tile_size, indices, offsets, pixels, frame_width, frame_height,
+                     copies, pixel_format, cached_indices, cached_slots, stored_slots)
+
+
+def merge(deltas):
+    """
+    Merge tile deltas of the same frame into one, e.g. the parts of a delta received separately.
+    The copies of all parts are applied first, in order, then all tiles.
+
+    Args:
+        deltas (list): The decoded tile deltas, none of them a keyframe or taking tiles from the tile cache.
+
+    Returns:
+        TileDelta: The merged delta, holding a copy of the pixels of all parts.
+
+    Raises:
+        ValueError: If the deltas don't share the frame size, tile size and pixel format.
+    """
+    first = deltas[0]
+    if any((delta.frame_width, delta.frame_height, delta.tile_size, delta.pixel_format) !=
+           (first.frame_width, first.frame_height, first.tile_size, first.pixel_format) for delta in deltas):
+        raise ValueError("Only deltas of the same frame can be merged")
+    if len(deltas) == 1:
+        return first
+    # The offsets of each part move by the length of the pixels before it
+    starts = np.cumsum([0] + [len(delta.pixels) for delta in deltas[:-1]])
+    offsets = np.concatenate([delta.offsets.astype(np.int64) + start for delta, start in zip(deltas, starts)])
+    return TileDelta(False, first.tile_size, np.concatenate([delta.indices for delta in deltas]),
+                     offsets.astype(np.uint32), np.concatenate([delta.pixels for delta in deltas]),
+                     first.frame_width, first.frame_height, np.concatenate([delta.copies for delta in deltas]),
+                     first.pixel_format)
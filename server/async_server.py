@@ -0,0 +1,331 @@
+import asyncio
+import collections
+import socket
+import threading
+import time
+
+from client_session import MAX_MESSAGE_SIZE, ClientSession
+from common import protocol
+from server_handler import JOIN_TIMEOUT, ServerHandler
+
+SHUTDOWN_TIMEOUT = 1.0  # Seconds the clients get to receive their queued packets when the server stops
+WRITE_BUFFER_LIMIT = 256 * 1024  # Bytes buffered per client before its writer waits for the socket
+
+
+class AsyncClientSession(ClientSession):
+    """
+    AsyncClientSession is a client session served by the event loop instead of threads of its own.
+
+    The frame pipelines publish packets from their threads into a bounded deque, and a writer
+    coroutine sends them with non-blocking writes. A queued keyframe replaces the older packets of
+    its stream, so a client that fell behind skips straight to the latest keyframe.
+
+    Attributes:
+        reader (asyncio.StreamReader): The stream the client's messages are read from.
+        writer (asyncio.StreamWriter): The stream the packets are written to.
+        loop (asyncio.AbstractEventLoop): The event loop serving the session.
+        packets (collections.deque): The packets waiting to be sent, at most queue_size tuples sent back to back.
+        queue_size (int): The maximum number of queued packets.
+        closing (bool): Whether the session only sends the packets already queued.
+    """
+
+    def __init__(self, reader, writer, client_address, queue_size=4):
+        """
+        Initializes the AsyncClientSession with the given streams, address and queue size.
+        Must be called on the event loop serving the session.
+
+        Args:
+            reader (asyncio.StreamReader): The stream the client's messages are read from.
+            writer (asyncio.StreamWriter): The stream the packets are written to.
+            client_address (tuple): The address of the client.
+            queue_size (int, optional): The maximum number of queued packets. Defaults to 4.
+        """
+        super().__init__(writer.get_extra_info("socket"), client_address, queue_size)
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.packets = collections.deque()
+        self.queue_size = queue_size
+        self.closing = False
+        self.packet_ready = asyncio.Event()
+
+    def publish(self, packet):
+        """
+        Queue an encoded packet for sending. Called from the frame pipeline threads.
+
+        As with ClientSession, packets of a stream are ignored until the client receives its next
+        keyframe. A keyframe drops the queued packets of its stream, they are outdated by it. If the
+        queue is still full the client has fallen behind: the queued packets are dropped and the
+        client waits for the next keyframe of every stream it receives.
+
+        Args:
+            packet (Packet): The encoded packet.
+
+        Returns:
+            bool: True if the packet was queued, False otherwise.
+        """
+        return self.publish_all((packet,))
+
+    def publish_all(self, packets):
+        """
+        Queue packets of one stream to be sent back to back, from any thread. They take a single
+        place in the queue and are dropped together, see publish().
+
+        Args:
+            packets (tuple): The encoded packets, only the first may synchronize the client with a keyframe.
+
+        Returns:
+            bool: True if the packets were queued, False otherwise.
+        """
+        keyframe = packets[0].keyframe
+        stream_id = packets[0].header.stream_id
+        with self.lock:
+            if self.closing or not self.is_subscribed(stream_id):
+                return False
+            if stream_id in self.keyframes_needed and not keyframe:
+                return False
+
+            if keyframe:
+                kept = collections.deque(queued for queued in self.packets if queued[0].header.stream_id != stream_id)
+                self.dropped_frames_total.inc(sum(len(queued) for queued in self.packets) -
+                                              sum(len(queued) for queued in kept))
+                self.packets = kept
+            if len(self.packets) >= self.queue_size:
+                self.dropped_frames_total.inc(sum(len(queued) for queued in self.packets) +
+                                              (0 if keyframe else len(packets)))
+                self.packets.clear()
+                self.keyframes_needed.update(self.subscriptions)
+                if not keyframe:
+                    return False
+
+            self.packets.append(packets)
+            if keyframe:
+                self.keyframes_needed.discard(stream_id)
+        self._call_soon(self.packet_ready.set)
+        return True
+
+    def _call_soon(self, callback):
+        """
+        Run a callback on the event loop, from any thread.
+
+        Args:
+            callback (callable): The callback.
+        """
+        try:
+            self.loop.call_soon_threadsafe(callback)
+        except RuntimeError:
+            pass  # The event loop is closed, the session with it
+
+    def _next_packets(self):
+        """
+        Take the next packets off the queue.
+
+        Returns:
+            tuple: The packets to send back to back, or None if the queue is empty.
+        """
+        with self.lock:
+            return self.packets.popleft() if self.packets else None
+
+    async def run(self):
+        """
+        Send queued packets to the client until the session is closed or the connection breaks.
+        Acknowledgements and subscriptions from the client are received by a second coroutine meanwhile.
+        """
+        receiver = asyncio.create_task(self._receive_messages())
+        self.writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_LIMIT)
+        try:
+            while self.active:
+                packets = self._next_packets()
+                if packets is None:
+                    if self.closing:
+                        break  # Everything queued was sent
+                    self.packet_ready.clear()
+                    if not self.packets:  # Published right before the event was cleared otherwise
+                        await self.packet_ready.wait()
+                    continue
+                for packet in packets:
+                    start_time = time.perf_counter()
+                    self.writer.writelines((packet.header_bytes, packet.payload))
+                    await self.writer.drain()  # Returns at once unless the client falls behind
+                    self.send_timer.observe(time.perf_counter() - start_time)
+                    self.sent_bytes_total.inc(len(packet.header_bytes) + len(packet.payload))
+                    link = self.links.get(packet.header.stream_id)
+                    if link is not None:
+                        link.on_sent(packet.header)
+        except OSError as e:
+            if self.active:  # Errors after close() are expected
+                print(f"Connection with {self.client_address} lost: {e}")
+        finally:
+            self.active = False
+            receiver.cancel()
+            self.writer.close()
+
+    async def _receive_messages(self):
+        """
+        Receive acknowledgements and subscriptions from the client.
+        """
+        try:
+            while self.active:
+                header = protocol.MessageHeader.unpack(await self.reader.readexactly(protocol.HEADER.size))
+                if header.payload_length > MAX_MESSAGE_SIZE:
+                    raise protocol.ProtocolError(f"Payload of {header.payload_length} bytes is too large")
+                self.handle_message(header, await self.reader.readexactly(header.payload_length))
+        except asyncio.IncompleteReadError:
+            pass  # The client disconnected
+        except (OSError, protocol.ProtocolError) as e:
+            if self.active:
+                print(f"Stopped receiving messages from {self.client_address}: {e}")
+        finally:
+            self.active = False
+            self.packet_ready.set()  # Wakes up the writer to end the session
+
+    def finish(self):
+        """
+        Stop accepting packets and end the session once the queued ones are sent.
+        """
+        self.closing = True
+        self._call_soon(self.packet_ready.set)
+
+    def close(self):
+        """
+        Close the session and its connection, from any thread.
+        """
+        self.active = False
+        self._call_soon(self.packet_ready.set)
+        self._call_soon(self.writer.transport.abort)
+
+
+class AsyncServerHandler(ServerHandler):
+    """
+    AsyncServerHandler serves all clients from a single event loop instead of a thread per client.
+
+    The frame pipelines keep their producer threads and publish packets to the sessions, which
+    the event loop writes to the clients without blocking. The threads in use don't grow with the
+    number of clients, and neither does the memory beyond the bounded queue and write buffer of
+    each client.
+
+    Attributes:
+        loop (asyncio.AbstractEventLoop): The event loop serving the clients while the server runs.
+        sessions (dict): The handler task of each connected client session.
+        stopping (asyncio.Event): Set to stop serving clients.
+        stopped (threading.Event): Set once the event loop stopped serving clients.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Initializes the AsyncServerHandler with the same arguments as ServerHandler.
+
+        Raises:
+            ValueError: If frames are to be sent over UDP, which needs a thread per client.
+        """
+        super().__init__(*args, **kwargs)
+        if self.datagram_transport is not None:
+            raise ValueError("Frames are only sent over UDP with a thread per client")
+        self.loop = None
+        self.sessions = {}
+        self.stopping = None
+        self.stopped = threading.Event()
+
+    async def handle_client(self, reader, writer):
+        """
+        Handle the client connection, sending it the frames published by the frame pipelines.
+
+        Args:
+            reader (asyncio.StreamReader): The stream the client's messages are read from.
+            writer (asyncio.StreamWriter): The stream the packets are written to.
+        """
+        client_address = writer.get_extra_info("peername")
+        if len(self.sessions) >= self.max_clients or self.stopping.is_set():
+            print(f"Refused connection from {client_address}: {self.max_clients} clients connected.")
+            writer.close()
+            return
+        print(f"Connection from {client_address} established.")
+        writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        session = AsyncClientSession(reader, writer, client_address)
+        self.sessions[session] = asyncio.current_task()
+        try:
+            hello = self.hello_packet()
+            writer.writelines((hello.header_bytes, hello.payload))
+            await writer.drain()
+            for frame_pipeline in self.frame_pipelines:
+                frame_pipeline.add_session(session)  # It only publishes the streams the client subscribes to
+            await session.run()  # Send queued packets until the client disconnects
+        except Exception as e:
+            print(f"An error occurred: {e}")
+        finally:
+            for frame_pipeline in self.frame_pipelines:
+                frame_pipeline.remove_session(session)
+            del self.sessions[session]
+            session.active = False
+            writer.close()
+
+    async def serve(self):
+        """
+        Serve clients until stop_server() is called, then let them receive their queued packets and
+        disconnect them.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        server = await asyncio.start_server(self.handle_client, self.host, self.port, backlog=self.max_clients,
+                                            reuse_address=True)
+        print(f"Server is listening on port {self.port}...")
+        self.start_streaming()
+        try:
+            await self.stopping.wait()
+        finally:
+            server.close()  # Stop accepting new clients
+            self.stopping.set()
+            for session in self.sessions:
+                session.finish()
+            tasks = list(self.sessions.values())
+            if tasks:
+                _, pending = await asyncio.wait(tasks, timeout=SHUTDOWN_TIMEOUT)
+                for session in self.sessions:
+                    session.close()  # Clients that don't read anymore, their writes fail once aborted
+                if pending:
+                    await asyncio.wait(pending, timeout=SHUTDOWN_TIMEOUT)
+            await server.wait_closed()
+
+    def upstream_closed(self):
+        """
+        Stop serving clients once the upstream server of a relay disconnected, from the relay connection's thread.
+        """
+        super().upstream_closed()
+        loop = self.loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self.stopping.set)
+            except RuntimeError:
+                pass  # The event loop is already closed
+
+    def start_server(self):
+        """
+        Start the server to listen for incoming client connections, serving all clients on the calling thread.
+        """
+        self.stopped.clear()
+        try:
+            asyncio.run(self.serve())
+        except Exception as e:
+            print(f"An error occurred: {e}")
+        finally:
+            self.running = False
+            self.loop = None
+            self.stopped.set()
+
+    def stop_server(self):
+        """
+        Stop the server and close all connections, from any thread.
+        """
+        self.running = False
+        loop = self.loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self.stopping.set)
+            except RuntimeError:
+                pass  # The event loop is already closed
+            else:
+                self.stopped.wait(2 * SHUTDOWN_TIMEOUT + JOIN_TIMEOUT)
+
+        self.stop_streaming()
+        print("Server has been stopped.")
@@ -1,5 +1,4 @@
-import numpy as np
-import bettercam as dxcam
+from capture_backends import create_backend
 
 
 class CameraHandler:
@@ -9,10 +8,10 @@ class CameraHandler:
     Attributes:
         frame_width (int): The width of the frame.
         frame_height (int): The height of the frame.
-        camera (dxcam.Camera): The camera object from the dxcam library.
+        camera (CaptureBackend): The capture backend frames are grabbed from.
     """
 
-    def __init__(self, frame_width, frame_height, frame_rate):
+    def __init__(self, frame_width, frame_height, frame_rate, backend="dxcam", backend_options=None):
         """
         Initializes the CameraHandler with the given frame width and frame height.
 
@@ -20,11 +19,12 @@ class CameraHandler:
             frame_width (int): The width of the frames to be grabbed.
             frame_height (int): The height of the frames to be grabbed.
             frame_rate (int): The frame rate limit.
+            backend (str, optional): The name of the capture backend. Defaults to "dxcam".
+            backend_options (dict, optional): Backend specific options. Defaults to None.
         """
         self.frame_width = frame_width
         self.frame_height = frame_height
-        self.camera = dxcam.create(output_color="BGRA")  # Initialize the camera with BGRA color format
-        self.camera.start(target_fps=frame_rate)
+        self.camera = create_backend(backend, frame_width, frame_height, frame_rate, **(backend_options or {}))
 
     def grab_frame(self):
         """
@@ -33,10 +33,31 @@ class CameraHandler:
         Returns:
             np.ndarray: The grabbed frame.
         """
-        return self.camera.get_latest_frame()  # Grab a frame from the camera
+        return self.camera.grab_frame()  # Grab a frame from the camera
+
+    @property
+    def frame_size(self):
+        """
+        tuple: The width and height of the grabbed frames, the size of the capture region.
+        """
+        return self.camera.width, self.camera.height
+
+    @property
+    def screen_region(self):
+        """
+        tuple: The (x, y, width, height) rectangle of the desktop shown by the grabbed frames.
+        """
+        return self.camera.screen_region
+
+    @property
+    def damage(self):
+        """
+        list: The (x, y, width, height) rectangles that changed since the previous frame, or None if unknown.
+        """
+        return self.camera.damage
 
     def stop_camera(self):
         """
         Stop the camera.
         """
-        del self.camera  # Stop the camera
+        self.camera.stop()  # Stop the camera
@@ -0,0 +1,429 @@
+import re
+import time
+import numpy as np
+
+
+def parse_region(text):
+    """
+    Parse a capture region written as "x,y,width,height".
+
+    Args:
+        text (str): The region, or an empty string for none.
+
+    Returns:
+        tuple: The (x, y, width, height) region, or None.
+
+    Raises:
+        ValueError: If the text is not four integers.
+    """
+    if not text.strip():
+        return None
+    values = [int(value) for value in text.split(",")]
+    if len(values) != 4:
+        raise ValueError(f"Expected x,y,width,height, got {text!r}")
+    return tuple(values)
+
+
+def find_window(title):
+    """
+    Find the rectangle of a window on the desktop.
+
+    Args:
+        title (str): A part of the window title.
+
+    Returns:
+        tuple: The (x, y, width, height) rectangle of the first matching window, in desktop coordinates.
+
+    Raises:
+        ValueError: If no window matches.
+    """
+    import pygetwindow  # Installed along with pyautogui, only supported on Windows and macOS
+
+    windows = pygetwindow.getWindowsWithTitle(title)
+    if not windows:
+        raise ValueError(f"No window titled {title!r}")
+    window = windows[0]
+    return window.left, window.top, window.width, window.height
+
+
+class CaptureBackend:
+    """
+    CaptureBackend is the interface between CameraHandler and a source of BGRA frames.
+
+    A backend captures either its whole screen or a region of it, given as a rectangle or as the
+    title of a window to follow. Pixels outside the region are never copied.
+
+    Attributes:
+        width (int): The width of the captured frames.
+        height (int): The height of the captured frames.
+        frame_rate (int): The frame rate limit.
+        region (tuple): The captured (x, y, width, height) rectangle of the screen.
+        screen_region (tuple): The captured rectangle in desktop coordinates, used to place the cursor.
+        damage (list): The (x, y, width, height) rectangles that changed since the previous frame,
+            or None if the backend doesn't know.
+    """
+
+    def __init__(self, screen_width, screen_height, frame_rate, region=None, window=None, screen_origin=(0, 0)):
+        """
+        Initializes the CaptureBackend with the size of its screen and the region to capture.
+
+        Args:
+            screen_width (int): The width of the screen.
+            screen_height (int): The height of the screen.
+            frame_rate (int): The frame rate limit.
+            region (tuple, optional): The (x, y, width, height) rectangle of the screen to capture. Defaults to None.
+            window (str, optional): The title of a window to capture instead of region. Defaults to None.
+            screen_origin (tuple, optional): The position of the screen on the desktop. Defaults to (0, 0).
+
+        Raises:
+            ValueError: If the region doesn't overlap the screen.
+        """
+        if window:
+            window_x, window_y, window_width, window_height = find_window(window)
+            region = (window_x - screen_origin[0], window_y - screen_origin[1], window_width, window_height)
+        if region is None:
+            region = (0, 0, screen_width, screen_height)
+
+        # Clip the region to the screen
+        x, y = max(region[0], 0), max(region[1], 0)
+        width = min(region[0] + region[2], screen_width) - x
+        height = min(region[1] + region[3], screen_height) - y
+        if width <= 0 or height <= 0:
+            raise ValueError(f"Capture region {region} is outside of the {screen_width}x{screen_height} screen")
+
+        self.region = (x, y, width, height)
+        self.screen_region = (screen_origin[0] + x, screen_origin[1] + y, width, height)
+        self.width = width
+        self.height = height
+        self.frame_rate = frame_rate
+        self.next_frame_time = None
+        self.damage = None
+
+    def _crop(self, frame):
+        """
+        Crop a full screen frame to the capture region, without copying.
+
+        Args:
+            frame (np.ndarray): The (screen height, screen width, 4) frame.
+
+        Returns:
+            np.ndarray: A view of the region.
+        """
+        x, y, width, height = self.region
+        return frame[y:y + height, x:x + width]
+
+    def _crop_damage(self, damage):
+        """
+        Move damage rectangles of the full screen into the capture region and drop those outside of it.
+
+        Args:
+            damage (list): The (x, y, width, height) rectangles on the screen, or None.
+
+        Returns:
+            list: The rectangles relative to the region, or None.
+        """
+        if damage is None:
+            return None
+        x, y, width, height = self.region
+        cropped = []
+        for rect_x, rect_y, rect_width, rect_height in damage:
+            left, top = max(rect_x - x, 0), max(rect_y - y, 0)
+            right, bottom = min(rect_x + rect_width - x, width), min(rect_y + rect_height - y, height)
+            if left < right and top < bottom:
+                cropped.append((left, top, right - left, bottom - top))
+        return cropped
+
+    def grab_frame(self):
+        """
+        Grab a frame.
+
+        Returns:
+            np.ndarray: A (height, width, 4) BGRA frame the caller may modify, or None if no frame is available.
+        """
+        raise NotImplementedError
+
+    def stop(self):
+        """
+        Release the capture source.
+        """
+
+    def _wait_for_next_frame(self):
+        """
+        Sleep until the next frame is due according to the frame rate limit.
+        """
+        now = time.perf_counter()
+        if self.next_frame_time is None or now - self.next_frame_time > 1.0:
+            self.next_frame_time = now  # First frame, or we fell far behind: don't try to catch up
+        elif self.next_frame_time > now:
+            time.sleep(self.next_frame_time - now)
+        self.next_frame_time += 1.0 / self.frame_rate
+
+
+class DXCamBackend(CaptureBackend):
+    """
+    DXCamBackend captures the screen through DXGI Desktop Duplication (Windows only).
+    Monitors are numbered from 1, like mss does.
+    """
+
+    def __init__(self, frame_rate, monitor=1, region=None, window=None):
+        import bettercam as dxcam
+
+        # Initialize the camera with BGRA color format
+        self.camera = dxcam.create(output_idx=monitor - 1, output_color="BGRA")
+        super().__init__(self.camera.width, self.camera.height, frame_rate, region, window)
+        x, y, width, height = self.region
+        # The region is copied out of the duplicated desktop on the GPU side, the rest is never read back
+        self.camera.start(region=(x, y, x + width, y + height), target_fps=frame_rate)
+
+    def grab_frame(self):
+        return self.camera.get_latest_frame()  # Blocks until a new frame is available
+
+    def stop(self):
+        self.camera.stop()
+        del self.camera
+
+
+class MSSBackend(CaptureBackend):
+    """
+    MSSBackend captures the screen with the cross-platform mss library (X11, macOS, Windows).
+    """
+
+    def __init__(self, frame_rate, monitor=1, region=None, window=None):
+        import mss
+
+        self.screenshot = mss.mss()
+        screen = self.screenshot.monitors[monitor]
+        super().__init__(screen["width"], screen["height"], frame_rate, region, window,
+                         (screen["left"], screen["top"]))
+        x, y, width, height = self.screen_region
+        self.monitor = {"left": x, "top": y, "width": width, "height": height}  # Only the region is grabbed
+
+    def grab_frame(self):
+        self._wait_for_next_frame()
+        return np.array(self.screenshot.grab(self.monitor))  # mss already returns BGRA
+
+    def stop(self):
+        self.screenshot.close()
+
+
+class SyntheticBackend(CaptureBackend):
+    """
+    SyntheticBackend generates reproducible desktop-like content, for benchmarks and headless servers.
+
+    Scenes:
+        static: a desktop that never changes.
+        typing: text appearing one character at a time.
+        scrolling: a document scrolling up.
+        window_drag: a window moving across the desktop.
+        video: a full-screen video with every pixel changing.
+
+    The returned frame is reused: it is only valid until the next call to grab_frame. The damage
+    of each frame is known for all scenes but scrolling and video.
+    """
+
+    SCENES = ("static", "typing", "scrolling", "window_drag", "video")
+
+    def __init__(self, width=1920, height=1080, frame_rate=60, scene="static", seed=0, scroll_speed=8, region=None):
+        if scene not in self.SCENES:
+            raise ValueError(f"Unknown scene {scene!r}, expected one of {', '.join(self.SCENES)}")
+        super().__init__(width, height, frame_rate, region)
+        self.screen_width = width
+        self.screen_height = height  # The scenes are rendered full screen, then cropped to the region
+        self.scene = scene
+        self.scroll_speed = scroll_speed
+        self.frame_index = 0
+        self.rng = np.random.default_rng(seed)
+        self.frame = np.empty((height, width, 4), dtype=np.uint8)
+        self.desktop = self._render_desktop()
+        self.window_rect = None
+
+        if scene == "scrolling":
+            self.document = self._render_text(3 * height, width)
+        elif scene == "typing":
+            self.glyphs = self.rng.random((64, 16, 9)) < 0.3  # Random 9x16 "characters"
+            self.text_layer = self.desktop.copy()
+        elif scene == "window_drag":
+            self.window = self._render_text(height // 2, width // 3)
+            self.window[:24] = (200, 120, 40, 255)  # Title bar
+        elif scene == "video":
+            # Noise twice the frame size, panned differently every frame so no two frames match
+            self.noise = self.rng.integers(0, 256, (2 * height, 2 * width, 4), dtype=np.uint8)
+            self.noise[..., 3] = 255
+
+    def _render_desktop(self):
+        """
+        Render the desktop background: a gradient with a task bar and a few icons.
+        """
+        desktop = np.empty((self.screen_height, self.screen_width, 4), dtype=np.uint8)
+        desktop[..., 0] = np.linspace(120, 60, self.screen_height, dtype=np.uint8)[:, None]
+        desktop[..., 1] = np.linspace(60, 30, self.screen_width, dtype=np.uint8)[None, :]
+        desktop[..., 2] = 40
+        desktop[..., 3] = 255
+        desktop[-40:] = (30, 30, 30, 255)
+        for i in range(6):
+            desktop[20 + 90 * i:84 + 90 * i, 20:84] = (220, 200, 160, 255)
+        return desktop
+
+    def _render_text(self, height, width):
+        """
+        Render a white page covered in pseudo-random lines of text.
+        """
+        page = np.full((height, width, 4), 255, dtype=np.uint8)
+        rows = self.rng.random((height // 20, width // 10)) < 0.7  # Which character cells hold "ink"
+        ink = np.repeat(np.repeat(rows, 20, axis=0), 10, axis=1)
+        ink[np.arange(ink.shape[0]) % 20 >= 14] = False  # Line spacing
+        page[:ink.shape[0], :ink.shape[1]][ink] = (30, 30, 30, 255)
+        return page
+
+    def grab_frame(self):
+        self._wait_for_next_frame()
+        i = self.frame_index
+        self.frame_index += 1
+
+        damage = None
+        if self.scene == "static":
+            np.copyto(self.frame, self.desktop)
+            damage = []
+        elif self.scene == "typing":
+            columns = (self.screen_width - 200) // 10
+            row, column = divmod(i, columns)
+            y = 150 + 20 * (row % ((self.screen_height - 300) // 20))
+            x = 100 + 10 * column
+            if column == 0 and row % ((self.screen_height - 300) // 20) == 0:
+                np.copyto(self.text_layer, self.desktop)  # Page full, start over
+            else:
+                damage = [(x, y, 9, 16)]
+            glyph = self.glyphs[i % len(self.glyphs)]
+            self.text_layer[y:y + 16, x:x + 9][glyph] = (255, 255, 255, 255)
+            np.copyto(self.frame, self.text_layer)
+        elif self.scene == "scrolling":
+            offset = (i * self.scroll_speed) % (self.document.shape[0] - self.screen_height)
+            np.copyto(self.frame, self.document[offset:offset + self.screen_height])
+        elif self.scene == "window_drag":
+            np.copyto(self.frame, self.desktop)
+            window_h, window_w = self.window.shape[:2]
+            x = (i * 6) % (self.screen_width - window_w)
+            amplitude = min(100, (self.screen_height - window_h) // 2)
+            y = (self.screen_height - window_h) // 2 + int(amplitude * np.sin(i / 30))
+            self.frame[y:y + window_h, x:x + window_w] = self.window
+            damage = [self.window_rect, (x, y, window_w, window_h)]
+            self.window_rect = damage[1]
+        elif self.scene == "video":
+            x = (i * 7) % self.screen_width
+            y = (i * 3) % self.screen_height
+            np.copyto(self.frame, self.noise[y:y + self.screen_height, x:x + self.screen_width])
+        self.damage = self._crop_damage(damage) if i > 0 else None
+        return self._crop(self.frame)
+
+
+class ReplayBackend(CaptureBackend):
+    """
+    ReplayBackend streams recorded raw frames from a memory-mapped .npy file of shape
+    (frame count, height, width, 4), looping at the end. Recordings are made with record_frames.
+
+    The returned frame is reused: it is only valid until the next call to grab_frame.
+    """
+
+    def __init__(self, path, frame_rate=60, loop=True, region=None):
+        self.frames = np.load(path, mmap_mode='r')  # Pages are read from disk on demand
+        if self.frames.ndim != 4 or self.frames.shape[3] != 4 or self.frames.dtype != np.uint8:
+            raise ValueError(f"{path} does not hold BGRA frames")
+        super().__init__(self.frames.shape[2], self.frames.shape[1], frame_rate, region)
+        self.loop = loop
+        self.frame_index = 0
+        self.frame = np.empty((self.height, self.width, 4), dtype=np.uint8)
+
+    def grab_frame(self):
+        if self.frame_index >= len(self.frames):
+            if not self.loop:
+                return None
+            self.frame_index = 0
+        self._wait_for_next_frame()
+        np.copyto(self.frame, self._crop(self.frames[self.frame_index]))  # Only the region's pages are read
+        self.frame_index += 1
+        return self.frame
+
+    def stop(self):
+        del self.frames  # Unmap the file
+
+
+def record_frames(backend, path, frame_count):
+    """
+    Record frames from a capture backend to a file that ReplayBackend can play back.
+
+    Args:
+        backend (CaptureBackend): The backend to record from.
+        path (str): The path of the .npy file to write.
+        frame_count (int): The number of frames to record.
+    """
+    frames = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8,
+                                       shape=(frame_count, backend.height, backend.width, 4))
+    recorded = 0
+    while recorded < frame_count:
+        frame = backend.grab_frame()
+        if frame is None:
+            continue
+        frames[recorded] = frame
+        recorded += 1
+    frames.flush()
+    del frames
+
+
+def list_monitors(name):
+    """
+    List the monitors a screen capture backend can capture.
+
+    Args:
+        name (str): The name of the backend, "dxcam" or "mss".
+
+    Returns:
+        list: The monitor number, width and height of each monitor, numbered from 1.
+
+    Raises:
+        ValueError: If the backend doesn't capture monitors.
+    """
+    if name == "mss":
+        import mss
+
+        with mss.mss() as screenshot:
+            # The first entry is the whole virtual desktop
+            return [(index, monitor["width"], monitor["height"])
+                    for index, monitor in enumerate(screenshot.monitors) if index > 0]
+    if name == "dxcam":
+        import bettercam as dxcam
+
+        # Lines like "Device[0] Output[1]: Res:(1920, 1080) Rot:0 Primary:False", DXCamBackend uses device 0
+        outputs = re.findall(r"Device\[0\] Output\[(\d+)\]: Res:\((\d+), (\d+)\)", dxcam.output_info())
+        return [(int(output) + 1, int(width), int(height)) for output, width, height in outputs]
+    raise ValueError(f"The {name} backend doesn't capture monitors")
+
+
+BACKENDS = {
+    "dxcam": DXCamBackend,
+    "mss": MSSBackend,
+    "synthetic": SyntheticBackend,
+    "replay": ReplayBackend,
+}
+
+
+def create_backend(name, frame_width, frame_height, frame_rate, **options):
+    """
+    Create a capture backend by name.
+
+    Args:
+        name (str): The name of the backend, one of BACKENDS.
+        frame_width (int): The width of the streamed frames, used as the default synthetic resolution.
+        frame_height (int): The height of the streamed frames, used as the default synthetic resolution.
+        frame_rate (int): The frame rate limit.
+        **options: Backend specific options, e.g. scene for "synthetic" or path for "replay". All backends
+            accept region and the screen backends also monitor and window.
+
+    Returns:
+        CaptureBackend: The capture backend.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown capture backend {name!r}, expected one of {', '.join(BACKENDS)}")
+    if name == "synthetic":
+        options.setdefault("width", frame_width)
+        options.setdefault("height", frame_height)
+    return BACKENDS[name](frame_rate=frame_rate, **options)
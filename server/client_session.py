@@ -0,0 +1,360 @@
+import collections
+import queue
+import socket
+import threading
+import time
+
+from common import metrics, protocol
+from rate_controller import LinkEstimator
+
+MAX_MESSAGE_SIZE = 256  # Clients only send subscriptions, acknowledgements and keyframe and tile requests
+RETRANSMIT_HISTORY = 64  # Frames per stream whose fragments are sent again when a client over UDP lost them
+
+
+class ClientSession:
+    """
+    ClientSession holds the state of a single connected client: its socket and a bounded queue
+    of encoded packets waiting to be sent to it.
+
+    A client receives the streams it subscribed to, multiplexed over its connection. Each stream is
+    synchronized with its own keyframes and has its own link estimates, as its frame ids are
+    counted independently.
+
+    A client may subscribe to receive the frames over UDP instead, see DatagramTransport. The
+    frames are then numbered per stream in the order they are sent, and the recent ones are kept to
+    send lost fragments again. Until the client registered its address the frames are not sent,
+    it is synchronized with keyframes once it did.
+
+    Attributes:
+        client_socket (socket.socket): The client socket.
+        client_address (tuple): The address of the client.
+        send_queue (queue.Queue): The bounded queue of packets waiting to be sent, in tuples sent back to back.
+        subscriptions (frozenset): The ids of the streams the client receives, none until it subscribes.
+        keyframes_needed (set): The ids of the streams the client has to be (re)synchronized with a keyframe.
+        active (bool): Whether the session is still connected.
+        links (dict): The LinkEstimator of each subscribed stream, estimated from the client's acknowledgements.
+        echoes_timestamps (bool): Whether the client echoes the timestamps of the packets to measure the latency.
+        uses_tile_cache (bool): Whether the client receives deltas taking tiles from its tile cache.
+        datagram_transport (DatagramTransport): The transport sending frames over UDP, or None without one.
+        datagram_address (tuple): The address the client receives frames over UDP at, None while it receives them
+            over TCP or has not registered it yet.
+        receives_datagrams (bool): Whether the client subscribed to receive the frames over UDP.
+        tile_requests (dict): The (first, last) ranges of tiles the client asked to be sent again, by stream id.
+    """
+
+    echoes_timestamps = True
+    uses_tile_cache = True
+
+    def __init__(self, client_socket, client_address, queue_size=4, datagram_transport=None):
+        """
+        Initializes the ClientSession with the given socket, address and queue size.
+
+        Args:
+            client_socket (socket.socket): The client socket.
+            client_address (tuple): The address of the client.
+            queue_size (int, optional): The maximum number of queued packets. Defaults to 4.
+            datagram_transport (DatagramTransport, optional): The transport sending frames over UDP to clients
+                subscribing for it, or None to only send over TCP. Defaults to None.
+        """
+        self.client_socket = client_socket
+        self.client_address = client_address
+        self.send_queue = queue.Queue(maxsize=queue_size)
+        self.subscriptions = frozenset()
+        self.keyframes_needed = set()
+        self.active = True
+        self.links = {}
+        self.lock = threading.Lock()
+        self.datagram_transport = datagram_transport
+        self.datagram_address = None
+        self.receives_datagrams = False
+        self.sequences = {}  # The sequence number of the last frame sent over UDP by stream id
+        self.sent_frames = {}  # The header, sequence number and fragments of the recent frames by stream id
+        self.tile_requests = {}
+        self.send_timer = metrics.REGISTRY.stage("server", "send")
+        self.sent_bytes_total = metrics.REGISTRY.counter("server_sent_bytes_total", "Bytes sent to all clients")
+        self.dropped_frames_total = metrics.REGISTRY.counter("server_dropped_frames_total",
+                                                             "Frames dropped because a client fell behind")
+
+    def subscribe(self, stream_ids):
+        """
+        Change the streams the client receives. Newly subscribed streams start with a keyframe.
+
+        Args:
+            stream_ids (iterable): The ids of the streams to receive.
+        """
+        with self.lock:
+            stream_ids = frozenset(stream_ids)
+            for stream_id in self.subscriptions - stream_ids:
+                self.keyframes_needed.discard(stream_id)
+                self.links.pop(stream_id, None)
+                self.tile_requests.pop(stream_id, None)
+            for stream_id in stream_ids - self.subscriptions:
+                self.keyframes_needed.add(stream_id)
+                self.links[stream_id] = LinkEstimator()
+            self.subscriptions = stream_ids
+
+    def is_subscribed(self, stream_id):
+        """
+        Check whether the client receives a stream.
+
+        Args:
+            stream_id (int): The stream id.
+
+        Returns:
+            bool: True if the session is active and subscribed to the stream.
+        """
+        return self.active and stream_id in self.subscriptions
+
+    def needs_keyframe(self, stream_id):
+        """
+        Check whether the client has to be synchronized with a keyframe of a stream.
+
+        Args:
+            stream_id (int): The stream id.
+
+        Returns:
+            bool: True if the next packet of the stream has to be a keyframe.
+        """
+        return stream_id in self.keyframes_needed
+
+    def request_keyframe(self, stream_id):
+        """
+        Resynchronize the client with the next keyframe of a stream, e.g. after its resolution changed.
+
+        Args:
+            stream_id (int): The stream id.
+        """
+        with self.lock:
+            self.keyframes_needed.add(stream_id)
+
+    def take_tile_requests(self, stream_id):
+        """
+        Take the tiles of a stream the client asked to be sent again, as they were lost on the way.
+
+        Args:
+            stream_id (int): The stream id.
+
+        Returns:
+            list: The (first, last) ranges of the requested tiles, empty if none were requested.
+        """
+        with self.lock:
+            return self.tile_requests.pop(stream_id, [])
+
+    def publish(self, packet):
+        """
+        Queue an encoded packet for sending.
+
+        Deltas are only useful on top of the frame the client already has, so until the client
+        receives a keyframe of the stream all other packets of it are ignored. If the queue is full
+        the client has fallen behind: the queued packets are dropped and the client waits for the
+        next keyframe of every stream it receives.
+
+        Args:
+            packet (Packet): The encoded packet.
+
+        Returns:
+            bool: True if the packet was queued, False otherwise.
+        """
+        return self.publish_all((packet,))
+
+    def publish_all(self, packets):
+        """
+        Queue packets of one stream to be sent back to back, e.g. a cached keyframe and the deltas
+        encoded since. They take a single place in the queue and are dropped together.
+
+        Args:
+            packets (tuple): The encoded packets, only the first may synchronize the client with a keyframe.
+
+        Returns:
+            bool: True if the packets were queued, False otherwise.
+        """
+        first = packets[0]
+        stream_id = first.header.stream_id
+        with self.lock:
+            if not self.is_subscribed(stream_id) or (stream_id in self.keyframes_needed and not first.keyframe):
+                return False
+
+            try:
+                self.send_queue.put_nowait(packets)
+            except queue.Full:
+                self.dropped_frames_total.inc(self._drop_queued_packets() + len(packets))
+                self.keyframes_needed.update(self.subscriptions)
+                return False
+
+            if first.keyframe:
+                self.keyframes_needed.discard(stream_id)
+            return True
+
+    def _drop_queued_packets(self):
+        """
+        Drop all packets waiting in the send queue.
+
+        Returns:
+            int: The number of dropped packets.
+        """
+        count = 0
+        while True:
+            try:
+                count += len(self.send_queue.get_nowait())
+            except queue.Empty:
+                return count
+
+    def run(self):
+        """
+        Send queued packets to the client until the session is closed or the connection breaks.
+        Acknowledgements and subscriptions from the client are received on a separate thread meanwhile.
+        """
+        threading.Thread(target=self._receive_messages, daemon=True).start()
+        try:
+            while self.active:
+                try:
+                    packets = self.send_queue.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                for packet in packets:
+                    start_time = time.perf_counter()
+                    if self.receives_datagrams:
+                        sent = self._send_datagrams(packet)
+                    else:
+                        protocol.send_message(self.client_socket, packet.header_bytes, packet.payload)
+                        sent = len(packet.header_bytes) + len(packet.payload)
+                    self.send_timer.observe(time.perf_counter() - start_time)
+                    self.sent_bytes_total.inc(sent)
+                    link = self.links.get(packet.header.stream_id)
+                    if link is not None and sent:
+                        link.on_sent(packet.header)
+        except OSError as e:
+            if self.active:  # Errors after close() are expected
+                print(f"Connection with {self.client_address} lost: {e}")
+        finally:
+            self.active = False
+
+    def _send_datagrams(self, packet):
+        """
+        Send a packet over UDP, keeping its fragments to send them again if the client lost some.
+
+        Args:
+            packet (Packet): The packet to send.
+
+        Returns:
+            int: The number of bytes sent, 0 if the client has not registered its address yet.
+        """
+        address = self.datagram_address
+        if address is None:
+            return 0  # Synchronized with a keyframe once registered
+        stream_id = packet.header.stream_id
+        try:
+            fragments = self.datagram_transport.fragment(packet)
+        except ValueError as e:
+            print(f"Frame {packet.header.frame_id} of stream {stream_id} not sent to {self.client_address}: {e}")
+            if not packet.keyframe:
+                self.request_keyframe(stream_id)  # The later deltas build on the frame the client missed
+            return 0
+        with self.lock:
+            sequence = self.sequences[stream_id] = (self.sequences.get(stream_id, 0) + 1) & 0xFFFFFFFF
+            sent_frames = self.sent_frames.setdefault(stream_id, collections.deque(maxlen=RETRANSMIT_HISTORY))
+            sent_frames.append((sequence, packet.header, fragments))
+        return self.datagram_transport.send(address, packet.header, sequence, fragments)
+
+    def register_address(self, address):
+        """
+        Start sending frames over UDP to the address the client registered, called from the transport.
+
+        Args:
+            address (tuple): The address of the client's UDP socket.
+        """
+        with self.lock:
+            registered = self.datagram_address is not None
+            self.datagram_address = address
+            if not registered:
+                self.keyframes_needed.update(self.subscriptions)  # Nothing was sent before
+
+    def retransmit(self, stream_id, sequence, indices):
+        """
+        Send fragments of a recent frame again, called from the transport when the client lost them.
+
+        Args:
+            stream_id (int): The stream of the frame.
+            sequence (int): The sequence number of the frame.
+            indices (list): The indices of the lost fragments, empty for all.
+
+        Returns:
+            int: The number of fragments sent again, 0 if the frame is not kept anymore.
+        """
+        with self.lock:
+            sent = [frame for frame in self.sent_frames.get(stream_id, ()) if frame[0] == sequence]
+        if not sent or self.datagram_address is None:
+            return 0
+        _, header, fragments = sent[0]
+        count = len(fragments[2])
+        indices = [index for index in indices if index < count] if indices else range(count)
+        try:
+            self.datagram_transport.send(self.datagram_address, header, sequence, fragments, indices)
+        except OSError:
+            return 0  # The session notices the error itself
+        return len(indices)
+
+    def _receive_messages(self):
+        """
+        Receive acknowledgements, subscriptions and keyframe and tile requests from the client.
+        """
+        header_buffer = bytearray(protocol.HEADER.size)
+        try:
+            while self.active:
+                header = protocol.recv_header(self.client_socket, header_buffer)
+                if header is None:
+                    break
+                if header.payload_length > MAX_MESSAGE_SIZE:
+                    raise protocol.ProtocolError(f"Payload of {header.payload_length} bytes is too large")
+                payload = protocol.recv_exact(self.client_socket, header.payload_length)
+                if payload is None:
+                    break
+                self.handle_message(header, payload)
+        except (OSError, protocol.ProtocolError) as e:
+            if self.active:
+                print(f"Stopped receiving messages from {self.client_address}: {e}")
+
+    def handle_message(self, header, payload):
+        """
+        Handle an acknowledgement, subscription, keyframe or tile request from the client.
+
+        Args:
+            header (MessageHeader): The header of the message.
+            payload (bytes-like): The payload of the message.
+        """
+        if header.msg_type == protocol.MSG_SUBSCRIBE:
+            if header.flags & protocol.FLAG_NO_TILE_CACHE:
+                self.uses_tile_cache = False  # Before subscribing, so no delta with references reaches it
+            if header.flags & protocol.FLAG_DATAGRAMS and self.datagram_transport is not None:
+                # Lost deltas would leave the tile cache out of sync, the client registers with the frame id as token
+                self.uses_tile_cache = False
+                self.receives_datagrams = True
+                self.datagram_transport.register(self, header.frame_id)
+            self.subscribe(payload)
+        elif header.msg_type == protocol.MSG_KEYFRAME_REQUEST:
+            if header.stream_id in self.subscriptions:
+                self.request_keyframe(header.stream_id)
+        elif header.msg_type == protocol.MSG_TILE_REQUEST:
+            if header.stream_id in self.subscriptions and not len(payload) % protocol.TILE_RANGE.size:
+                with self.lock:
+                    self.tile_requests.setdefault(header.stream_id, []).extend(
+                        protocol.TILE_RANGE.iter_unpack(payload))
+        elif header.msg_type == protocol.MSG_ACK and len(payload) >= protocol.ACK_PAYLOAD.size:
+            link = self.links.get(header.stream_id)
+            if link is None:
+                return  # Acknowledges a stream that was unsubscribed meanwhile
+            decode_time, = protocol.ACK_PAYLOAD.unpack_from(payload, 0)
+            link.on_ack(header.frame_id, header.timestamp, decode_time / 1e6)
+
+    def close(self):
+        """
+        Close the session and its socket.
+        """
+        self.active = False
+        if self.datagram_transport is not None:
+            self.datagram_transport.unregister(self)
+        try:
+            self.client_socket.shutdown(socket.SHUT_RDWR)  # Unblocks sends and receives of the other threads
+        except OSError:
+            pass  # Not connected anymore
+        self.client_socket.close()
@@ -0,0 +1,198 @@
+import select
+import socket
+import threading
+from collections import OrderedDict
+
+from common import datagrams, metrics, protocol
+
+SEND_BUFFER_SIZE = 4 * 1024 * 1024  # Bytes of datagrams the socket buffers, keyframes are sent in bursts
+FRAGMENT_CACHE_SIZE = 64  # Frames whose fragments are kept for the sessions sending them, and for retransmission
+MAX_DATAGRAM_SIZE = 2048  # Clients only send registrations and NACKs
+RECEIVE_TIMEOUT = 0.5  # Seconds between checks whether the transport was closed while waiting for datagrams
+JOIN_TIMEOUT = 2.0  # Seconds to wait for the receiver thread when closing
+
+
+class DatagramTransport:
+    """
+    DatagramTransport sends the frames of the clients that subscribed with protocol.FLAG_DATAGRAMS
+    over UDP instead of their TCP connection, so a lost packet only delays its own frame instead of
+    all the data behind it. The TCP connection stays the control channel for the subscriptions,
+    acknowledgements and keyframe and tile requests.
+
+    Each frame is split into units (see datagrams.split_units) and cut into fragment datagrams
+    with XOR parity (see datagrams.fragment), once for all clients receiving it. The clients
+    register the address their fragments go to by sending the token they subscribed with, and ask
+    for lost fragments with NACK datagrams, which this transport receives on a thread of its own.
+
+    Attributes:
+        host (str): The host address the UDP socket is bound to.
+        port (int): The UDP port, the same as the TCP port of the server.
+        fec_ratio (float): The parity fragments sent per data fragment.
+        server_socket (socket.socket): The UDP socket, None until started.
+        sessions (dict): The session of each registered token.
+        addresses (dict): The session of each client address fragments are sent to.
+        fragments (OrderedDict): The codec, flags, fragment bodies and data fragment count of the recently
+            sent frames by the id of their payload, least recently used first.
+    """
+
+    def __init__(self, host, port, fec_ratio=datagrams.FEC_RATIO):
+        """
+        Initializes the DatagramTransport for the given address.
+
+        Args:
+            host (str): The host address to bind the UDP socket to.
+            port (int): The UDP port.
+            fec_ratio (float, optional): The parity fragments sent per data fragment. Defaults to datagrams.FEC_RATIO.
+        """
+        self.host = host
+        self.port = port
+        self.fec_ratio = fec_ratio
+        self.server_socket = None
+        self.sessions = {}
+        self.addresses = {}
+        self.lock = threading.Lock()
+        self.fragments = OrderedDict()
+        self.fragments_lock = threading.Lock()  # Fragmenting takes a while, the sessions don't wait for registrations
+        self.buffer = bytearray()  # Deltas are decompressed into it for splitting
+        self.running = False
+        self.thread = None
+        self.sent_datagrams_total = metrics.REGISTRY.counter("server_sent_datagrams_total",
+                                                             "Fragment datagrams sent to all clients")
+        self.retransmitted_datagrams_total = metrics.REGISTRY.counter("server_retransmitted_datagrams_total",
+                                                                      "Fragment datagrams sent again after a NACK")
+
+    def start(self):
+        """
+        Bind the UDP socket and start receiving registrations and NACKs.
+        """
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+        self.server_socket.bind((self.host, self.port))
+        self.running = True
+        self.thread = threading.Thread(target=self._receive_datagrams, daemon=True)
+        self.thread.start()
+
+    def register(self, session, token):
+        """
+        Expect a client to register its address with a token, sent over its TCP connection.
+
+        Args:
+            session (ClientSession): The session of the client.
+            token (int): The random token the client registers with.
+        """
+        with self.lock:
+            if self.sessions.get(token, session) is session:
+                self.sessions[token] = session
+
+    def unregister(self, session):
+        """
+        Stop sending to a client, e.g. once it disconnected.
+
+        Args:
+            session (ClientSession): The session of the client.
+        """
+        with self.lock:
+            self.sessions = {token: other for token, other in self.sessions.items() if other is not session}
+            self.addresses = {address: other for address, other in self.addresses.items() if other is not session}
+
+    def fragment(self, packet):
+        """
+        Split and fragment a frame message for sending, once for all clients receiving it.
+
+        Args:
+            packet (Packet): The frame message.
+
+        Returns:
+            tuple: The codec and flags of the fragments, the body of each fragment and the count of data fragments.
+
+        Raises:
+            ValueError: If the frame is too large to be sent in datagrams.
+        """
+        key = id(packet.payload)
+        with self.fragments_lock:
+            entry = self.fragments.get(key)
+            if entry is not None and entry[0] is packet.payload:
+                self.fragments.move_to_end(key)
+                return entry[1:]
+            codec, flags, units, self.buffer = datagrams.split_units(packet, self.buffer)
+            bodies, data_count = datagrams.fragment(units, self.fec_ratio)
+            # Holding the payload keeps its id from being reused by another payload
+            self.fragments[key] = (packet.payload, codec, flags, bodies, data_count)
+            if len(self.fragments) > FRAGMENT_CACHE_SIZE:
+                self.fragments.popitem(last=False)
+            return codec, flags, bodies, data_count
+
+    def send(self, address, header, sequence, fragments, indices=None):
+        """
+        Send fragments of a frame to a client.
+
+        Args:
+            address (tuple): The address of the client.
+            header (MessageHeader): The header of the frame message.
+            sequence (int): The sequence number of the frame among the ones sent to the client.
+            fragments (tuple): The codec, flags, fragment bodies and data fragment count, see fragment().
+            indices (iterable, optional): The indices of the fragments to send. Defaults to all.
+
+        Returns:
+            int: The number of bytes sent.
+        """
+        codec, flags, bodies, data_count = fragments
+        sent = 0
+        for index in range(len(bodies)) if indices is None else indices:
+            body = bodies[index]
+            datagram_header = protocol.HEADER.pack(protocol.MAGIC, protocol.VERSION, protocol.MSG_FRAGMENT, codec, flags,
+                                                   header.stream_id, header.frame_id, header.timestamp, header.width,
+                                                   header.height, datagrams.FRAGMENT.size + len(body))
+            fragment_header = datagrams.FRAGMENT.pack(sequence, index, data_count, len(bodies) - data_count)
+            if hasattr(self.server_socket, 'sendmsg'):
+                sent += self.server_socket.sendmsg([datagram_header, fragment_header, body], (), 0, address)
+            else:
+                sent += self.server_socket.sendto(b''.join((datagram_header, fragment_header, body)), address)
+        self.sent_datagrams_total.inc(len(bodies) if indices is None else len(indices))
+        return sent
+
+    def _receive_datagrams(self):
+        """
+        Receive registrations and NACKs from the clients until closed.
+        """
+        buffer = bytearray(MAX_DATAGRAM_SIZE)
+        while self.running:
+            try:
+                # Closing the socket doesn't end a blocking receive, sends have to block while the buffer is full
+                if not select.select([self.server_socket], [], [], RECEIVE_TIMEOUT)[0]:
+                    continue
+                length, address = self.server_socket.recvfrom_into(buffer)
+            except (OSError, ValueError):
+                break  # Closed
+            if length < protocol.HEADER.size:
+                continue
+            try:
+                header = protocol.MessageHeader.unpack(buffer)
+            except protocol.ProtocolError:
+                continue  # Not ours, datagrams can come from anyone
+            if header.msg_type == protocol.MSG_REGISTER:
+                with self.lock:
+                    session = self.sessions.get(header.frame_id)
+                    if session is None or self.addresses.get(address, session) is not session:
+                        continue
+                    self.addresses[address] = session
+                session.register_address(address)
+            elif header.msg_type == protocol.MSG_NACK and length >= protocol.HEADER.size + datagrams.NACK.size:
+                session = self.addresses.get(address)
+                if session is None:
+                    continue
+                sequence, = datagrams.NACK.unpack_from(buffer, protocol.HEADER.size)
+                start = protocol.HEADER.size + datagrams.NACK.size
+                end = start + (length - start) // datagrams.NACK_INDEX.size * datagrams.NACK_INDEX.size
+                indices = [index for index, in datagrams.NACK_INDEX.iter_unpack(buffer[start:end])]
+                self.retransmitted_datagrams_total.inc(session.retransmit(header.stream_id, sequence, indices))
+
+    def close(self):
+        """
+        Stop receiving and close the UDP socket.
+        """
+        self.running = False
+        if self.server_socket is not None:
+            self.server_socket.close()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(JOIN_TIMEOUT)
@@ -0,0 +1,171 @@
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+from common import compression, pixel_formats, tile_delta
+
+
+def _encoder_worker(connection, frame_name, back_buffer_name, frame_width, frame_height, first_row, last_row,
+                    tile_size, pixel_format):
+    """
+    Diff and compress one horizontal band of every frame, until told to stop.
+
+    The band spans whole tile rows, so each worker owns its tiles and its part of the back buffer.
+
+    Args:
+        connection (multiprocessing.connection.Connection): The pipe to the pool.
+        frame_name (str): The name of the shared memory holding the current frame.
+        back_buffer_name (str): The name of the shared memory holding the back buffer.
+        frame_width (int): The width of the frames.
+        frame_height (int): The height of the frames.
+        first_row (int): The first pixel row of the band.
+        last_row (int): The pixel row after the band.
+        tile_size (int): The tile edge length.
+        pixel_format (int): The pixel format the tiles are sent in.
+    """
+    frame_memory = shared_memory.SharedMemory(name=frame_name)
+    back_buffer_memory = shared_memory.SharedMemory(name=back_buffer_name)
+    frame = np.ndarray((frame_height, frame_width), dtype=np.uint32, buffer=frame_memory.buf)
+    back_buffer = np.ndarray((frame_height, frame_width), dtype=np.uint32, buffer=back_buffer_memory.buf)
+    band_frame = frame[first_row:last_row]
+    band_back_buffer = back_buffer[first_row:last_row]
+    pixels = np.empty(band_frame.size, dtype=np.uint32)  # Scratch space for the band's dirty tiles
+    packed = np.empty(4 * band_frame.size, dtype=np.uint8)  # Scratch space for them in a compact pixel format
+    tiles_x, _ = tile_delta.tile_grid(frame_width, frame_height, tile_size)
+    first_tile = (first_row // tile_size) * tiles_x
+
+    try:
+        while True:
+            acceleration = connection.recv()  # The LZ4 acceleration for this frame, 0 to stop
+            if not acceleration:
+                break
+            try:
+                dirty_tiles = tile_delta.find_dirty_tiles(band_back_buffer, band_frame, tile_size)
+                band_back_buffer[:] = band_frame
+                pixel_count = tile_delta.pack_tiles(band_frame, dirty_tiles, pixels, tile_size)
+                data, length = pixels[:pixel_count], 4 * pixel_count
+                if pixel_format != pixel_formats.BGRA32 and pixel_count:
+                    _, _, widths, heights, _ = tile_delta.tile_geometry(dirty_tiles, frame_width, len(band_frame),
+                                                                        tile_size)
+                    length = pixel_formats.pack(pixel_format, data, widths, heights, packed)
+                    data = packed[:length]
+                compressed = compression.compress_block(data, acceleration) if pixel_count else None
+                connection.send((dirty_tiles + np.uint32(first_tile), compressed, length, pixel_count))
+            except Exception as e:
+                connection.send(e)
+    finally:
+        del frame, back_buffer, band_frame, band_back_buffer  # Release the views before closing the memory
+        frame_memory.close()
+        back_buffer_memory.close()
+
+
+class EncoderPool:
+    """
+    EncoderPool diffs and compresses frames in a pool of worker processes, each working on a
+    horizontal band of the frame. Frames are shared with the workers through shared memory, and
+    the compressed bands are reassembled in band order into one chunked payload.
+
+    Attributes:
+        frame_width (int): The width of the frames.
+        frame_height (int): The height of the frames.
+        tile_size (int): The tile edge length.
+        pixel_format (int): The pixel format the tiles are sent in.
+        last_dirty_pixels (int): The number of pixels in the dirty tiles of the last delta.
+        last_encoded_size (int): The size of the last delta before compression.
+        frame (np.ndarray): The shared (height, width) buffer the next frame has to be written to.
+        back_buffer (np.ndarray): The shared (height, width) buffer holding the last encoded frame.
+    """
+
+    def __init__(self, frame_width, frame_height, worker_count, tile_size=tile_delta.TILE_SIZE,
+                 pixel_format=pixel_formats.BGRA32):
+        """
+        Initializes the EncoderPool and starts its workers.
+
+        Args:
+            frame_width (int): The width of the frames to be encoded.
+            frame_height (int): The height of the frames to be encoded.
+            worker_count (int): The number of worker processes.
+            tile_size (int, optional): The tile edge length. Defaults to tile_delta.TILE_SIZE.
+            pixel_format (int, optional): The pixel format the tiles are sent in. Defaults to pixel_formats.BGRA32.
+        """
+        self.frame_width = frame_width
+        self.frame_height = frame_height
+        self.tile_size = tile_size
+        self.pixel_format = pixel_format
+        self.last_dirty_pixels = 0
+        self.last_encoded_size = 0
+
+        frame_size = 4 * frame_width * frame_height
+        self.frame_memory = shared_memory.SharedMemory(create=True, size=frame_size)
+        self.back_buffer_memory = shared_memory.SharedMemory(create=True, size=frame_size)
+        self.frame = np.ndarray((frame_height, frame_width), dtype=np.uint32, buffer=self.frame_memory.buf)
+        self.back_buffer = np.ndarray((frame_height, frame_width), dtype=np.uint32, buffer=self.back_buffer_memory.buf)
+        self.back_buffer[:] = 0
+
+        # Split the tile rows as evenly as possible between the workers
+        _, tiles_y = tile_delta.tile_grid(frame_width, frame_height, tile_size)
+        worker_count = max(1, min(worker_count, tiles_y))
+        band_edges = [round(i * tiles_y / worker_count) * tile_size for i in range(worker_count + 1)]
+        band_edges[-1] = frame_height
+
+        context = multiprocessing.get_context("spawn")  # Forking a process that runs threads is unsafe
+        self.connections = []
+        self.workers = []
+        for first_row, last_row in zip(band_edges, band_edges[1:]):
+            connection, worker_connection = context.Pipe()
+            worker = context.Process(target=_encoder_worker, daemon=True,
+                                     args=(worker_connection, self.frame_memory.name, self.back_buffer_memory.name,
+                                           frame_width, frame_height, first_row, last_row, tile_size,
+                                           pixel_format))
+            worker.start()
+            self.connections.append(connection)
+            self.workers.append(worker)
+
+    def encode_delta(self, acceleration=1, copies=()):
+        """
+        Encode the tiles of self.frame that differ from the back buffer and update the back buffer.
+
+        Args:
+            acceleration (int, optional): The LZ4 acceleration. Defaults to 1.
+            copies (list, optional): The rectangles the client copies before applying the tiles, already
+                applied to the back buffer. Defaults to none.
+
+        Returns:
+            bytes: The tile delta as a chunked LZ4 payload (protocol.CODEC_LZ4_CHUNKS).
+        """
+        for connection in self.connections:
+            connection.send(acceleration)
+
+        results = []
+        for connection in self.connections:  # Collected in band order
+            result = connection.recv()
+            if isinstance(result, Exception):
+                raise result
+            results.append(result)
+
+        dirty_tiles = np.concatenate([indices for indices, _, _, _ in results])
+        header = tile_delta.encode_tile_header(dirty_tiles, self.tile_size, copies, self.pixel_format)
+        chunks = [(compression.compress_block(header, acceleration), len(header))]
+        chunks.extend((compressed, length) for _, compressed, length, _ in results if length)
+        self.last_dirty_pixels = sum(pixel_count for _, _, _, pixel_count in results)
+        self.last_encoded_size = len(header) + sum(length for _, _, length, _ in results)
+        return compression.join_chunks(chunks)
+
+    def close(self):
+        """
+        Stop the workers and release the shared memory.
+        """
+        for connection in self.connections:
+            try:
+                connection.send(0)
+            except OSError:
+                pass  # The worker is already gone
+        for worker in self.workers:
+            worker.join(timeout=5)
+        for connection in self.connections:
+            connection.close()
+
+        self.frame = self.back_buffer = None  # Release the views before closing the memory
+        for memory in (self.frame_memory, self.back_buffer_memory):
+            memory.close()
+            memory.unlink()
@@ -0,0 +1,595 @@
+import time
+import numpy as np
+import cv2
+
+from common import compression, metrics, pixel_formats, protocol, tile_delta
+from common.compression import ZSTD_AVAILABLE, CompressionHistory
+from encoder_pool import EncoderPool
+from rate_controller import RateController
+from stream_publisher import StreamPublisher
+from tile_cache import TileCache
+from video_encoder import VideoEncoder, VideoModeSelector
+
+MIN_COMPRESS_SIZE = 64  # Smaller payloads (e.g. empty deltas) are sent uncompressed
+COMPRESSIONS = ("lz4", "zstd")  # The compressions of the keyframes and tile deltas
+
+
+class FramePipeline(StreamPublisher):
+    """
+    FramePipeline is the producer stage of one stream, e.g. one monitor. It captures, processes and
+    encodes every frame once and publishes the encoded packet to all client sessions subscribed to
+    the stream.
+
+    With a video codec the stream switches to video mode while most of the frame keeps changing,
+    e.g. during video playback: frames are then sent as lossy video packets instead of tile deltas.
+    The back buffer stays current in video mode, so the clients are resynchronized losslessly
+    with a keyframe when the stream switches back.
+
+    Content that moved since the last frame, e.g. a scrolled document, is sent as copies of
+    rectangles the client already has, followed by the tiles that still differ.
+
+    The last keyframe and the deltas since are cached: joining clients and clients that fell
+    behind are synchronized with them before the next capture, however many join at once. Every
+    keyframe_interval seconds all clients receive a fresh keyframe instead of a delta, which
+    recovers clients whose frame got out of sync.
+
+    With zstd compression the deltas refer to the ones sent before them, through a compression
+    history starting over with every keyframe. The deltas sent while a keyframe is encoded for the
+    cache start it over too, so the clients receiving them and the ones joining with the keyframe
+    continue with the same history.
+
+    Tiles that clients receiving the stream over UDP lost are sent again with the next delta
+    encoded in this process, to all clients. With the encoder pool those clients are
+    resynchronized with a keyframe instead.
+
+    Attributes:
+        camera_handler (CameraHandler): The handler for capturing frames from the camera.
+        frame_processor (FrameProcessor): The handler for processing frames.
+        frame_width (int): The width of the frames.
+        frame_height (int): The height of the frames.
+        stream_width (int): The width of the streamed frames, smaller than frame_width when downscaled.
+        stream_height (int): The height of the streamed frames.
+        back_buffer (np.ndarray): The last frame known to the connected clients.
+        frame_buffer (np.ndarray): The buffer captured frames are resized into when not encoding in the pool.
+        damage (list): The rectangles of the last captured frame that may differ from the one before, or None.
+        encoder_pool (EncoderPool): The worker processes encoding deltas, or None to encode in this process.
+        rate_controller (RateController): Adapts the frame rate, resolution and codec level, or None.
+        video_codec (str): The video codec of video mode, or None to always send tile deltas.
+        video_selector (VideoModeSelector): Switches between the delta and video mode, or None without a video codec.
+        video_encoder (VideoEncoder): The encoder session of video mode, created at the current stream resolution.
+        detect_motion (bool): Whether moved content is sent as copies instead of tiles.
+        pixel_format (int): The pixel format the keyframes and tiles are sent in.
+        tile_cache (TileCache): The tiles cached by the clients, sent as references when dirty again, or None.
+        compression_history (CompressionHistory): The history zstd payloads are compressed with, or None with LZ4.
+        compression_level (int): The zstd level.
+        keyframe_cache (KeyframeCache): The last keyframe and the deltas since, reproducing the back buffer.
+        keyframe_interval (float): The seconds between keyframes sent to all clients, or None to only send
+            keyframes to clients that need one.
+        frame_id (int): The id of the last captured frame.
+        stream_id (int): The id of the stream in the messages.
+        sessions (list): The connected client sessions.
+    """
+
+    def __init__(self, camera_handler, frame_processor, frame_width, frame_height, encoder_workers=0, frame_rate=60,
+                 target_latency=None, stream_id=0, video_codec=None, video_mode="auto", detect_motion=True,
+                 keyframe_interval=10.0, pixel_format="bgra32", tile_cache=True, compression="lz4",
+                 compression_level=1):
+        """
+        Initializes the FramePipeline with the given handlers and frame size.
+
+        Args:
+            camera_handler (CameraHandler): The handler for capturing frames from the camera.
+            frame_processor (FrameProcessor): The handler for processing frames.
+            frame_width (int): The width of the frames to be processed.
+            frame_height (int): The height of the frames to be processed.
+            encoder_workers (int, optional): The number of encoder processes, 0 to encode in this process.
+                Defaults to 0.
+            frame_rate (int, optional): The frame rate limit. Defaults to 60.
+            target_latency (float, optional): The latency target in seconds the stream quality is adapted to,
+                or None to always stream at full quality. Defaults to None.
+            stream_id (int, optional): The id of the stream in the messages. Defaults to 0.
+            video_codec (str, optional): The video codec of video mode, "h264", "vp8" or "vp9", or None to
+                always send tile deltas. Defaults to None.
+            video_mode (str, optional): "auto" to switch to video mode while most of the frame changes,
+                "always" to stay in video mode. Defaults to "auto".
+            detect_motion (bool, optional): Whether to send moved content as copies instead of tiles.
+                Defaults to True.
+            keyframe_interval (float, optional): The seconds between keyframes sent to all clients, or None to
+                only send keyframes to clients that need one. Defaults to 10.0.
+            pixel_format (str, optional): The pixel format the keyframes and tiles are sent in, one of
+                pixel_formats.PIXEL_FORMATS. Defaults to "bgra32".
+            tile_cache (bool, optional): Whether to send dirty tiles the clients have cached, e.g. of windows
+                switched back to, as references to their cache. Not done by the encoder pool. Defaults to True.
+            compression (str, optional): "lz4" to compress every payload on its own, "zstd" to compress the
+                deltas referring to the ones before. The encoder pool always uses LZ4. Defaults to "lz4".
+            compression_level (int, optional): The zstd level, negative levels are faster. Defaults to 1.
+
+        Raises:
+            RuntimeError: If video mode is requested but PyAV is not installed, or zstd but zstandard is not.
+            ValueError: If the video codec, mode, pixel format or compression is unknown, or the frame size is odd
+                in video mode.
+        """
+        if pixel_format not in pixel_formats.PIXEL_FORMATS:
+            raise ValueError(f"Unknown pixel format {pixel_format}, "
+                             f"expected one of {list(pixel_formats.PIXEL_FORMATS)}")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression {compression}, expected one of {list(COMPRESSIONS)}")
+        if compression == "zstd" and not ZSTD_AVAILABLE:
+            raise RuntimeError("zstd compression needs the zstandard package")
+        super().__init__(stream_id)
+        self.camera_handler = camera_handler
+        self.frame_processor = frame_processor
+        self.frame_width = frame_width
+        self.frame_height = frame_height
+        self.stream_width = frame_width
+        self.stream_height = frame_height
+        self.pixel_format = pixel_formats.PIXEL_FORMATS[pixel_format]
+        if encoder_workers > 0:
+            self.encoder_pool = EncoderPool(frame_width, frame_height, encoder_workers, pixel_format=self.pixel_format)
+            self.back_buffer = self.encoder_pool.back_buffer
+        else:
+            self.encoder_pool = None
+            self.back_buffer = np.zeros((frame_height, frame_width), dtype=np.uint32)
+        self.frame_buffer = np.empty((frame_height, frame_width), dtype=np.uint32)  # Captured frames are resized into it
+        self.damage = None
+        self.rate_controller = RateController(frame_rate, target_latency) if target_latency else None
+        self.frame_rate = frame_rate
+        self.video_codec = video_codec
+        self.video_selector = VideoModeSelector(video_mode) if video_codec else None
+        # Opened up front, so a missing codec or an odd frame size fails before streaming
+        self.video_encoder = VideoEncoder(video_codec, frame_width, frame_height, frame_rate) if video_codec else None
+        self.video_keyframe = False  # Whether the next video packet must be a keyframe
+        self.detect_motion = detect_motion
+        self.tile_cache = TileCache() if tile_cache else None
+        self.compression_history = CompressionHistory() if compression == "zstd" else None
+        self.compression_level = compression_level
+        self.keyframe_interval = keyframe_interval
+
+        # Looked up once, observing them is cheap enough for every frame
+        stages = ("capture", "overlay", "resize", "motion", "diff", "pack", "compress", "encode", "video")
+        self.stage_timers = {stage: metrics.REGISTRY.stage("server", stage) for stage in stages}
+        self.frames_total = metrics.REGISTRY.counter("server_frames_total", "Frames captured and encoded")
+        self.keyframes_total = metrics.REGISTRY.counter("server_keyframes_total", "Keyframes encoded")
+        self.copies_total = metrics.REGISTRY.counter("server_copies_total", "Moved rectangles sent as copies")
+        self.cached_tiles_total = metrics.REGISTRY.counter("server_cached_tiles_total",
+                                                           "Dirty tiles sent as references to the client's tile cache")
+        self.refreshed_tiles_total = metrics.REGISTRY.counter("server_refreshed_tiles_total",
+                                                              "Tiles sent again as clients lost them on the way")
+        self.encoded_bytes_total = metrics.REGISTRY.counter("server_encoded_bytes_total",
+                                                            "Size of the encoded updates before compression")
+        self.compressed_bytes_total = metrics.REGISTRY.counter("server_compressed_bytes_total",
+                                                               "Size of the encoded updates after compression")
+        self.dirty_ratio = metrics.REGISTRY.histogram("server_dirty_ratio", "Share of the pixels in dirty tiles",
+                                                      buckets=metrics.RATIO_BUCKETS)
+        self.video_gauge = metrics.REGISTRY.gauge("server_video_mode", "Whether the stream is sent as video",
+                                                  stream=str(stream_id))
+        self.frame_id = 0
+
+    def stop(self):
+        """
+        Stop the producer thread and the encoder processes.
+        """
+        super().stop()
+        if self.encoder_pool is not None:
+            self.encoder_pool.close()
+            self.encoder_pool = None
+
+    def capture_frame(self, output=None):
+        """
+        Capture a frame and prepare it for encoding at the stream resolution: it is resized first,
+        then the overlay is drawn onto it.
+
+        Args:
+            output (np.ndarray, optional): A (height, width) uint32 buffer to write the frame to, or None to use
+                frame_buffer. Defaults to None.
+
+        Returns:
+            np.ndarray: The processed frame as a (height, width) uint32 array, or None if no frame was available.
+        """
+        start_time = time.perf_counter()
+        frame = self.camera_handler.grab_frame()  # Capture a frame from the camera
+        if frame is None:
+            return None
+        resize_time = time.perf_counter()
+        self.stage_timers["capture"].observe(resize_time - start_time)
+
+        # Downscale first, so the overlay and everything after it only touch the streamed pixels
+        if output is None:
+            output = self.frame_buffer
+        output_bgra = output.view(np.uint8).reshape((self.stream_height, self.stream_width, 4))
+        if frame.shape[:2] == output_bgra.shape[:2]:
+            np.copyto(output_bgra, frame)
+        else:
+            cv2.resize(frame, (self.stream_width, self.stream_height), dst=output_bgra)  # Resize into the output
+        overlay_time = time.perf_counter()
+        self.stage_timers["resize"].observe(overlay_time - resize_time)
+
+        # Draw overlay on the frame
+        self.frame_processor.draw_overlay(output_bgra, self.camera_handler.screen_region)
+        self.stage_timers["overlay"].observe(time.perf_counter() - overlay_time)
+        self.damage = self._stream_damage(frame.shape)
+        return output
+
+    def _stream_damage(self, capture_shape):
+        """
+        Map the capture damage of the last frame to the stream resolution and add the overlay damage.
+
+        Args:
+            capture_shape (tuple): The shape of the captured frame.
+
+        Returns:
+            list: The (x, y, width, height) rectangles of the stream frame that may have changed, or None if unknown.
+        """
+        capture_damage = self.camera_handler.damage
+        if capture_damage is None:
+            return None
+        scale_x = self.stream_width / capture_shape[1]
+        scale_y = self.stream_height / capture_shape[0]
+        damage = list(self.frame_processor.overlay_damage)  # Drawn at the stream resolution already
+        for x, y, width, height in capture_damage:
+            # Interpolation spreads a changed pixel to its neighbours, so grow the rectangle by one pixel
+            left = max(int(x * scale_x) - 1, 0)
+            top = max(int(y * scale_y) - 1, 0)
+            right = min(int(np.ceil((x + width) * scale_x)) + 1, self.stream_width)
+            bottom = min(int(np.ceil((y + height) * scale_y)) + 1, self.stream_height)
+            if left < right and top < bottom:
+                damage.append((left, top, right - left, bottom - top))
+        return damage
+
+    def copy_moved_content(self, frame):
+        """
+        Detect content of the frame that moved since the back buffer, e.g. scrolled, and move it in
+        the back buffer the same way the client will.
+
+        Args:
+            frame (np.ndarray): The (height, width) uint32 frame at the stream resolution.
+
+        Returns:
+            list: The (source x, source y, destination x, destination y, width, height) rectangles copied.
+        """
+        if not self.detect_motion:
+            return []
+        start_time = time.perf_counter()
+        copies = self.frame_processor.estimate_motion(self.back_buffer, frame, self.damage)
+        if copies:
+            tile_delta.apply_copies(self.back_buffer, copies)
+            self.copies_total.inc(len(copies))
+        self.stage_timers["motion"].observe(time.perf_counter() - start_time)
+        return copies
+
+    def encode_frame(self, payload, timestamp, keyframe=False, codec=None, flags=0):
+        """
+        Compress an encoded keyframe or tile delta into a packet ready to be sent.
+
+        Args:
+            payload (bytearray): The encoded keyframe or tile delta.
+            timestamp (int): The capture time of the frame.
+            keyframe (bool, optional): Whether the payload is a keyframe. Defaults to False.
+            codec (int, optional): The codec of an already compressed payload. Defaults to None.
+            flags (int, optional): The compression history flags of a delta, protocol.FLAG_DETACHED and
+                protocol.FLAG_RESETS_HISTORY. Defaults to 0.
+
+        Returns:
+            Packet: The frame message.
+        """
+        encoded = payload
+        if codec is not None:
+            pass  # Compressed by the encoder pool
+        elif len(payload) < MIN_COMPRESS_SIZE:
+            codec = protocol.CODEC_RAW
+        else:
+            start_time = time.perf_counter()
+            acceleration = self._acceleration()
+            if self.compression_history is not None:
+                # zstd's negative levels are its accelerated ones, keyframes decompress without the history
+                level = -acceleration if acceleration > 1 else self.compression_level
+                payload = compression.compress_zstd(payload, level, None if keyframe else self.compression_history)
+                codec = protocol.CODEC_ZSTD
+            else:
+                payload = compression.compress_block(payload, acceleration)  # Compress the encoded update
+                codec = protocol.CODEC_LZ4_BLOCK
+            self.stage_timers["compress"].observe(time.perf_counter() - start_time)
+            self.encoded_bytes_total.inc(len(encoded))
+            self.compressed_bytes_total.inc(len(payload))
+
+        header = protocol.MessageHeader(protocol.MSG_FRAME, codec=codec,
+                                        flags=flags | (protocol.FLAG_KEYFRAME if keyframe else 0),
+                                        frame_id=self.frame_id, timestamp=timestamp,
+                                        width=self.stream_width, height=self.stream_height, stream_id=self.stream_id)
+        if self.compression_history is not None:
+            self.compression_history.update(header, encoded)  # As the clients do after decompressing it
+        return protocol.Packet(header, payload)
+
+    def encode_keyframe(self, timestamp):
+        """
+        Encode the back buffer into a keyframe packet and cache it for joining clients.
+
+        Args:
+            timestamp (int): The capture time of the frame.
+
+        Returns:
+            Packet: The keyframe message.
+        """
+        payload = tile_delta.encode_keyframe(self.back_buffer, pixel_format=self.pixel_format)
+        keyframe_packet = self.encode_frame(payload, timestamp, keyframe=True)
+        self.keyframes_total.inc()
+        self.keyframe_cache.reset(keyframe_packet)
+        return keyframe_packet
+
+    def _resync_tile_cache(self, sessions):
+        """
+        Reset the tile cache if sessions using it were (re)synchronized with a keyframe: they have
+        not received the tiles stored in it before.
+
+        Args:
+            sessions (list): The sessions that received a keyframe they needed.
+        """
+        if self.tile_cache is not None and any(session.uses_tile_cache for session in sessions):
+            self.tile_cache.reset()
+
+    def encode_video(self, frame, timestamp, keyframe=False):
+        """
+        Encode a frame into a video packet ready to be sent.
+
+        Args:
+            frame (np.ndarray): The (height, width) uint32 frame at the stream resolution.
+            timestamp (int): The capture time of the frame.
+            keyframe (bool, optional): Whether to encode a keyframe. Defaults to False.
+
+        Returns:
+            Packet: The frame message, or None if the encoder didn't output a packet for this frame.
+        """
+        start_time = time.perf_counter()
+        encoder = self.video_encoder
+        if encoder is None or (encoder.frame_width, encoder.frame_height) != (self.stream_width, self.stream_height):
+            # A new session starts with a keyframe at the current resolution
+            encoder = self.video_encoder = VideoEncoder(self.video_codec, self.stream_width, self.stream_height,
+                                                        self.frame_rate)
+        payload, keyframe = encoder.encode(frame, keyframe)
+        self.stage_timers["video"].observe(time.perf_counter() - start_time)
+        if payload is None:
+            return None
+        self.compressed_bytes_total.inc(len(payload))
+        if keyframe:
+            self.keyframes_total.inc()
+        return self.encode_frame(payload, timestamp, keyframe, codec=encoder.protocol_codec)
+
+    def _switch_video_mode(self, sessions):
+        """
+        Follow a switch between the delta and video mode of the stream.
+
+        Args:
+            sessions (list): The active client sessions.
+        """
+        if self.video_selector.active:
+            self.video_keyframe = True  # The clients' decoders start from a keyframe
+            self.keyframe_cache.invalidate()  # The back buffer changes without deltas in video mode
+        else:
+            for session in sessions:
+                session.request_keyframe(self.stream_id)  # Replace the lossy video frame with the exact one
+        self.video_gauge.set(int(self.video_selector.active))
+        print(f"Stream {self.stream_id} switched to {'video' if self.video_selector.active else 'delta'} mode, "
+              f"change rate: {self.video_selector.change_rate:.2f}")
+
+    def _acceleration(self):
+        """
+        Get the LZ4 acceleration of the current codec level.
+
+        Returns:
+            int: The acceleration, 1 without a rate controller.
+        """
+        return self.rate_controller.acceleration if self.rate_controller else 1
+
+    def _use_encoder_pool(self):
+        """
+        Check whether deltas are encoded by the encoder pool. The pool only works at full resolution,
+        downscaled frames are small enough to be encoded in this process.
+
+        Returns:
+            bool: True if the encoder pool is used.
+        """
+        return self.encoder_pool is not None and self.stream_width == self.frame_width
+
+    @property
+    def refreshes_tiles(self):
+        """
+        bool: Whether the tiles clients lost are sent with the next delta, which the encoder pool can't.
+        """
+        return not self._use_encoder_pool()
+
+    def _requested_tiles(self, sessions):
+        """
+        Collect the tiles the sessions asked to be sent again.
+
+        Args:
+            sessions (list): The active client sessions.
+
+        Returns:
+            np.ndarray: The sorted indices of the requested tiles, leaving out the ones beyond the stream's tiles.
+        """
+        ranges = [tiles for session in sessions for tiles in session.take_tile_requests(self.stream_id)]
+        if not ranges:
+            return np.zeros(0, dtype=np.uint32)
+        tiles_x, tiles_y = tile_delta.tile_grid(self.stream_width, self.stream_height)
+        requested = np.zeros(tiles_x * tiles_y, dtype=bool)
+        for first, last in ranges:
+            requested[first:last + 1] = True  # Ranges from before a resize may reach past the tiles
+        indices = np.flatnonzero(requested).astype(np.uint32)
+        self.refreshed_tiles_total.inc(len(indices))
+        return indices
+
+    def _set_scale(self, scale, sessions):
+        """
+        Change the stream resolution. The clients are resynchronized with a keyframe at the new resolution.
+
+        Args:
+            scale (float): The scale of the stream resolution relative to the frame size.
+            sessions (list): The active client sessions.
+        """
+        self.stream_width = max(2, int(self.frame_width * scale) & ~1)
+        self.stream_height = max(2, int(self.frame_height * scale) & ~1)
+        if self._use_encoder_pool():
+            self.back_buffer = self.encoder_pool.back_buffer
+        else:
+            self.back_buffer = np.zeros((self.stream_height, self.stream_width), dtype=np.uint32)
+        self.frame_buffer = np.empty((self.stream_height, self.stream_width), dtype=np.uint32)
+        self.keyframe_cache.invalidate()
+        for session in sessions:
+            session.request_keyframe(self.stream_id)
+
+    def _run(self):
+        """
+        Capture, process and encode frames once and fan them out to all subscribed client sessions.
+        """
+        frame_count = 0
+        start_time = time.time()
+        next_frame_time = time.perf_counter()
+
+        while self.running:
+            sessions = self._active_sessions()
+            if not sessions:
+                self.clients_gauge.set(0)
+                time.sleep(0.05)  # Nobody is watching, no point in encoding
+                frame_count = 0
+                start_time = time.time()
+                continue
+
+            video_mode = self.video_selector is not None and self.video_selector.active
+            if not video_mode:
+                joined = self.join_sessions(sessions)  # Right away, before waiting for the next frame
+                self._resync_tile_cache(joined)
+
+            if self.rate_controller is not None:
+                # Pace the frames at the adapted frame rate, the capture backend paces at the limit
+                delay = next_frame_time - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                next_frame_time = max(next_frame_time + 1.0 / self.rate_controller.fps, time.perf_counter())
+
+            timestamp = protocol.timestamp_now()
+            use_encoder_pool = self._use_encoder_pool()
+            frame = self.capture_frame(self.encoder_pool.frame if use_encoder_pool else None)
+            if frame is None:
+                continue
+            encode_start_time = time.perf_counter()
+            self.frame_id = (self.frame_id + 1) & 0xFFFFFFFF
+            dirty_ratio = None
+            full_delta_packet = None  # The delta without tiles taken from the tile cache, if it takes any
+
+            cache = self.keyframe_cache
+            periodic_keyframe = bool(not video_mode and self.keyframe_interval and
+                                     cache.age() >= self.keyframe_interval)
+            refresh_keyframe = not video_mode and (cache.keyframe is None or periodic_keyframe or cache.is_full())
+            # The clients receiving the delta instead of the keyframe start the compression history over with it
+            delta_flags = protocol.FLAG_RESETS_HISTORY if refresh_keyframe else 0
+
+            if video_mode:
+                # Keep the back buffer current for switching back, and measure the change rate on the way
+                dirty_tiles = self.frame_processor.calculate_diff(self.back_buffer, frame, regions=self.damage)
+                self.stage_timers["diff"].observe(time.perf_counter() - encode_start_time)
+                tiles_x, tiles_y = tile_delta.tile_grid(self.stream_width, self.stream_height)
+                dirty_ratio = len(dirty_tiles) / (tiles_x * tiles_y)
+                self.dirty_ratio.observe(dirty_ratio)
+                keyframe = self.video_keyframe or any(session.needs_keyframe(self.stream_id) for session in sessions)
+                delta_packet = self.encode_video(frame, timestamp, keyframe)
+                if delta_packet is not None and delta_packet.keyframe:
+                    self.video_keyframe = False
+            elif all(session.needs_keyframe(self.stream_id) for session in sessions):
+                self.back_buffer[:] = frame
+                delta_packet = None
+            elif use_encoder_pool:
+                copies = self.copy_moved_content(frame)
+                diff_start_time = time.perf_counter()
+                payload = self.encoder_pool.encode_delta(self._acceleration(), copies)
+                self.stage_timers["encode"].observe(time.perf_counter() - diff_start_time)
+                self.encoded_bytes_total.inc(self.encoder_pool.last_encoded_size)
+                self.compressed_bytes_total.inc(len(payload))
+                dirty_ratio = self.encoder_pool.last_dirty_pixels / frame.size
+                self.dirty_ratio.observe(dirty_ratio)
+                delta_packet = self.encode_frame(payload, timestamp, codec=protocol.CODEC_LZ4_CHUNKS,
+                                                 flags=delta_flags)
+            else:
+                copies = self.copy_moved_content(frame)
+                diff_start_time = time.perf_counter()
+                # Calculate the difference, only where the capture or the overlay may have changed if that is known
+                dirty_tiles = self.frame_processor.calculate_diff(self.back_buffer, frame, regions=self.damage)
+                requested_tiles = self._requested_tiles(sessions)
+                if len(requested_tiles):
+                    dirty_tiles = np.union1d(dirty_tiles, requested_tiles)
+                pack_start_time = time.perf_counter()
+                self.stage_timers["diff"].observe(pack_start_time - diff_start_time)
+                if self.tile_cache is not None:
+                    tiles, stored_slots, cached_tiles, cached_slots = self.tile_cache.update(self.back_buffer,
+                                                                                             dirty_tiles)
+                    self.cached_tiles_total.inc(len(cached_tiles))
+                else:
+                    tiles, stored_slots, cached_tiles, cached_slots = dirty_tiles, None, (), ()
+                payload = tile_delta.encode_tiles(self.back_buffer, tiles, copies=copies,
+                                                  pixel_format=self.pixel_format, stored_slots=stored_slots,
+                                                  cached_indices=cached_tiles, cached_slots=cached_slots)
+                if len(cached_tiles):
+                    # For joining clients and recordings, which may not hold the cached tiles
+                    full_payload = tile_delta.encode_tiles(self.back_buffer, dirty_tiles, copies=copies,
+                                                           pixel_format=self.pixel_format)
+                self.stage_timers["pack"].observe(time.perf_counter() - pack_start_time)
+                _, _, widths, heights, _ = tile_delta.tile_geometry(dirty_tiles, frame.shape[1], frame.shape[0],
+                                                                    tile_delta.TILE_SIZE)
+                dirty_pixels = int((widths * heights).sum())
+                dirty_ratio = dirty_pixels / frame.size
+                self.dirty_ratio.observe(dirty_ratio)
+                if len(cached_tiles):
+                    # Each client receives one of the two, so neither is part of the compression history
+                    delta_flags |= protocol.FLAG_DETACHED
+                delta_packet = self.encode_frame(payload, timestamp, flags=delta_flags)
+                if len(cached_tiles):
+                    full_delta_packet = self.encode_frame(full_payload, timestamp, flags=delta_flags)
+            if full_delta_packet is None:
+                full_delta_packet = delta_packet
+
+            keyframe_packet = None
+            if not video_mode:
+                if delta_packet is None or refresh_keyframe:
+                    keyframe_packet = self.encode_keyframe(timestamp)  # Of the back buffer, now equal to the frame
+                else:
+                    cache.append(full_delta_packet)
+
+            resynced = []
+            for session in sessions:
+                if video_mode:
+                    if delta_packet is not None:
+                        session.publish(delta_packet)  # Only keyframes reach the sessions waiting for one
+                elif keyframe_packet is not None and (periodic_keyframe or session.needs_keyframe(self.stream_id)):
+                    if session.needs_keyframe(self.stream_id):
+                        resynced.append(session)
+                    session.publish(keyframe_packet)
+                elif not session.needs_keyframe(self.stream_id):  # Otherwise it joins from the cache next frame
+                    session.publish(delta_packet if session.uses_tile_cache else full_delta_packet)
+            self._resync_tile_cache(resynced)
+
+            if dirty_ratio is not None and self.video_selector is not None and self.video_selector.update(dirty_ratio):
+                self._switch_video_mode(sessions)
+
+            if self.rate_controller is not None:
+                latencies = []
+                for session in sessions:
+                    link = session.links.get(self.stream_id)
+                    latency = link.current_latency() if link is not None else None
+                    if latency is not None:
+                        latencies.append(latency)
+                if self.rate_controller.update(latencies, time.perf_counter() - encode_start_time):
+                    self._set_scale(self.rate_controller.scale, sessions)
+
+            self.frames_total.inc()
+            self.clients_gauge.set(len(sessions))
+            frame_count += 1
+            elapsed_time = time.time() - start_time
+            if elapsed_time > 1.0:
+                fps = frame_count / elapsed_time  # Calculate FPS
+                if self.rate_controller is not None:
+                    print(f"Stream {self.stream_id} FPS: {fps:.2f}, clients: {len(sessions)}, "
+                          f"stream: {self.stream_width}x{self.stream_height}, "
+                          f"fps limit: {self.rate_controller.fps:.1f}, acceleration: {self.rate_controller.acceleration}")
+                else:
+                    print(f"Stream {self.stream_id} FPS: {fps:.2f}, clients: {len(sessions)}")
+                frame_count = 0
+                start_time = time.time()
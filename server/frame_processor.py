@@ -1,9 +1,24 @@
+import os
 import socket
 import numpy as np
 import cv2
 import imutils
-import time
-import pyautogui
+
+from common import tile_delta
+from overlay_compositor import OverlayCompositor
+
+try:
+    import pyautogui
+except Exception:  # No display to query the cursor from, e.g. a headless Linux server
+    pyautogui = None
+
+CURSOR_IMAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets', 'cursor.png')
+
+MOTION_SAMPLE_STEP = 4  # Pixel stride of the quick search for the changed rectangle
+MOTION_HASH_SAMPLES = 128  # Pixels per line hashed to match the lines of two frames
+MOTION_WINDOW = 16  # Consecutive lines identifying a position, single lines repeat, e.g. within a line of text
+MIN_MOTION_LINES = 32  # Fewest moved lines worth a copy
+_HASH_WEIGHTS = np.random.default_rng(0).integers(0, 2 ** 32, MOTION_HASH_SAMPLES, dtype=np.uint32) | np.uint32(1)
 
 
 class FrameProcessor:
@@ -15,6 +30,8 @@ class FrameProcessor:
         frame_height (int): The height of the frame.
         cursor_image (np.ndarray): The image of the cursor to overlay on the frames.
         host_name (str): The hostname of the machine.
+        compositor (OverlayCompositor): The compositor drawing the cursor and the status text.
+        overlay_damage (list): The rectangles where the last drawn overlay may differ from the one before.
     """
 
     def __init__(self, frame_width, frame_height):
@@ -27,63 +44,230 @@ class FrameProcessor:
         """
         self.frame_width = frame_width
         self.frame_height = frame_height
-        self.cursor_image = cv2.imread('assets/cursor.png', cv2.IMREAD_UNCHANGED)  # Load the cursor image with alpha channel
+        self.cursor_image = cv2.imread(CURSOR_IMAGE_PATH, cv2.IMREAD_UNCHANGED)  # Load the cursor image with alpha channel
         self.cursor_image = imutils.resize(self.cursor_image, width=12)  # Resize the cursor image to a smaller size
         self.host_name = socket.gethostname()  # Get the hostname of the machine
+        self.compositor = OverlayCompositor(self.cursor_image, self.host_name)
+        self.screen_size = pyautogui.size() if pyautogui is not None else None  # Queried once, it rarely changes
+        self.overlay_damage = []
 
-    def draw_overlay(self, frame):
+    def draw_overlay(self, frame, screen_region=None):
         """
         Draw an overlay on the frame, including the cursor image, hostname, current time, and status message.
 
         Args:
             frame (np.ndarray): The frame to draw the overlay on.
+            screen_region (tuple, optional): The (x, y, width, height) rectangle of the desktop the frame shows,
+                or None for the whole screen. Defaults to None.
 
         Returns:
             np.ndarray: The frame with the overlay.
         """
+        self.overlay_damage = self.compositor.compose(frame, self._cursor_position(frame, screen_region))
+        return frame
+
+    def _cursor_position(self, frame, screen_region):
+        """
+        Get the cursor position in frame pixels.
+
+        Args:
+            frame (np.ndarray): The frame the cursor is drawn on.
+            screen_region (tuple): The rectangle of the desktop the frame shows, or None for the whole screen.
+
+        Returns:
+            tuple: The cursor position, or None if it can't be queried.
+        """
+        if self.screen_size is None:
+            return None
+        if screen_region is None:
+            screen_region = (0, 0, self.screen_size.width, self.screen_size.height)
+        region_x, region_y, region_width, region_height = screen_region
         cursor_x, cursor_y = pyautogui.position()  # Get the current cursor position
-        # Calculate the cursor position relative to the frame dimensions
-        cursor_pos = (int(cursor_x * self.frame_width / pyautogui.size().width),
-                      int(cursor_y * self.frame_height / pyautogui.size().height))
-        cursor_h, cursor_w, cursor_c = self.cursor_image.shape
-        x, y = cursor_pos
-
-        # Check if the cursor fits within the frame dimensions
-        if x + cursor_w <= frame.shape[1] and y + cursor_h <= frame.shape[0]:
-            alpha_cursor = self.cursor_image[:, :, 3] / 255.0  # Extract the alpha channel
-            alpha_inv = 1.0 - alpha_cursor  # Calculate the inverse alpha channel
-
-            # Overlay the cursor image on the frame
-            for c in range(0, 3):
-                frame[y:y + cursor_h, x:x + cursor_w, c] = (alpha_cursor * self.cursor_image[:, :, c] +
-                                                            alpha_inv * frame[y:y + cursor_h, x:x + cursor_w, c])
-
-        # Draw the hostname on the frame
-        cv2.putText(frame, self.host_name, (10, 30), cv2.QT_FONT_NORMAL, 0.75, (255, 255, 255), 1, cv2.LINE_AA)
-        current_time = time.strftime("%H:%M:%S")  # Get the current time
-        # Draw the current time on the frame
-        cv2.putText(frame, current_time, (10, 60), cv2.QT_FONT_NORMAL, 0.75, (255, 255, 255), 1, cv2.LINE_AA)
-        status_message = "Live"  # Define the status message
-        # Draw the status message on the frame
-        cv2.putText(frame, status_message, (10, 90), cv2.QT_FONT_NORMAL, 0.75, (0, 255, 0), 1, cv2.LINE_AA)
+        # Calculate the cursor position relative to the region and the frame dimensions
+        return (int((cursor_x - region_x) * frame.shape[1] / region_width),
+                int((cursor_y - region_y) * frame.shape[0] / region_height))
 
-        return frame
+    @classmethod
+    def estimate_motion(cls, old_image, new_image, regions=None):
+        """
+        Detect content that moved vertically or horizontally between two images, e.g. a scrolled
+        document, so the client can copy it instead of receiving its pixels again.
+
+        The lines of the changed rectangle are hashed, the shift most lines agree on is verified
+        pixel by pixel, and the longest run of lines moved by it becomes a copy.
+
+        Args:
+            old_image (np.ndarray): The previous frame of shape (height, width).
+            new_image (np.ndarray): The current frame of shape (height, width).
+            regions (list, optional): The (x, y, width, height) rectangles that may have changed, or None to
+                search the whole frames. Defaults to None.
+
+        Returns:
+            list: The (source x, source y, destination x, destination y, width, height) rectangles to copy
+                within old_image, empty if nothing moved.
+        """
+        rect = _changed_rect(old_image, new_image, regions)
+        if rect is None:
+            return []
+        left, top, right, bottom = rect
+        old_block = old_image[top:bottom, left:right]
+        new_block = new_image[top:bottom, left:right]
+
+        moved = _estimate_translation(old_block, new_block)
+        if moved is not None:
+            shift, start, end = moved
+            return [(left, top + start - shift, left, top + start, right - left, end - start)]
+        moved = _estimate_translation(old_block.T, new_block.T)  # Columns are the lines of the transposed blocks
+        if moved is not None:
+            shift, start, end = moved
+            return [(left + start - shift, top, left + start, top, end - start, bottom - top)]
+        return []
 
     @classmethod
-    def calculate_diff(cls, old_image, new_image):
+    def calculate_diff(cls, old_image, new_image, tile_size=tile_delta.TILE_SIZE, regions=None):
         """
-        Calculate the difference between two images.
+        Calculate the difference between two images as a list of dirty tiles.
 
         Args:
-            old_image (np.ndarray): The previous frame.
-            new_image (np.ndarray): The current frame.
+            old_image (np.ndarray): The previous frame of shape (height, width). Updated in place.
+            new_image (np.ndarray): The current frame of shape (height, width).
+            tile_size (int, optional): The tile edge length. Defaults to tile_delta.TILE_SIZE.
+            regions (list, optional): The (x, y, width, height) rectangles that may have changed, or None to
+                compare the whole frames. Defaults to None.
 
         Returns:
-            np.ndarray: The difference image with alpha channel for changed pixels.
+            np.ndarray: The indices of the tiles that changed.
         """
-        diff_image = np.zeros_like(old_image)
-        differences = old_image != new_image  # Find differences between the old and new images
-        diff_image[differences] = (0xFF000000 |
-                                   (new_image[differences] & 0x00FFFFFF))  # Mark differences with alpha channel
-        old_image[:] = new_image  # Update the old image with the new image
-        return diff_image
+        if regions is None:
+            dirty_tiles = tile_delta.find_dirty_tiles(old_image, new_image, tile_size)  # Find the changed tiles
+            old_image[:] = new_image  # Update the old image with the new image
+            return dirty_tiles
+
+        dirty_tiles = tile_delta.find_dirty_tiles_in_regions(old_image, new_image, regions, tile_size)
+        frame_height, frame_width = old_image.shape
+        for region in regions:
+            # Only the regions can differ, so only they need updating
+            left, top, right, bottom = tile_delta.region_tile_bounds(region, frame_width, frame_height, tile_size)
+            block = (slice(top * tile_size, bottom * tile_size), slice(left * tile_size, right * tile_size))
+            old_image[block] = new_image[block]
+        return dirty_tiles
+
+
+def _changed_rect(old_image, new_image, regions):
+    """
+    Find the bounding rectangle of the changed pixels on a sparse grid. Changes between the grid
+    points may be missed, which only makes the detected copies smaller.
+
+    Returns:
+        tuple: The left, top, right and bottom edge of the rectangle, or None if nothing changed.
+    """
+    frame_height, frame_width = old_image.shape
+    if regions is None:
+        left, top, right, bottom = 0, 0, frame_width, frame_height
+    elif regions:
+        left = max(min(x for x, _, _, _ in regions), 0)
+        top = max(min(y for _, y, _, _ in regions), 0)
+        right = min(max(x + width for x, _, width, _ in regions), frame_width)
+        bottom = min(max(y + height for _, y, _, height in regions), frame_height)
+    else:
+        return None
+    if left >= right or top >= bottom:
+        return None
+
+    step = MOTION_SAMPLE_STEP
+    changed = old_image[top:bottom:step, left:right:step] != new_image[top:bottom:step, left:right:step]
+    rows = np.flatnonzero(changed.any(axis=1))
+    if not len(rows):
+        return None
+    columns = np.flatnonzero(changed.any(axis=0))
+    first_row, last_row = top + int(rows[0]) * step, top + int(rows[-1]) * step
+    first_column, last_column = left + int(columns[0]) * step, left + int(columns[-1]) * step
+
+    # Widen the rectangle to the changes in the strips just outside the grid lines it ends on
+    rows = slice(max(first_row - step + 1, top), min(last_row + step, bottom))
+    strip = slice(max(first_column - step + 1, left), first_column)
+    changed = np.flatnonzero((old_image[rows, strip] != new_image[rows, strip]).any(axis=0))
+    first_column = strip.start + int(changed[0]) if len(changed) else first_column
+    strip = slice(last_column + 1, min(last_column + step, right))
+    changed = np.flatnonzero((old_image[rows, strip] != new_image[rows, strip]).any(axis=0))
+    last_column = strip.start + int(changed[-1]) if len(changed) else last_column
+
+    columns = slice(first_column, last_column + 1)
+    strip = slice(max(first_row - step + 1, top), first_row)
+    changed = np.flatnonzero((old_image[strip, columns] != new_image[strip, columns]).any(axis=1))
+    first_row = strip.start + int(changed[0]) if len(changed) else first_row
+    strip = slice(last_row + 1, min(last_row + step, bottom))
+    changed = np.flatnonzero((old_image[strip, columns] != new_image[strip, columns]).any(axis=1))
+    last_row = strip.start + int(changed[-1]) if len(changed) else last_row
+    return first_column, first_row, last_column + 1, last_row + 1
+
+def _line_hashes(block):
+    """
+    Hash each row of a block over up to MOTION_HASH_SAMPLES evenly spaced pixels.
+    """
+    step = max(1, block.shape[1] // MOTION_HASH_SAMPLES)  # A strided view, gathering columns is much slower
+    samples = block[:, ::step][:, :MOTION_HASH_SAMPLES]
+    return (samples * _HASH_WEIGHTS[:samples.shape[1]]).sum(axis=1, dtype=np.uint64)  # The products wrap around
+
+
+def _window_hashes(line_hashes):
+    """
+    Combine the hashes of every MOTION_WINDOW consecutive lines.
+    """
+    count = len(line_hashes) - MOTION_WINDOW + 1
+    windows = np.zeros(max(count, 0), dtype=np.uint64)
+    for offset in range(MOTION_WINDOW if count > 0 else 0):
+        windows += line_hashes[offset:offset + count] * _HASH_WEIGHTS[offset]
+    return windows
+
+
+def _dominant_shift(old_hashes, new_hashes):
+    """
+    Find the shift most lines moved by. Windows of lines vote for the shift between their old
+    and new position, if they occur once in the old block: blank areas are everywhere.
+
+    Returns:
+        int: The shift in lines towards the end of the block, 0 if no shift has MIN_MOTION_LINES votes.
+    """
+    old_hashes = _window_hashes(old_hashes)
+    new_hashes = _window_hashes(new_hashes)
+    if not len(old_hashes):
+        return 0
+    unique, first, counts = np.unique(old_hashes, return_index=True, return_counts=True)
+    positions = np.minimum(np.searchsorted(unique, new_hashes), len(unique) - 1)
+    matched = (unique[positions] == new_hashes) & (counts[positions] == 1)
+    shifts = np.flatnonzero(matched) - first[positions[matched]]
+    shifts = shifts[shifts != 0]
+    if len(shifts) < MIN_MOTION_LINES:
+        return 0
+    values, votes = np.unique(shifts, return_counts=True)
+    best = int(np.argmax(votes))
+    return int(values[best]) if votes[best] >= MIN_MOTION_LINES else 0
+
+
+def _estimate_translation(old_block, new_block):
+    """
+    Find the longest run of rows that moved by the same vertical shift between two blocks.
+
+    Returns:
+        tuple: The shift and the first and last row after the run in new_block, or None if too few rows moved.
+    """
+    old_hashes = _line_hashes(old_block)
+    new_hashes = _line_hashes(new_block)
+    shift = _dominant_shift(old_hashes, new_hashes)
+    if not shift:
+        return None
+
+    # Row y of the new block shows row y - shift of the old one
+    first, last = max(shift, 0), len(new_hashes) + min(shift, 0)
+    matching = new_hashes[first:last] == old_hashes[first - shift:last - shift]
+    edges = np.flatnonzero(np.diff(np.concatenate(([False], matching, [False])).astype(np.int8)))
+    runs = edges.reshape((-1, 2))
+    if not len(runs):
+        return None
+    start, end = runs[int(np.argmax(runs[:, 1] - runs[:, 0]))] + first
+    if end - start < MIN_MOTION_LINES:
+        return None
+    if not np.array_equal(new_block[start:end], old_block[start - shift:end - shift]):
+        return None  # Hash collision
+    return shift, int(start), int(end)
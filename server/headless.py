@@ -0,0 +1,110 @@
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # Make the shared "common" package importable
+
+from server_handler import ServerHandler
+from async_server import AsyncServerHandler
+from capture_backends import BACKENDS, SyntheticBackend, list_monitors, parse_region
+from common.datagrams import FEC_RATIO
+from common.pixel_formats import PIXEL_FORMATS
+from frame_pipeline import COMPRESSIONS
+from relay import parse_address
+from video_encoder import VIDEO_ENCODERS
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the screen sharing server without the GUI.")
+    parser.add_argument("--host", default="0.0.0.0", help="The host address to bind the server.")
+    parser.add_argument("--port", type=int, default=9998, help="The port number to bind the server.")
+    parser.add_argument("--width", type=int, default=1920, help="The width of the streamed frames.")
+    parser.add_argument("--height", type=int, default=1080, help="The height of the streamed frames.")
+    parser.add_argument("--fps", type=int, default=60, help="The frame rate limit.")
+    parser.add_argument("--capture", choices=list(BACKENDS), default="synthetic", help="The capture backend.")
+    parser.add_argument("--scene", choices=SyntheticBackend.SCENES, nargs="+", default=["typing"],
+                        help="The scene generated by the synthetic backend, one stream per scene.")
+    parser.add_argument("--replay", help="The .npy recording played back by the replay backend.")
+    parser.add_argument("--monitor", type=int, nargs="+", default=[1],
+                        help="The monitors captured by the dxcam and mss backends, one stream per monitor.")
+    parser.add_argument("--list-monitors", action="store_true", help="List the monitors of the backend and exit.")
+    parser.add_argument("--region", type=parse_region, help="The x,y,width,height region of the screen to capture.")
+    parser.add_argument("--window", help="The title of a window to capture, with the dxcam and mss backends.")
+    parser.add_argument("--encoder-workers", type=int, default=0,
+                        help="The number of encoder processes, 0 to encode in the server process.")
+    parser.add_argument("--target-latency", type=int, default=150,
+                        help="The latency target in milliseconds the stream quality adapts to, 0 to disable.")
+    parser.add_argument("--video-codec", choices=list(VIDEO_ENCODERS),
+                        help="The video codec to switch to while most of the frame changes, e.g. when playing videos.")
+    parser.add_argument("--video-mode", choices=["auto", "always"], default="auto",
+                        help="Switch to video by the change rate, or always send video.")
+    parser.add_argument("--no-motion", action="store_true",
+                        help="Send scrolled and moved content as tiles instead of copies.")
+    parser.add_argument("--keyframe-interval", type=float, default=10.0,
+                        help="The seconds between keyframes sent to all clients, 0 to disable.")
+    parser.add_argument("--pixel-format", choices=list(PIXEL_FORMATS), default="bgra32",
+                        help="The pixel format of the tiles, rgb565 and yuv420 are lossy.")
+    parser.add_argument("--no-tile-cache", action="store_true",
+                        help="Always send the pixels of dirty tiles, also the ones the clients have cached.")
+    parser.add_argument("--compression", choices=COMPRESSIONS, default="lz4",
+                        help="Compress every frame on its own, or with zstd referring to the frames sent before.")
+    parser.add_argument("--compression-level", type=int, default=1,
+                        help="The zstd level, negative levels are faster but compress less.")
+    parser.add_argument("--record", help="The directory to record the streams to, for auditing.")
+    parser.add_argument("--playback", help="The directory of a recording to stream instead of capturing.")
+    parser.add_argument("--playback-start", type=float, default=0.0,
+                        help="The seconds into the recording to start the playback at.")
+    parser.add_argument("--relay", type=parse_address, metavar="HOST:PORT",
+                        help="A server or relay whose streams to serve again as they are, instead of capturing.")
+    parser.add_argument("--udp", action="store_true",
+                        help="Let clients receive the frames over UDP, so lost packets don't hold up later frames.")
+    parser.add_argument("--fec-ratio", type=float, default=FEC_RATIO,
+                        help="The parity datagrams sent per data datagram over UDP, recovering lost ones.")
+    parser.add_argument("--server-mode", choices=["threads", "asyncio"], default="threads",
+                        help="Serve each client on a thread of its own, or all clients from one event loop.")
+    parser.add_argument("--max-clients", type=int, default=32, help="The most clients connected at once.")
+    parser.add_argument("--metrics-port", type=int, help="The port to serve Prometheus metrics on.")
+    parser.add_argument("--metrics-file", help="The JSON-lines file to append metrics snapshots to.")
+    return parser.parse_args()
+
+
+def capture_options(args):
+    """
+    Build the capture backend options from the command line arguments.
+
+    Args:
+        args (argparse.Namespace): The parsed arguments.
+
+    Returns:
+        tuple: The options shared by all streams and the options of each stream.
+    """
+    if args.capture == "synthetic":
+        # Every scene is a display of its own, with different content
+        return {"region": args.region}, [{"scene": scene, "seed": seed} for seed, scene in enumerate(args.scene)]
+    if args.capture == "replay":
+        if not args.replay:
+            sys.exit("--replay is required with --capture replay")
+        return {"path": args.replay, "region": args.region}, None
+    return {"region": args.region, "window": args.window}, [{"monitor": monitor} for monitor in args.monitor]
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.list_monitors:
+        for monitor, width, height in list_monitors(args.capture):
+            print(f"Monitor {monitor}: {width}x{height}")
+        sys.exit()
+
+    options, streams = capture_options(args)
+    handler_class = AsyncServerHandler if args.server_mode == "asyncio" else ServerHandler
+    server_handler = handler_class(args.host, args.port, args.width, args.height, args.fps, args.capture, options,
+                                   args.encoder_workers, args.target_latency / 1000 or None, args.metrics_port,
+                                   args.metrics_file, streams, args.video_codec, args.video_mode,
+                                   not args.no_motion, args.max_clients, args.keyframe_interval or None,
+                                   args.record, args.playback, args.playback_start, args.pixel_format,
+                                   not args.no_tile_cache, args.relay, args.compression, args.compression_level,
+                                   args.udp, args.fec_ratio)
+    try:
+        server_handler.start_server()
+    except KeyboardInterrupt:
+        server_handler.stop_server()
@@ -0,0 +1,97 @@
+import time
+
+MAX_CACHED_DELTAS = 120  # Most deltas replayed to a joining client, a fresh keyframe is cached after them
+MAX_CACHED_DELTA_RATIO = 4  # Most delta bytes replayed to a joining client per keyframe byte
+
+
+class KeyframeCache:
+    """
+    KeyframeCache keeps the last keyframe of a stream and the deltas encoded since, together
+    equal to the back buffer of the stream. Joining and resynchronizing clients receive them
+    right away, without waiting for a capture or encoding anything for them.
+
+    The deltas are kept until they add up to MAX_CACHED_DELTA_RATIO times the size of the keyframe
+    or MAX_CACHED_DELTAS, then a fresh keyframe replaces them. This bounds the memory of the cache
+    and what a joining client receives, while encoding at most one keyframe per few frames' worth
+    of deltas, even if every frame changes a lot.
+
+    Attributes:
+        keyframe (Packet): The cached keyframe, or None if the back buffer changed without packets, e.g. in video mode.
+        deltas (list): The delta packets encoded since the keyframe.
+        delta_bytes (int): The payload size of the deltas.
+        keyframe_time (float): The time.perf_counter() time the keyframe was cached.
+    """
+
+    def __init__(self):
+        self.keyframe = None
+        self.deltas = []
+        self.delta_bytes = 0
+        self.keyframe_time = time.perf_counter()
+
+    def reset(self, keyframe):
+        """
+        Cache a new keyframe, dropping the deltas before it.
+
+        Args:
+            keyframe (Packet): The keyframe.
+        """
+        self.keyframe = keyframe
+        self.deltas = []
+        self.delta_bytes = 0
+        self.keyframe_time = time.perf_counter()
+
+    def invalidate(self):
+        """
+        Drop the cached packets, the back buffer changed in a way they don't reproduce.
+        """
+        self.keyframe = None
+        self.deltas = []
+        self.delta_bytes = 0
+
+    def append(self, delta):
+        """
+        Log a delta applied to the back buffer after the keyframe.
+
+        Args:
+            delta (Packet): The delta.
+        """
+        self.deltas.append(delta)
+        self.delta_bytes += len(delta.payload)
+
+    def is_full(self):
+        """
+        Check whether a fresh keyframe should replace the cached packets.
+
+        Returns:
+            bool: True if a fresh keyframe should replace the cached packets.
+        """
+        return (len(self.deltas) >= MAX_CACHED_DELTAS or
+                self.delta_bytes >= MAX_CACHED_DELTA_RATIO * len(self.keyframe.payload))
+
+    def age(self):
+        """
+        Get the time since the keyframe was cached.
+
+        Returns:
+            float: The age of the keyframe in seconds.
+        """
+        return time.perf_counter() - self.keyframe_time
+
+    def packets(self, timestamp=None):
+        """
+        Get the packets synchronizing a client with the back buffer.
+
+        Given a timestamp, they carry it instead of their capture time, as clients echo it: the
+        latency of the link is measured from when they are sent, not from when they were captured.
+
+        Args:
+            timestamp (int, optional): The timestamp of the packets. Defaults to their capture time.
+
+        Returns:
+            tuple: The keyframe and the deltas since, or None if nothing is cached.
+        """
+        if self.keyframe is None:
+            return None
+        if timestamp is None:
+            return tuple([self.keyframe] + self.deltas)
+        return tuple(packet.with_timestamp(timestamp) for packet in [self.keyframe] + self.deltas)
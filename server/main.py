@@ -1,7 +1,15 @@
+import os
+import sys
 import tkinter as tk
 from tkinter import messagebox
 import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # Make the shared "common" package importable
+
 from server_handler import ServerHandler
+from async_server import AsyncServerHandler
+from capture_backends import list_monitors, parse_region
+from video_encoder import VIDEO_ENCODERS
 
 
 class ServerGUI:
@@ -45,13 +53,103 @@ class ServerGUI:
         self.height_entry.grid(row=4, column=1, padx=10, pady=5)
         self.height_entry.insert(0, "1080")
 
+        # Capture Backend
+        tk.Label(self.root, text="Capture:").grid(row=5, column=0, padx=10, pady=5)
+        self.backend_var = tk.StringVar(self.root, "dxcam")
+        tk.OptionMenu(self.root, self.backend_var, "dxcam", "mss", "synthetic").grid(row=5, column=1, padx=10, pady=5, sticky="ew")
+
+        # Monitors, comma separated, each one is streamed separately
+        tk.Label(self.root, text="Monitors:").grid(row=6, column=0, padx=10, pady=5)
+        self.monitor_entry = tk.Entry(self.root)
+        self.monitor_entry.grid(row=6, column=1, padx=10, pady=5)
+        self.monitor_entry.insert(0, "1")
+        tk.Button(self.root, text="List...", command=self.show_monitors).grid(row=6, column=2, padx=10, pady=5)
+
+        # Capture Region as x,y,width,height, empty for the whole monitor
+        tk.Label(self.root, text="Region (x,y,w,h):").grid(row=7, column=0, padx=10, pady=5)
+        self.region_entry = tk.Entry(self.root)
+        self.region_entry.grid(row=7, column=1, padx=10, pady=5)
+        tk.Button(self.root, text="Select...", command=self.select_region).grid(row=7, column=2, padx=10, pady=5)
+
+        # Window Title, captures that window instead of the region
+        tk.Label(self.root, text="Window Title:").grid(row=8, column=0, padx=10, pady=5)
+        self.window_entry = tk.Entry(self.root)
+        self.window_entry.grid(row=8, column=1, padx=10, pady=5)
+
+        # Encoder Processes
+        tk.Label(self.root, text="Encoder Processes:").grid(row=9, column=0, padx=10, pady=5)
+        self.workers_entry = tk.Entry(self.root)
+        self.workers_entry.grid(row=9, column=1, padx=10, pady=5)
+        self.workers_entry.insert(0, "0")
+
+        # Target Latency, 0 disables adapting the stream quality
+        tk.Label(self.root, text="Target Latency (ms):").grid(row=10, column=0, padx=10, pady=5)
+        self.latency_entry = tk.Entry(self.root)
+        self.latency_entry.grid(row=10, column=1, padx=10, pady=5)
+        self.latency_entry.insert(0, "150")
+
+        # Video Codec, streams switch to it while most of the frame changes
+        tk.Label(self.root, text="Video Codec:").grid(row=11, column=0, padx=10, pady=5)
+        self.video_codec_var = tk.StringVar(value="off")
+        tk.OptionMenu(self.root, self.video_codec_var, "off", *VIDEO_ENCODERS).grid(row=11, column=1, padx=10, pady=5, sticky="ew")
+
+        # Server Mode, a thread per client or all clients on one event loop
+        tk.Label(self.root, text="Server Mode:").grid(row=12, column=0, padx=10, pady=5)
+        self.server_mode_var = tk.StringVar(value="threads")
+        tk.OptionMenu(self.root, self.server_mode_var, "threads", "asyncio").grid(row=12, column=1, padx=10, pady=5, sticky="ew")
+
+        # Record To, the directory the streams are recorded to, empty to not record them
+        tk.Label(self.root, text="Record To:").grid(row=13, column=0, padx=10, pady=5)
+        self.record_entry = tk.Entry(self.root)
+        self.record_entry.grid(row=13, column=1, padx=10, pady=5)
+
         # Start Button
         self.start_button = tk.Button(self.root, text="Start Server", command=self.start_server)
-        self.start_button.grid(row=5, column=0, pady=10)
+        self.start_button.grid(row=14, column=0, pady=10)
 
         # Stop Button
         self.stop_button = tk.Button(self.root, text="Stop Server", command=self.stop_server, state=tk.DISABLED)
-        self.stop_button.grid(row=5, column=1, pady=10)
+        self.stop_button.grid(row=14, column=1, pady=10)
+
+    def show_monitors(self):
+        try:
+            monitors = list_monitors(self.backend_var.get())
+            messagebox.showinfo("Monitors", "\n".join(f"Monitor {monitor}: {width}x{height}"
+                                                       for monitor, width, height in monitors))
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to list monitors: {e}")
+
+    def select_region(self):
+        # Let the user drag a rectangle over a translucent full-screen window
+        overlay = tk.Toplevel(self.root)
+        overlay.attributes("-fullscreen", True)
+        overlay.attributes("-alpha", 0.3)
+        overlay.attributes("-topmost", True)
+        canvas = tk.Canvas(overlay, cursor="crosshair", bg="grey")
+        canvas.pack(fill=tk.BOTH, expand=True)
+        start = {}
+
+        def on_press(event):
+            start["x"], start["y"] = event.x_root, event.y_root
+            start["rect"] = canvas.create_rectangle(event.x, event.y, event.x, event.y, outline="red", width=2)
+
+        def on_drag(event):
+            canvas.coords(start["rect"], start["x"] - canvas.winfo_rootx(), start["y"] - canvas.winfo_rooty(),
+                          event.x, event.y)
+
+        def on_release(event):
+            left, top = min(start["x"], event.x_root), min(start["y"], event.y_root)
+            width, height = abs(event.x_root - start["x"]), abs(event.y_root - start["y"])
+            overlay.destroy()
+            if width and height:
+                self.region_entry.delete(0, tk.END)
+                self.region_entry.insert(0, f"{left},{top},{width},{height}")
+
+        canvas.bind("<ButtonPress-1>", on_press)
+        canvas.bind("<B1-Motion>", on_drag)
+        canvas.bind("<ButtonRelease-1>", on_release)
+        overlay.bind("<Escape>", lambda event: overlay.destroy())
+        overlay.focus_force()
 
     def start_server(self):
         if self.is_running:
@@ -63,9 +161,22 @@ class ServerGUI:
         frame_width = int(self.width_entry.get())
         frame_height = int(self.height_entry.get())
         frame_rate = int(self.fps_entry.get())
+        capture_backend = self.backend_var.get()
+        encoder_workers = int(self.workers_entry.get())
+        target_latency = int(self.latency_entry.get()) / 1000 or None
+        video_codec = None if self.video_codec_var.get() == "off" else self.video_codec_var.get()
+        record_path = self.record_entry.get() or None
 
         try:
-            self.server_handler = ServerHandler(host, port, frame_width, frame_height, frame_rate)
+            capture_options = {"region": parse_region(self.region_entry.get())}
+            streams = None
+            if capture_backend in ("dxcam", "mss"):
+                capture_options["window"] = self.window_entry.get() or None
+                streams = [{"monitor": int(monitor)} for monitor in self.monitor_entry.get().split(",")]
+            handler_class = AsyncServerHandler if self.server_mode_var.get() == "asyncio" else ServerHandler
+            self.server_handler = handler_class(host, port, frame_width, frame_height, frame_rate, capture_backend,
+                                                capture_options, encoder_workers, target_latency, streams=streams,
+                                                video_codec=video_codec, record_path=record_path)
             self.server_thread = threading.Thread(target=self.run_server)
             self.server_thread.start()
             self.is_running = True
@@ -0,0 +1,176 @@
+import time
+import numpy as np
+import cv2
+
+TEXT_FONT = cv2.QT_FONT_NORMAL
+TEXT_SCALE = 0.75
+TEXT_THICKNESS = 1
+
+
+class OverlaySprite:
+    """
+    OverlaySprite is a small BGRA image prepared for fast alpha blending: its color is stored
+    premultiplied by alpha, so blending takes one multiplication per channel in integer math.
+
+    Attributes:
+        color (np.ndarray): The (height, width, 3) uint16 premultiplied BGR color.
+        inverse_alpha (np.ndarray): The (height, width, 1) uint16 value of 255 - alpha.
+        width (int): The width of the sprite.
+        height (int): The height of the sprite.
+    """
+
+    def __init__(self, image):
+        """
+        Initializes the OverlaySprite from a BGRA image with straight alpha.
+
+        Args:
+            image (np.ndarray): The (height, width, 4) uint8 image.
+        """
+        alpha = image[..., 3:4].astype(np.uint16)
+        # Rounded down, so the blended sum never exceeds 255
+        self.color = image[..., :3].astype(np.uint16) * alpha // 255
+        self.inverse_alpha = 255 - alpha
+        self.height, self.width = image.shape[:2]
+
+    @classmethod
+    def from_text(cls, text, color):
+        """
+        Render a line of text into a sprite, the way cv2.putText would draw it.
+
+        Args:
+            text (str): The text to render.
+            color (tuple): The BGR text color.
+
+        Returns:
+            tuple: The sprite and the offset of its top left corner from the text origin.
+        """
+        (width, height), baseline = cv2.getTextSize(text, TEXT_FONT, TEXT_SCALE, TEXT_THICKNESS)
+        padding = 2  # Anti-aliasing bleeds a little beyond the text box
+        coverage = np.zeros((height + baseline + 2 * padding, width + 2 * padding), dtype=np.uint8)
+        cv2.putText(coverage, text, (padding, padding + height), TEXT_FONT, TEXT_SCALE, 255, TEXT_THICKNESS,
+                    cv2.LINE_AA)
+
+        image = np.empty(coverage.shape + (4,), dtype=np.uint8)
+        image[..., :3] = color
+        image[..., 3] = coverage
+        return cls(image), (-padding, -padding - height)
+
+    def blend(self, frame, x, y):
+        """
+        Blend the sprite onto a frame, clipped to the frame.
+
+        Args:
+            frame (np.ndarray): The (height, width, 3 or 4) uint8 frame, modified in place.
+            x (int): The left edge of the sprite in the frame.
+            y (int): The top edge of the sprite in the frame.
+
+        Returns:
+            tuple: The (x, y, width, height) rectangle of the frame that was touched, or None if none was.
+        """
+        frame_height, frame_width = frame.shape[:2]
+        left, top = max(x, 0), max(y, 0)
+        right, bottom = min(x + self.width, frame_width), min(y + self.height, frame_height)
+        if left >= right or top >= bottom:
+            return None
+
+        region = frame[top:bottom, left:right, :3]
+        sprite_rows = slice(top - y, bottom - y)
+        sprite_columns = slice(left - x, right - x)
+        # region * (255 - alpha) / 255, rounded exactly with integer math
+        blended = region.astype(np.uint16)
+        blended *= self.inverse_alpha[sprite_rows, sprite_columns]
+        blended += 128
+        blended += blended >> 8
+        blended >>= 8
+        blended += self.color[sprite_rows, sprite_columns]
+        region[:] = blended
+        return left, top, right - left, bottom - top
+
+
+class OverlayCompositor:
+    """
+    OverlayCompositor draws the cursor and the status text onto captured frames.
+
+    The sprites are prepared once: the cursor and the static text when the compositor is created,
+    the clock whenever its second changes. Blending only touches the sprites' rectangles, and
+    compose reports which rectangles may differ from the previous frame's overlay.
+
+    Attributes:
+        cursor (OverlaySprite): The cursor sprite, drawn with its top left corner at the cursor position.
+        text_sprites (list): The static text sprites and their positions.
+        clock_sprite (OverlaySprite): The sprite of the current time.
+    """
+
+    CLOCK_ORIGIN = (10, 60)
+
+    def __init__(self, cursor_image, host_name, status_message="Live"):
+        """
+        Initializes the OverlayCompositor with the given cursor image and texts.
+
+        Args:
+            cursor_image (np.ndarray): The BGRA cursor image.
+            host_name (str): The hostname drawn on the frames.
+            status_message (str, optional): The status drawn on the frames. Defaults to "Live".
+        """
+        self.cursor = OverlaySprite(cursor_image)
+        self.text_sprites = []
+        for text, origin, color in ((host_name, (10, 30), (255, 255, 255)), (status_message, (10, 90), (0, 255, 0))):
+            sprite, (dx, dy) = OverlaySprite.from_text(text, color)
+            self.text_sprites.append((sprite, origin[0] + dx, origin[1] + dy))
+
+        self.clock_second = None
+        self.clock_sprite = None
+        self.clock_position = None
+        self.last_clock_rect = None
+        self.last_cursor_rect = None
+        self.last_frame_shape = None
+
+    def _update_clock(self):
+        """
+        Re-render the clock sprite if the second changed.
+
+        Returns:
+            bool: True if the clock changed.
+        """
+        second = int(time.time())
+        if second == self.clock_second:
+            return False
+        self.clock_second = second
+        self.clock_sprite, (dx, dy) = OverlaySprite.from_text(time.strftime("%H:%M:%S", time.localtime(second)),
+                                                              (255, 255, 255))
+        self.clock_position = (self.CLOCK_ORIGIN[0] + dx, self.CLOCK_ORIGIN[1] + dy)
+        return True
+
+    def compose(self, frame, cursor_position=None):
+        """
+        Draw the overlay onto a frame.
+
+        Args:
+            frame (np.ndarray): The (height, width, 4) BGRA frame, modified in place.
+            cursor_position (tuple, optional): The cursor position in frame pixels, or None to not draw it.
+                Defaults to None.
+
+        Returns:
+            list: The (x, y, width, height) rectangles where the overlay may differ from the previous frame's.
+        """
+        changed_rects = []
+        first_frame = frame.shape != self.last_frame_shape
+        self.last_frame_shape = frame.shape
+
+        for sprite, x, y in self.text_sprites:
+            rect = sprite.blend(frame, x, y)
+            if first_frame and rect is not None:
+                changed_rects.append(rect)
+
+        clock_changed = self._update_clock()
+        clock_rect = self.clock_sprite.blend(frame, *self.clock_position)
+        if first_frame or clock_changed:
+            # The digits differ in width, so the old clock may reach further than the new one
+            changed_rects.extend(rect for rect in (self.last_clock_rect, clock_rect) if rect is not None)
+        self.last_clock_rect = clock_rect
+
+        cursor_rect = self.cursor.blend(frame, *cursor_position) if cursor_position is not None else None
+        if first_frame or cursor_rect != self.last_cursor_rect:
+            changed_rects.extend(rect for rect in (self.last_cursor_rect, cursor_rect) if rect is not None)
+        self.last_cursor_rect = cursor_rect
+        return changed_rects
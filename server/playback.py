@@ -0,0 +1,84 @@
+import time
+
+from common import protocol
+from stream_publisher import StreamPublisher
+
+
+class PlaybackPipeline(StreamPublisher):
+    """
+    PlaybackPipeline streams a stream of a recording to the clients in place of a capture, with the
+    timing it was recorded with. The recorded packets are sent as they are, nothing is encoded.
+
+    Clients joining during the playback are synchronized from the keyframe cache, like with a live
+    stream. The playback pauses while nobody is watching.
+
+    Attributes:
+        reader (RecordingReader): The recording.
+        start_timestamp (int): The timestamp the playback starts at, shared by the streams to keep them in sync.
+        start_position (tuple): The segment number and offset of the keyframe the playback starts at.
+        loop (bool): Whether to start over at the end of the recording.
+    """
+
+    def __init__(self, reader, stream_id, start_timestamp, loop=True):
+        """
+        Initializes the PlaybackPipeline for a recorded stream.
+
+        Args:
+            reader (RecordingReader): The recording.
+            stream_id (int): The id of the recorded stream.
+            start_timestamp (int): The timestamp to start at, in microseconds since the epoch. The playback
+                starts at the last keyframe before it.
+            loop (bool, optional): Whether to start over at the end of the recording. Defaults to True.
+
+        Raises:
+            ValueError: If the stream has no keyframes in the recording.
+        """
+        super().__init__(stream_id)
+        self.reader = reader
+        self.start_timestamp = start_timestamp
+        self.start_position = reader.seek(start_timestamp, stream_id)
+        self.loop = loop
+
+    def _run(self):
+        """
+        Publish the recorded packets at their recorded pace until stopped or the recording ends.
+        """
+        while self.running:
+            self._play(self.reader.packets(self.stream_id, self.start_position))  # Starting with a keyframe for everyone
+            if not self.loop:
+                break
+
+    def _play(self, packets):
+        """
+        Publish recorded packets at their recorded pace.
+
+        Args:
+            packets (iterator): The MessageHeader and payload of each recorded packet, starting with a keyframe.
+        """
+        start_time = time.perf_counter()
+        for header, payload in packets:
+            # Wait for the packet's time, the playback clock stands still while nobody is watching
+            sessions = self._active_sessions()
+            while self.running and (not sessions or
+                                    time.perf_counter() - start_time < (header.timestamp - self.start_timestamp) / 1e6):
+                if not sessions:
+                    self.clients_gauge.set(0)
+                    time.sleep(0.05)
+                    start_time += 0.05
+                else:
+                    time.sleep(min(0.05, (header.timestamp - self.start_timestamp) / 1e6 -
+                                   (time.perf_counter() - start_time)))
+                sessions = self._active_sessions()
+            if not self.running:
+                return
+
+            self.join_sessions(sessions)  # Up to the packet before, the packet follows
+            # Sent with the current time, which the clients echo to measure the latency
+            packet = protocol.Packet(header, payload).with_timestamp(protocol.timestamp_now())
+            if packet.keyframe:
+                self.keyframe_cache.reset(packet)
+            elif self.keyframe_cache.keyframe is not None:
+                self.keyframe_cache.append(packet)
+            for session in sessions:
+                session.publish(packet)  # Only keyframes reach the sessions waiting for one
+            self.clients_gauge.set(len(sessions))
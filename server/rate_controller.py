@@ -0,0 +1,200 @@
+import collections
+import threading
+import time
+
+from common import metrics, protocol
+
+# Quality steps from best to cheapest: share of the frame rate limit and scale of the stream resolution
+QUALITY_STEPS = ((1.0, 1.0), (0.5, 1.0), (0.5, 0.75), (0.25, 0.75), (0.25, 0.5), (0.125, 0.5))
+
+MAX_ACCELERATION = 64  # LZ4 acceleration of the cheapest codec level
+SMOOTHING = 0.2  # Weight of a new sample in the moving averages
+
+
+def _smooth(average, sample):
+    """
+    Update an exponential moving average.
+
+    Args:
+        average (float): The current average, or None before the first sample.
+        sample (float): The new sample.
+
+    Returns:
+        float: The updated average.
+    """
+    return sample if average is None else average + SMOOTHING * (sample - average)
+
+
+class LinkEstimator:
+    """
+    LinkEstimator tracks the state of the link to one client from the frames sent to it and the
+    acknowledgements it sends back.
+
+    The latency is measured from the capture timestamp echoed by the client, so it covers capturing,
+    encoding, queueing, the transfer, decoding and the way back of the acknowledgement, without
+    requiring synchronized clocks.
+
+    Attributes:
+        latency (float): The smoothed capture-to-acknowledgement latency in seconds, None before the first ack.
+        rtt (float): The smoothed round trip time in seconds, excluding the client's decode time.
+        throughput (float): The smoothed rate at which the client receives data, in bytes per second.
+        decode_time (float): The smoothed time the client needs to decode and apply a frame, in seconds.
+    """
+
+    def __init__(self):
+        self.latency = None
+        self.rtt = None
+        self.throughput = None
+        self.decode_time = None
+        self.outstanding = collections.deque()  # (frame id, capture timestamp, send time, size) of unacked frames
+        self.acked_bytes = 0
+        self.last_ack_time = None
+        self.lock = threading.Lock()
+        self.ack_latency = metrics.REGISTRY.histogram("server_ack_latency_seconds",
+                                                      "Time from capturing a frame to receiving its acknowledgement")
+
+    def on_sent(self, header):
+        """
+        Record a frame that was sent to the client.
+
+        Args:
+            header (MessageHeader): The header of the sent frame.
+        """
+        with self.lock:
+            self.outstanding.append((header.frame_id, header.timestamp, time.perf_counter(),
+                                     protocol.HEADER.size + header.payload_length))
+
+    def on_ack(self, frame_id, timestamp, decode_time):
+        """
+        Update the estimates with an acknowledgement.
+
+        Args:
+            frame_id (int): The id of the last frame the client applied.
+            timestamp (int): The capture timestamp of that frame, echoed by the client.
+            decode_time (float): The time the client needed to decode and apply it, in seconds.
+        """
+        now = time.perf_counter()
+        with self.lock:
+            acked = None
+            while self.outstanding and acked is None:
+                entry = self.outstanding.popleft()
+                self.acked_bytes += entry[3]
+                if entry[0] == frame_id:
+                    acked = entry
+            if acked is None:
+                return  # Not a frame sent on this link
+
+            latency = max(0.0, (protocol.timestamp_now() - timestamp) / 1e6)
+            self.ack_latency.observe(latency)
+            self.latency = _smooth(self.latency, latency)
+            self.rtt = _smooth(self.rtt, max(0.0, now - acked[2] - decode_time))
+            self.decode_time = _smooth(self.decode_time, decode_time)
+            if self.last_ack_time is not None and now > self.last_ack_time:
+                self.throughput = _smooth(self.throughput, self.acked_bytes / (now - self.last_ack_time))
+            self.acked_bytes = 0
+            self.last_ack_time = now
+
+    def current_latency(self):
+        """
+        Estimate the current latency, including frames the client has not acknowledged in time.
+
+        Returns:
+            float: The latency in seconds, or None if the client never acknowledged a frame.
+        """
+        with self.lock:
+            if self.latency is None:
+                return None
+            if not self.outstanding:
+                return self.latency
+            # Acks stop arriving when the link stalls, the oldest unacked frame then tells how far behind it is
+            oldest_age = (protocol.timestamp_now() - self.outstanding[0][1]) / 1e6 - protocol.ACK_INTERVAL
+            return max(self.latency, oldest_age)
+
+
+class RateController:
+    """
+    RateController adapts the frame rate, the stream resolution and the codec level so that the
+    latency of the slowest client stays below a target.
+
+    When the latency exceeds the target it steps down one quality step at a time, and steps back up
+    once the latency has stayed well below the target for a while. Independently, the codec level
+    gets cheaper when encoding can't keep up with the frame rate.
+
+    Attributes:
+        frame_rate (int): The frame rate limit.
+        target_latency (float): The latency target in seconds.
+        step (int): The current index in QUALITY_STEPS.
+        acceleration (int): The current LZ4 acceleration, 1 is the default codec level.
+    """
+
+    DOWN_HOLD = 0.5  # Seconds after a change before stepping down again
+    UP_HOLD = 2.0  # Seconds of low latency before stepping up again
+
+    def __init__(self, frame_rate, target_latency):
+        """
+        Initializes the RateController with the given frame rate limit and latency target.
+
+        Args:
+            frame_rate (int): The frame rate limit.
+            target_latency (float): The latency target in seconds.
+        """
+        self.frame_rate = frame_rate
+        self.target_latency = target_latency
+        self.step = 0
+        self.acceleration = 1
+        self.encode_time = None
+        self.last_change = time.perf_counter()
+        self.last_codec_change = self.last_change
+
+    @property
+    def fps(self):
+        """
+        float: The current frame rate.
+        """
+        return self.frame_rate * QUALITY_STEPS[self.step][0]
+
+    @property
+    def scale(self):
+        """
+        float: The current scale of the stream resolution.
+        """
+        return QUALITY_STEPS[self.step][1]
+
+    def update(self, latencies, encode_time):
+        """
+        Adapt the quality to the latest estimates.
+
+        Args:
+            latencies (list): The current latency of each client that acknowledges frames.
+            encode_time (float): The time the last frame took to capture and encode, in seconds.
+
+        Returns:
+            bool: True if the stream resolution changed.
+        """
+        now = time.perf_counter()
+        previous_scale = self.scale
+
+        latency = max(latencies) if latencies else None
+        if latency is not None:
+            if latency > self.target_latency:
+                if self.step < len(QUALITY_STEPS) - 1 and now - self.last_change > self.DOWN_HOLD:
+                    self.step += 1
+                    self.last_change = now
+            elif latency > self.target_latency / 2:
+                self.last_change = now  # Close to the target, stay at this step
+            elif self.step > 0 and now - self.last_change > self.UP_HOLD:
+                self.step -= 1
+                self.last_change = now
+
+        # Switch to a cheaper codec level when encoding takes most of the frame interval
+        self.encode_time = _smooth(self.encode_time, encode_time)
+        if now - self.last_codec_change > self.DOWN_HOLD:
+            frame_interval = 1.0 / self.fps
+            if self.encode_time > 0.8 * frame_interval and self.acceleration < MAX_ACCELERATION:
+                self.acceleration *= 2
+                self.last_codec_change = now
+            elif self.encode_time < 0.4 * frame_interval and self.acceleration > 1:
+                self.acceleration //= 2
+                self.last_codec_change = now
+
+        return self.scale != previous_scale
@@ -0,0 +1,294 @@
+import queue
+import socket
+import threading
+
+from common import metrics, protocol
+from stream_publisher import StreamPublisher
+
+JOIN_TIMEOUT = 2.0  # Seconds to wait for the receiver thread when closing the connection
+
+
+def parse_address(value):
+    """
+    Parse a host:port address given on the command line.
+
+    Args:
+        value (str): The address, e.g. "192.168.0.10:9998".
+
+    Returns:
+        tuple: The host and the port.
+
+    Raises:
+        ValueError: If the address has no valid port.
+    """
+    host, separator, port = value.rpartition(":")
+    if not separator or not host or not port.isdigit():
+        raise ValueError(f"Invalid address {value}, expected host:port")
+    return host, int(port)
+
+
+def _follows(frame_id, previous_id):
+    """
+    Check whether a frame id comes after another one, allowing for the ids wrapping around.
+
+    Args:
+        frame_id (int): The frame id.
+        previous_id (int): The frame id to compare to.
+
+    Returns:
+        bool: True if frame_id is later than previous_id.
+    """
+    return 0 < (frame_id - previous_id) & 0xFFFFFFFF < 0x80000000
+
+
+class RelayConnection:
+    """
+    RelayConnection receives the streams of an upstream server like a client, for a relay to
+    serve them again to clients of its own. Relays connect to relays in turn, so a tree of them
+    fans a stream out to many clients while the source sends it once.
+
+    The packets are passed on as they were received, nothing is decoded. The connection subscribes
+    to all streams without the tile cache, as the relay's clients join at different times and
+    don't hold the tiles the upstream server refers to. Received frames are acknowledged right
+    away, so the upstream server adapts the streams to the link of the relay.
+
+    Attributes:
+        host (str): The host address of the upstream server.
+        port (int): The port number of the upstream server.
+        client_socket (socket.socket): The socket connected to the upstream server.
+        streams (dict): The width and height of each stream by stream id, announced by the upstream server.
+        pipelines (dict): The RelayPipeline of each stream by stream id, the received packets are passed to.
+        active (bool): Whether the connection receives packets.
+        on_close (callable): Called without arguments once the upstream server disconnected, or None.
+    """
+
+    def __init__(self, host, port):
+        """
+        Initializes the RelayConnection, connecting to the upstream server and receiving its streams.
+
+        Args:
+            host (str): The host address of the upstream server.
+            port (int): The port number of the upstream server.
+
+        Raises:
+            ProtocolError: If the upstream server did not start with a hello message.
+        """
+        self.host = host
+        self.port = port
+        self.client_socket = socket.create_connection((host, port))
+        self.client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Don't delay acknowledgements
+        self.header_buffer = bytearray(protocol.HEADER.size)
+        self.streams = self._receive_hello()
+        self.max_payload_length = max(2 * 4 * width * height for width, height in self.streams.values()) + 65536
+        self.pipelines = {}
+        self.active = False
+        self.on_close = None
+        self.send_lock = threading.Lock()  # Acknowledgements and keyframe requests are sent from several threads
+        self.thread = None
+        self.received_bytes_total = metrics.REGISTRY.counter("relay_received_bytes_total",
+                                                             "Bytes received from the upstream server")
+
+    def _receive_hello(self):
+        """
+        Receive the hello message of the upstream server.
+
+        Returns:
+            dict: The width and height of each stream by stream id.
+
+        Raises:
+            ProtocolError: If the upstream server did not start with a hello message.
+        """
+        header = protocol.recv_header(self.client_socket, self.header_buffer)
+        if header is None or header.msg_type != protocol.MSG_HELLO:
+            raise protocol.ProtocolError("Expected a hello message from the upstream server")
+        if header.payload_length > 256 * protocol.STREAM_INFO.size:
+            raise protocol.ProtocolError("Hello message is too large")
+        payload = protocol.recv_exact(self.client_socket, header.payload_length)
+        if payload is None:
+            raise protocol.ProtocolError("Connection closed during the hello message")
+        return protocol.unpack_streams(payload)
+
+    def start(self, pipelines, on_close=None):
+        """
+        Subscribe to the streams of the pipelines and start passing them the received packets.
+
+        Args:
+            pipelines (list): The RelayPipeline of each stream to receive.
+            on_close (callable, optional): Called once the upstream server disconnected. Defaults to None.
+        """
+        self.pipelines = {pipeline.stream_id: pipeline for pipeline in pipelines}
+        self.on_close = on_close
+        self.active = True
+        payload = bytes(sorted(self.pipelines))
+        header = protocol.MessageHeader(protocol.MSG_SUBSCRIBE, flags=protocol.FLAG_NO_TILE_CACHE,
+                                        payload_length=len(payload))
+        self._send(header, payload)
+        self.thread = threading.Thread(target=self._receive_packets, daemon=True)
+        self.thread.start()
+
+    def request_keyframe(self, stream_id):
+        """
+        Ask the upstream server to resynchronize the relay with a keyframe of a stream.
+
+        Args:
+            stream_id (int): The stream id.
+        """
+        self._send(protocol.MessageHeader(protocol.MSG_KEYFRAME_REQUEST, stream_id=stream_id))
+
+    def _send(self, header, payload=b''):
+        """
+        Send a message to the upstream server, from any thread.
+
+        Args:
+            header (MessageHeader): The header of the message.
+            payload (bytes-like, optional): The payload of the message. Defaults to b''.
+        """
+        try:
+            with self.send_lock:
+                protocol.send_message(self.client_socket, header.pack(), payload)
+        except OSError as e:
+            if self.active:  # The receiver thread notices the lost connection too
+                print(f"Sending to the upstream server {self.host}:{self.port} failed: {e}")
+
+    def _receive_packets(self):
+        """
+        Receive packets and pass them to the pipeline of their stream until the connection is closed.
+        """
+        try:
+            while self.active:
+                header = protocol.recv_header(self.client_socket, self.header_buffer)
+                if header is None:
+                    break
+                if header.msg_type != protocol.MSG_FRAME:
+                    raise protocol.ProtocolError(f"Unexpected message type {header.msg_type}")
+                if header.payload_length > self.max_payload_length:
+                    raise protocol.ProtocolError(f"Payload of {header.payload_length} bytes is too large")
+                payload = protocol.recv_exact(self.client_socket, header.payload_length)  # Owned by the packet
+                if payload is None:
+                    break
+                self.received_bytes_total.inc(protocol.HEADER.size + header.payload_length)
+                pipeline = self.pipelines.get(header.stream_id)
+                if pipeline is None:
+                    continue
+                pipeline.put(protocol.Packet(header, payload))
+                ack = protocol.MessageHeader(protocol.MSG_ACK, frame_id=header.frame_id, timestamp=header.timestamp,
+                                             payload_length=protocol.ACK_PAYLOAD.size, stream_id=header.stream_id)
+                self._send(ack, protocol.ACK_PAYLOAD.pack(0))  # Nothing is decoded
+        except (OSError, protocol.ProtocolError) as e:
+            if self.active:
+                print(f"Stopped receiving from the upstream server {self.host}:{self.port}: {e}")
+        finally:
+            closed = self.active
+            self.active = False
+            for pipeline in self.pipelines.values():
+                pipeline.put(None)  # Ends the stream
+            if closed and self.on_close is not None:
+                self.on_close()
+
+    def close(self):
+        """
+        Close the connection to the upstream server.
+        """
+        self.active = False
+        try:
+            self.client_socket.shutdown(socket.SHUT_RDWR)  # Unblocks the receiver thread
+        except OSError:
+            pass  # Not connected anymore
+        self.client_socket.close()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(JOIN_TIMEOUT)
+
+
+class RelayPipeline(StreamPublisher):
+    """
+    RelayPipeline serves a stream received by a RelayConnection to the relay's clients, in place
+    of a capture. The packets are published as they were received, nothing is encoded.
+
+    Clients joining or falling behind are synchronized from the keyframe cache, like with a live
+    stream. Once the cache is full, the relay asks the upstream server for a keyframe instead of
+    encoding one: the upstream server replays its own keyframe cache, which ends with the frame
+    the relay's clients already have. Packets the clients already received are only cached, the
+    clients waiting for a keyframe join once the cache reproduces that frame again.
+
+    Attributes:
+        connection (RelayConnection): The connection to the upstream server.
+        packets (queue.Queue): The received packets waiting to be published, None once the upstream server
+            disconnected.
+        forwarded_frame_id (int): The id of the last frame published to the clients, or None.
+        cached_frame_id (int): The id of the last frame in the keyframe cache, or None.
+        keyframe_requested (bool): Whether a keyframe was requested from the upstream server and not received yet.
+    """
+
+    def __init__(self, connection, stream_id):
+        """
+        Initializes the RelayPipeline for a stream of the upstream server.
+
+        Args:
+            connection (RelayConnection): The connection to the upstream server.
+            stream_id (int): The id of the stream.
+        """
+        super().__init__(stream_id)
+        self.connection = connection
+        self.packets = queue.Queue()  # Publishing never blocks, so it keeps up with the connection
+        self.forwarded_frame_id = None
+        self.cached_frame_id = None
+        self.keyframe_requested = False
+        self.keyframe_requests_total = metrics.REGISTRY.counter("relay_keyframe_requests_total",
+                                                                "Keyframes requested from the upstream server",
+                                                                stream=str(stream_id))
+
+    def put(self, packet):
+        """
+        Queue a received packet for publishing, from the receiver thread.
+
+        Args:
+            packet (Packet): The received packet, or None once the upstream server disconnected.
+        """
+        self.packets.put(packet)
+
+    def _run(self):
+        """
+        Publish the received packets until stopped or the upstream server disconnected.
+        """
+        while self.running:
+            try:
+                packet = self.packets.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if packet is None:
+                self.close_sessions()  # Clients of relays further down disconnect in turn
+                break
+            self.relay(packet)
+
+    def relay(self, packet):
+        """
+        Cache a received packet and publish it to the clients that don't have it yet.
+
+        Args:
+            packet (Packet): The received packet.
+        """
+        sessions = self._active_sessions()
+        frame_id = packet.header.frame_id
+        # Sent with the current time, which the clients echo to measure the latency of their link to the relay
+        packet = packet.with_timestamp(protocol.timestamp_now())
+        cache = self.keyframe_cache
+        if packet.keyframe:
+            cache.reset(packet)
+            self.keyframe_requested = False
+        elif cache.keyframe is not None:
+            if not self.keyframe_requested and cache.is_full():
+                # Checked before appending like the upstream server does, which then just replaced its cached
+                # packets with a fresh keyframe and replays it, without a keyframe reaching the relay's clients
+                self.keyframe_requested = True
+                self.keyframe_requests_total.inc()
+                self.connection.request_keyframe(self.stream_id)
+            cache.append(packet)
+        self.cached_frame_id = frame_id
+
+        if self.forwarded_frame_id is None or _follows(frame_id, self.forwarded_frame_id):
+            self.forwarded_frame_id = frame_id
+            for session in sessions:
+                session.publish(packet)  # Only keyframes reach the sessions waiting for one
+        if self.cached_frame_id == self.forwarded_frame_id:  # Not in the middle of a replayed cache
+            self.join_sessions(sessions)
+        self.clients_gauge.set(len(sessions))
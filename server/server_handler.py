@@ -1,13 +1,19 @@
 import socket
-import pickle
 import threading
-import time
-import lz4.frame
-import numpy as np
-import cv2
 
 from camera_handler import CameraHandler
 from frame_processor import FrameProcessor
+from frame_pipeline import FramePipeline
+from client_session import ClientSession
+from datagram_transport import DatagramTransport
+from playback import PlaybackPipeline
+from relay import RelayConnection, RelayPipeline
+from session_recorder import SessionRecorder
+from common import datagrams, metrics, protocol
+from common.recording import RecordingReader
+
+ACCEPT_TIMEOUT = 0.5  # Seconds between checks whether the server was stopped while waiting for clients
+JOIN_TIMEOUT = 2.0  # Seconds to wait for a client thread when stopping
 
 
 class ServerHandler:
@@ -20,11 +26,27 @@ class ServerHandler:
         port (int): The port number to bind the server.
         frame_width (int): The width of the frames.
         frame_height (int): The height of the frames.
-        camera_handler (CameraHandler): The handler for capturing frames from the camera.
-        frame_processor (FrameProcessor): The handler for processing frames.
+        camera_handlers (list): The handler capturing each stream, e.g. one per monitor.
+        frame_processors (list): The handler processing the frames of each stream.
+        frame_pipelines (list): The producer stage of each stream, shared by all clients. The index of a
+            pipeline is its stream id.
+        streams (dict): The largest width and height of each stream by stream id.
+        record_path (str): The directory the streams are recorded to, or None.
+        recorder (SessionRecorder): The recorder while the server runs, or None.
+        recording_reader (RecordingReader): The recording played back instead of capturing, or None.
+        relay_connection (RelayConnection): The connection to the upstream server relayed instead of capturing,
+            or None.
+        datagram_transport (DatagramTransport): Sends the frames over UDP to the clients asking for it, or None.
+        max_clients (int): The most clients connected at once, further connections are refused.
+        client_threads (list): The threads handling the connected clients.
     """
 
-    def __init__(self, host, port, frame_width, frame_height, frame_rate=60):
+    def __init__(self, host, port, frame_width, frame_height, frame_rate=60, capture_backend="dxcam",
+                 capture_options=None, encoder_workers=0, target_latency=None, metrics_port=None, metrics_file=None,
+                 streams=None, video_codec=None, video_mode="auto", detect_motion=True, max_clients=32,
+                 keyframe_interval=10.0, record_path=None, playback_path=None, playback_start=0.0,
+                 pixel_format="bgra32", tile_cache=True, relay_address=None, compression="lz4", compression_level=1,
+                 udp=False, fec_ratio=datagrams.FEC_RATIO):
         """
         Initializes the ServerHandler with the given host, port, frame width, and frame height.
 
@@ -33,104 +55,223 @@ class ServerHandler:
             port (int): The port number to bind the server.
             frame_width (int): The width of the frames to be processed.
             frame_height (int): The height of the frames to be processed.
+            frame_rate (int, optional): The frame rate limit. Defaults to 60.
+            capture_backend (str, optional): The name of the capture backend. Defaults to "dxcam".
+            capture_options (dict, optional): Options for the capture backend. Defaults to None.
+            encoder_workers (int, optional): The number of encoder processes, 0 to encode in the server process.
+                Defaults to 0.
+            target_latency (float, optional): The latency target in seconds the stream quality adapts to,
+                or None to always stream at full quality. Defaults to None.
+            metrics_port (int, optional): The port to serve Prometheus metrics on. Defaults to None.
+            metrics_file (str, optional): The JSON-lines file to write metrics snapshots to. Defaults to None.
+            streams (list, optional): The capture options of each stream, added to capture_options, e.g.
+                [{"monitor": 1}, {"monitor": 2}]. Defaults to a single stream.
+            video_codec (str, optional): The video codec streams switch to while most of the frame changes,
+                "h264", "vp8" or "vp9", or None to always send lossless tile deltas. Defaults to None.
+            video_mode (str, optional): "auto" to switch by the change rate, "always" to always send video.
+                Defaults to "auto".
+            detect_motion (bool, optional): Whether to send moved content, e.g. when scrolling, as copies of
+                rectangles the client already has. Defaults to True.
+            max_clients (int, optional): The most clients connected at once. Defaults to 32.
+            keyframe_interval (float, optional): The seconds between keyframes sent to all clients, which
+                recover clients whose frame got out of sync, or None to disable them. Defaults to 10.0.
+            record_path (str, optional): The directory to record the streams to, or None to not record them.
+                Defaults to None.
+            playback_path (str, optional): The directory of a recording to stream instead of capturing, or None.
+                Defaults to None.
+            playback_start (float, optional): The seconds into the recording to start the playback at.
+                Defaults to 0.0.
+            pixel_format (str, optional): The pixel format of the tile deltas, "bgra32", or "bgr24", "rgb565"
+                or "yuv420" to send fewer bytes per pixel. Defaults to "bgra32".
+            tile_cache (bool, optional): Whether to send dirty tiles the clients have received before, e.g. when
+                switching windows, as references to the clients' tile cache. Defaults to True.
+            relay_address (tuple, optional): The host and port of a server, or another relay, whose streams to serve
+                instead of capturing, as they are received. Defaults to None.
+            compression (str, optional): "lz4" to compress every keyframe and delta on its own, or "zstd" to
+                compress the deltas referring to the ones sent before. Defaults to "lz4".
+            compression_level (int, optional): The zstd level, negative levels are faster. Defaults to 1.
+            udp (bool, optional): Whether clients may receive the frames over UDP on the server's port, which
+                doesn't hold up later frames when packets are lost. Defaults to False.
+            fec_ratio (float, optional): The parity datagrams sent per data datagram over UDP, which recover lost
+                datagrams without waiting for them to be sent again. Defaults to datagrams.FEC_RATIO.
+
+        Raises:
+            ValueError: If both a recording and a server to relay are given, or the recording holds no keyframes.
         """
         self.host = host
         self.port = port
         self.frame_width = frame_width
         self.frame_height = frame_height
-        self.camera_handler = CameraHandler(frame_width, frame_height, frame_rate)
-        self.frame_processor = FrameProcessor(frame_width, frame_height)
+        self.camera_handlers = []
+        self.frame_processors = []
+        self.frame_pipelines = []
+        self.recording_reader = None
+        self.relay_connection = None
+        if playback_path is not None and relay_address is not None:
+            raise ValueError("A recording can't be played back by a relay")
+        if relay_address is not None:
+            # The streams are received once and served to this server's clients as they are
+            self.relay_connection = RelayConnection(*relay_address)
+            self.streams = self.relay_connection.streams
+            self.frame_width = max(width for width, _ in self.streams.values())
+            self.frame_height = max(height for _, height in self.streams.values())
+            self.frame_pipelines = [RelayPipeline(self.relay_connection, stream_id)
+                                    for stream_id in sorted(self.streams)]
+        elif playback_path is not None:
+            # Every recorded stream is played back from its last keyframe before the start, in sync
+            self.recording_reader = RecordingReader(playback_path)
+            if not len(self.recording_reader.index):
+                raise ValueError(f"{playback_path} holds no keyframes")
+            start_timestamp = int(self.recording_reader.index['timestamp'].min()) + int(playback_start * 1e6)
+            self.streams = self.recording_reader.streams
+            self.frame_width = max(width for width, _ in self.streams.values())
+            self.frame_height = max(height for _, height in self.streams.values())
+            self.frame_pipelines = [PlaybackPipeline(self.recording_reader, stream_id, start_timestamp)
+                                    for stream_id in sorted(self.streams)]
+        else:
+            self.streams = {stream_id: (frame_width, frame_height) for stream_id in range(len(streams or [{}]))}
+            for stream_id, stream_options in enumerate(streams or [{}]):
+                # Every stream has its own capture, back buffer, diff state and rate control
+                camera_handler = CameraHandler(frame_width, frame_height, frame_rate, capture_backend,
+                                               dict(capture_options or {}, **stream_options))
+                frame_processor = FrameProcessor(frame_width, frame_height)
+                self.camera_handlers.append(camera_handler)
+                self.frame_processors.append(frame_processor)
+                self.frame_pipelines.append(FramePipeline(camera_handler, frame_processor, frame_width, frame_height,
+                                                          encoder_workers, frame_rate, target_latency, stream_id,
+                                                          video_codec, video_mode, detect_motion, keyframe_interval,
+                                                          pixel_format, tile_cache, compression, compression_level))
+        self.datagram_transport = DatagramTransport(host, port, fec_ratio) if udp else None
+        self.max_clients = max_clients
+        self.record_path = record_path
+        self.recorder = None
+        self.metrics_port = metrics_port
+        self.metrics_file = metrics_file
+        self.metrics_exporters = []
         self.server_socket = None
         self.running = False
         self.client_threads = []
 
-    def send_frame(self, client_socket, frame):
+    def hello_packet(self):
         """
-        Compress and send a frame to the client.
+        Build the hello message announcing the streams and their resolution. Frames may be downscaled
+        later on, but never exceed this resolution.
 
-        Args:
-            client_socket (socket.socket): The client socket to send the frame to.
-            frame (np.ndarray): The frame to send.
+        Returns:
+            Packet: The hello message.
         """
-        data_to_send = pickle.dumps(frame)  # Serialize the frame
-        compressed_data = lz4.frame.compress(data_to_send)  # Compress the serialized frame
-        client_socket.sendall(len(compressed_data).to_bytes(4, 'big') + compressed_data)  # Send the size and data
+        return protocol.hello_packet(self.streams, protocol.FLAG_DATAGRAMS if self.datagram_transport else 0)
 
-    def send_resolution(self, client_socket):
-        width = self.frame_width
-        height = self.frame_height
-        resolution_message = f"{width}x{height}"
-        client_socket.sendall(resolution_message.encode())
+    def send_hello(self, client_socket):
+        """
+        Send the hello message announcing the streams and their resolution to the client.
 
-    def handle_client(self, client_socket):
+        Args:
+            client_socket (socket.socket): The client socket.
+        """
+        hello = self.hello_packet()
+        protocol.send_message(client_socket, hello.header_bytes, hello.payload)
+
+    def handle_client(self, client_socket, client_address):
         """
-        Handle the client connection, capturing and sending frames.
+        Handle the client connection, sending it the frames published by the frame pipeline.
 
         Args:
             client_socket (socket.socket): The client socket.
+            client_address (tuple): The address of the client.
         """
+        session = ClientSession(client_socket, client_address, datagram_transport=self.datagram_transport)
         try:
-            self.send_resolution(client_socket)
-            back_buffer = np.zeros((self.frame_height * self.frame_width,), dtype=np.uint32)
-            first_frame_sent = False
-            frame_count = 0
-            start_time = time.time()
-
-            while self.running:
-                frame = self.camera_handler.grab_frame()  # Capture a frame from the camera
-                if frame is None:
-                    continue
+            self.send_hello(client_socket)
+            for frame_pipeline in self.frame_pipelines:
+                frame_pipeline.add_session(session)  # It only publishes the streams the client subscribes to
+            session.run()  # Send queued packets until the client disconnects
+        except Exception as e:
+            print(f"An error occurred: {e}")
+        finally:
+            for frame_pipeline in self.frame_pipelines:
+                frame_pipeline.remove_session(session)
+            session.close()
 
-                frame = self.frame_processor.draw_overlay(frame)  # Draw overlay on the frame
-                frame = np.array(frame)
-                frame = cv2.resize(frame, (self.frame_width, self.frame_height))  # Resize the frame
-                frame = frame.view(np.uint32).reshape((self.frame_height * self.frame_width,))
+    def start_streaming(self):
+        """
+        Start the metrics exporters, the recorder and the frame pipelines.
+        """
+        self.running = True
+        self.metrics_exporters = metrics.start_exporters(port=self.metrics_port, path=self.metrics_file)
+        if self.record_path is not None:
+            self.recorder = SessionRecorder(self.record_path, self.streams)
+            self.recorder.start()
+            for frame_pipeline in self.frame_pipelines:
+                frame_pipeline.add_session(self.recorder)  # Published to like any client
+        for frame_pipeline in self.frame_pipelines:
+            frame_pipeline.start()
+        if self.relay_connection is not None:
+            self.relay_connection.start(self.frame_pipelines, on_close=self.upstream_closed)
 
-                if not first_frame_sent:
-                    self.send_frame(client_socket, frame)  # Send the first frame
-                    first_frame_sent = True
-                    back_buffer = frame.copy()
-                    continue
+    def upstream_closed(self):
+        """
+        Stop serving clients once the upstream server of a relay disconnected, called from the relay connection.
+        """
+        print("The upstream server disconnected.")
+        self.running = False
 
-                diff_buffer = self.frame_processor.calculate_diff(back_buffer, frame)  # Calculate the difference
-                self.send_frame(client_socket, diff_buffer)  # Send the difference frame
+    def stop_streaming(self):
+        """
+        Stop the frame pipelines, close the client sessions and release the captures and exporters.
+        """
+        if self.relay_connection is not None:
+            self.relay_connection.close()
+        for frame_pipeline in self.frame_pipelines:
+            frame_pipeline.stop()
+        for frame_pipeline in self.frame_pipelines:
+            frame_pipeline.close_sessions()  # Unblocks the client threads and finishes the recording
+        self.recorder = None
+        if self.recording_reader is not None:
+            self.recording_reader.close()
 
-                frame_count += 1
-                elapsed_time = time.time() - start_time
-                if elapsed_time > 1.0:
-                    fps = frame_count / elapsed_time  # Calculate FPS
-                    print(f"FPS: {fps:.2f}")
-                    frame_count = 0
-                    start_time = time.time()
+        for camera_handler in self.camera_handlers:
+            camera_handler.stop_camera()  # Stop the camera
 
-        except Exception as e:
-            print(f"An error occurred: {e}")
-        finally:
-            self.camera_handler.stop_camera()  # Stop the camera
-            client_socket.close()
-            cv2.destroyAllWindows()
+        for exporter in self.metrics_exporters:
+            exporter.close()
+        self.metrics_exporters = []
 
     def start_server(self):
         """
-        Start the server to listen for incoming client connections.
+        Start the server to listen for incoming client connections, handling each client on a thread of its own.
         """
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(1)
+        self.server_socket.listen(self.max_clients)
+        self.server_socket.settimeout(ACCEPT_TIMEOUT)  # accept() doesn't return when the socket is closed
         print(f"Server is listening on port {self.port}...")
+        if self.datagram_transport is not None:
+            self.datagram_transport.start()  # On the same port for UDP
 
-        self.running = True
-
+        self.start_streaming()
         try:
             while self.running:
-                client_socket, client_address = self.server_socket.accept()  # Accept a new client connection
+                try:
+                    client_socket, client_address = self.server_socket.accept()  # Accept a new client connection
+                except socket.timeout:
+                    continue
+                client_socket.settimeout(None)
+                self.client_threads = [thread for thread in self.client_threads if thread.is_alive()]
+                if len(self.client_threads) >= self.max_clients:
+                    print(f"Refused connection from {client_address}: {self.max_clients} clients connected.")
+                    client_socket.close()
+                    continue
                 print(f"Connection from {client_address} established.")
-                client_thread = threading.Thread(target=self.handle_client, args=(client_socket,))
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Don't delay small packets
+                client_thread = threading.Thread(target=self.handle_client, args=(client_socket, client_address),
+                                                 daemon=True)
                 self.client_threads.append(client_thread)
                 client_thread.start()  # Handle client in a new thread
         except Exception as e:
-            print(f"An error occurred: {e}")
+            if self.running:  # Closing the socket in stop_server() ends accept() with an error
+                print(f"An error occurred: {e}")
         finally:
             self.server_socket.close()
             self.running = False
@@ -143,8 +284,13 @@ class ServerHandler:
         if self.server_socket:
             self.server_socket.close()
 
-        # Wait for all client threads to finish
+        self.stop_streaming()
+        if self.datagram_transport is not None:
+            self.datagram_transport.close()
+
+        # Wait for all client threads to finish, closing their sessions unblocked their sends
         for thread in self.client_threads:
-            thread.join()
+            thread.join(JOIN_TIMEOUT)
+        self.client_threads = []
 
         print("Server has been stopped.")
@@ -0,0 +1,107 @@
+import queue
+import threading
+
+from client_session import ClientSession
+from common import metrics
+from common.recording import SEGMENT_SIZE, RecordingWriter
+
+JOIN_TIMEOUT = 5.0  # Seconds to wait for the queued packets to be written when the recording stops
+
+
+class SessionRecorder(ClientSession):
+    """
+    SessionRecorder records the streams to disk for auditing, as a client session of its own.
+
+    The frame pipelines publish packets to it like to any client and a writer thread appends them
+    to the recording, so the pipelines never wait for the disk. If the disk falls behind, the
+    queued packets are dropped and the recording continues with the next keyframes, like a client
+    that fell behind. Every segment starts with a keyframe of each stream.
+
+    Attributes:
+        writer (RecordingWriter): The recording the packets are appended to.
+        thread (threading.Thread): The writer thread.
+    """
+
+    echoes_timestamps = False  # Packets are recorded with their capture time, also when joining from the cache
+    uses_tile_cache = False  # Every keyframe of the recording has to be a starting point for playing it back
+
+    def __init__(self, path, streams, queue_size=64, segment_size=SEGMENT_SIZE):
+        """
+        Initializes the SessionRecorder, recording all the given streams.
+
+        Args:
+            path (str): The directory of the recording.
+            streams (dict): The width and height of each stream by stream id.
+            queue_size (int, optional): The maximum number of queued packets. Defaults to 64.
+            segment_size (int, optional): The bytes after which a new segment is started. Defaults to SEGMENT_SIZE.
+        """
+        super().__init__(None, ("recording", path), queue_size)
+        self.writer = RecordingWriter(path, streams, segment_size)
+        self.recorded_bytes_total = metrics.REGISTRY.counter("server_recorded_bytes_total", "Bytes recorded to disk")
+        self.subscribe(streams)
+        self.thread = None
+
+    def start(self):
+        """
+        Start the writer thread.
+        """
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """
+        Write queued packets to the recording until the recorder is closed, then write the ones still queued.
+        """
+        try:
+            while self.active or not self.send_queue.empty():
+                try:
+                    packets = self.send_queue.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                self._write(packets)
+                if self.writer.is_full():
+                    with self.lock:
+                        # The next segment starts with keyframes, the packets queued until then end this one
+                        queued = self._take_queued_packets()
+                        self.keyframes_needed.update(self.subscriptions)
+                    for packets in queued:
+                        self._write(packets)
+                    self.writer.next_segment()
+        except OSError as e:
+            print(f"Recording to {self.writer.path} failed: {e}")
+        finally:
+            self.active = False
+            self.writer.close()
+
+    def _write(self, packets):
+        """
+        Append packets to the recording.
+
+        Args:
+            packets (tuple): The packets of a queue entry.
+        """
+        for packet in packets:
+            self.writer.write(packet)
+            self.recorded_bytes_total.inc(len(packet.header_bytes) + len(packet.payload))
+
+    def _take_queued_packets(self):
+        """
+        Take all entries waiting in the send queue.
+
+        Returns:
+            list: The queued entries, in order.
+        """
+        entries = []
+        while True:
+            try:
+                entries.append(self.send_queue.get_nowait())
+            except queue.Empty:
+                return entries
+
+    def close(self):
+        """
+        Stop recording, once the queued packets are written.
+        """
+        self.active = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(JOIN_TIMEOUT)
@@ -0,0 +1,129 @@
+import threading
+
+from common import metrics, protocol
+from keyframe_cache import KeyframeCache
+
+
+class StreamPublisher:
+    """
+    StreamPublisher is the base of the producers of a stream, e.g. a FramePipeline capturing a
+    monitor. It publishes the packets of the stream to the client sessions subscribed to it from
+    a producer thread, and keeps the last keyframe and the deltas since for the ones joining.
+
+    Clients receiving the stream over UDP ask for the tiles they lost to be sent again. Producers
+    that can't add tiles to their deltas resynchronize those clients with a keyframe instead.
+
+    Attributes:
+        stream_id (int): The id of the stream in the messages.
+        keyframe_cache (KeyframeCache): The last keyframe and the deltas since, reproducing the clients' frame.
+        sessions (list): The connected client sessions.
+        running (bool): Whether the producer thread runs.
+        refreshes_tiles (bool): Whether the producer sends the tiles clients asked for again with its next delta.
+    """
+
+    refreshes_tiles = False
+
+    def __init__(self, stream_id=0):
+        """
+        Initializes the StreamPublisher for the given stream.
+
+        Args:
+            stream_id (int, optional): The id of the stream in the messages. Defaults to 0.
+        """
+        self.stream_id = stream_id
+        self.keyframe_cache = KeyframeCache()
+        self.clients_gauge = metrics.REGISTRY.gauge("server_clients", "Clients receiving the stream",
+                                                    stream=str(stream_id))
+        self.sessions = []
+        self.sessions_lock = threading.Lock()
+        self.running = False
+        self.thread = None
+
+    def add_session(self, session):
+        """
+        Register a client session. Once subscribed to the stream, it receives a keyframe with the next captured frame.
+
+        Args:
+            session (ClientSession): The session to add.
+        """
+        with self.sessions_lock:
+            self.sessions.append(session)
+
+    def remove_session(self, session):
+        """
+        Unregister a client session.
+
+        Args:
+            session (ClientSession): The session to remove.
+        """
+        with self.sessions_lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+
+    def close_sessions(self):
+        """
+        Close all client sessions.
+        """
+        with self.sessions_lock:
+            sessions, self.sessions = self.sessions, []
+        for session in sessions:
+            session.close()
+
+    def start(self):
+        """
+        Start the producer thread.
+        """
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the producer thread.
+        """
+        self.running = False
+        if self.thread:
+            self.thread.join()
+
+    def join_sessions(self, sessions):
+        """
+        Synchronize the sessions waiting for a keyframe with the cached keyframe and deltas, and the
+        ones that lost tiles if the producer doesn't send them again.
+
+        Args:
+            sessions (list): The active client sessions.
+
+        Returns:
+            list: The sessions synchronized.
+        """
+        if not self.refreshes_tiles:
+            for session in sessions:
+                if session.take_tile_requests(self.stream_id):
+                    session.request_keyframe(self.stream_id)
+        waiting = [session for session in sessions if session.needs_keyframe(self.stream_id)]
+        if not waiting:
+            return []
+        packets = self.keyframe_cache.packets()
+        if packets is None:
+            return []  # They receive the next keyframe
+        restamped = self.keyframe_cache.packets(protocol.timestamp_now())
+        for session in waiting:
+            session.publish_all(restamped if session.echoes_timestamps else packets)
+        return waiting
+
+    def _active_sessions(self):
+        """
+        Drop disconnected sessions and return the ones subscribed to the stream.
+
+        Returns:
+            list: The active client sessions receiving the stream.
+        """
+        with self.sessions_lock:
+            self.sessions = [session for session in self.sessions if session.active]
+            return [session for session in self.sessions if session.is_subscribed(self.stream_id)]
+
+    def _run(self):
+        """
+        Produce the packets of the stream and publish them until stopped.
+        """
+        raise NotImplementedError
@@ -0,0 +1,101 @@
+import zlib
+from collections import OrderedDict
+import numpy as np
+
+from common import tile_delta
+
+
+class TileCache:
+    """
+    TileCache mirrors the tile cache of the clients, so dirty tiles the clients have received
+    before, e.g. of a window switched back to, are sent as references to their cache slot instead
+    of their pixels.
+
+    The server decides the slot every sent tile is stored in, evicting the least recently used
+    tile, and the clients store and look up tiles as told. All clients receiving the deltas since
+    the last reset hold the same tiles, without tracking their use themselves. Tiles are found by
+    a CRC32 of their pixels and compared before being referenced, so a hash collision only costs
+    a miss.
+
+    A client that is (re)synchronized with a keyframe missed the tiles stored before, so the cache
+    has to be reset then, see reset().
+
+    Attributes:
+        tile_size (int): The tile edge length.
+        slot_count (int): The number of cache slots, at most tile_delta.tile_cache_slots(tile_size).
+        slots (OrderedDict): The slot of each cached tile by its hash, width and height, least recently used first.
+        free_slots (list): The slots holding no tile.
+        pixels (np.ndarray): The (slot_count, tile_size * tile_size) pixels of the cached tiles.
+    """
+
+    def __init__(self, slot_count=None, tile_size=tile_delta.TILE_SIZE):
+        """
+        Initializes an empty TileCache.
+
+        Args:
+            slot_count (int, optional): The number of cache slots, or None for as many as the clients hold.
+                Defaults to None.
+            tile_size (int, optional): The tile edge length. Defaults to tile_delta.TILE_SIZE.
+        """
+        max_slots = tile_delta.tile_cache_slots(tile_size)
+        self.tile_size = tile_size
+        self.slot_count = max_slots if slot_count is None else min(slot_count, max_slots)
+        self.pixels = np.empty((self.slot_count, tile_size * tile_size), dtype=np.uint32)
+        self.scratch = np.empty(0, dtype=np.uint32)  # The dirty tiles, one tile after another
+        self.reset()
+
+    def reset(self):
+        """
+        Forget all cached tiles. Tiles stored in the clients' caches before are not referenced anymore.
+        """
+        self.slots = OrderedDict()
+        self.free_slots = list(range(self.slot_count - 1, -1, -1))
+
+    def update(self, frame, indices):
+        """
+        Look up the dirty tiles of a frame in the cache and store the ones not found.
+
+        Args:
+            frame (np.ndarray): The frame of shape (height, width).
+            indices (np.ndarray): The indices of the dirty tiles.
+
+        Returns:
+            tuple: The indices of the tiles to send, the slot each of them is stored in (tile_delta.NO_SLOT if
+                not stored), the indices of the tiles found in the cache and the slot of each of those.
+        """
+        if not len(indices):
+            return indices, np.zeros(0, dtype=np.uint32), indices, np.zeros(0, dtype=np.uint32)
+
+        frame_height, frame_width = frame.shape
+        _, _, widths, heights, offsets = tile_delta.tile_geometry(indices, frame_width, frame_height, self.tile_size)
+        pixel_count = int(offsets[-1] + widths[-1] * heights[-1])
+        if len(self.scratch) < pixel_count:
+            self.scratch = np.empty(pixel_count, dtype=np.uint32)
+        tile_delta.pack_tiles(frame, indices, self.scratch, self.tile_size)
+
+        # Look up all tiles first, so storing the missing ones never evicts a tile found
+        tiles = []
+        found = np.zeros(len(indices), dtype=bool)
+        cached_slots = []
+        for i, (offset, width, height) in enumerate(zip(offsets.tolist(), widths.tolist(), heights.tolist())):
+            tile = self.scratch[offset:offset + width * height]
+            key = (zlib.crc32(tile), width, height)
+            tiles.append((key, tile))
+            slot = self.slots.get(key)
+            if slot is not None and np.array_equal(self.pixels[slot, :len(tile)], tile):
+                self.slots.move_to_end(key)
+                found[i] = True
+                cached_slots.append(slot)
+
+        # Clients take the found tiles from their cache before storing the sent ones, so any slot may be reused
+        missing = np.flatnonzero(~found)
+        stored_slots = np.full(len(missing), tile_delta.NO_SLOT, dtype=np.uint32)
+        for i, tile_number in enumerate(missing.tolist()):
+            key, tile = tiles[tile_number]
+            if key in self.slots or not self.slot_count:
+                continue  # A tile sent twice in this delta, or a hash collision
+            slot = self.free_slots.pop() if self.free_slots else self.slots.popitem(last=False)[1]
+            self.slots[key] = slot
+            self.pixels[slot, :len(tile)] = tile
+            stored_slots[i] = slot
+        return indices[missing], stored_slots, indices[found], np.array(cached_slots, dtype=np.uint32)
@@ -0,0 +1,165 @@
+import fractions
+import time
+import numpy as np
+
+try:
+    import av
+    from av.video.frame import PictureType
+except ImportError:  # PyAV is optional, without it the server only streams lossless deltas
+    av = None
+
+from common import protocol
+
+SMOOTHING = 0.2  # Weight of a new sample in the moving average of the change rate
+
+# FFmpeg encoder and options of each video codec, tuned for latency: no B-frames and no lookahead
+VIDEO_ENCODERS = {
+    "h264": ("libx264", {"preset": "ultrafast", "tune": "zerolatency", "crf": "23"}),
+    "vp8": ("libvpx", {"deadline": "realtime", "cpu-used": "8", "lag-in-frames": "0"}),
+    "vp9": ("libvpx-vp9", {"deadline": "realtime", "cpu-used": "8", "lag-in-frames": "0", "row-mt": "1"}),
+}
+
+
+class VideoEncoder:
+    """
+    VideoEncoder is a streaming encoder session of one stream, encoding every frame into one packet
+    of a lossy video codec through FFmpeg.
+
+    Attributes:
+        codec (str): The video codec, one of VIDEO_ENCODERS.
+        frame_width (int): The width of the frames, even.
+        frame_height (int): The height of the frames, even.
+        protocol_codec (int): The codec id of the packets in the messages.
+    """
+
+    def __init__(self, codec, frame_width, frame_height, frame_rate, bit_rate=None):
+        """
+        Initializes the VideoEncoder and opens the encoder.
+
+        Args:
+            codec (str): The video codec, one of VIDEO_ENCODERS.
+            frame_width (int): The width of the frames, even.
+            frame_height (int): The height of the frames, even.
+            frame_rate (int): The frame rate the encoder plans its bit rate for.
+            bit_rate (int, optional): The target bit rate of the VP8 and VP9 encoders in bits per second.
+                Defaults to 0.1 bits per pixel. H.264 encodes at a constant quality instead.
+
+        Raises:
+            RuntimeError: If PyAV is not installed.
+            ValueError: If the codec is unknown or the frame size is odd.
+        """
+        if av is None:
+            raise RuntimeError("Video mode requires PyAV, install it with pip install av")
+        if codec not in VIDEO_ENCODERS:
+            raise ValueError(f"Unknown video codec {codec!r}, expected one of {', '.join(VIDEO_ENCODERS)}")
+        if frame_width % 2 or frame_height % 2:
+            raise ValueError(f"Video frames must have an even size, got {frame_width}x{frame_height}")
+
+        self.codec = codec
+        self.frame_width = frame_width
+        self.frame_height = frame_height
+        self.protocol_codec = protocol.VIDEO_CODECS[codec]
+        self.frame_index = 0
+
+        encoder_name, options = VIDEO_ENCODERS[codec]
+        self.context = av.CodecContext.create(encoder_name, "w")
+        self.context.width = frame_width
+        self.context.height = frame_height
+        self.context.pix_fmt = "yuv420p"
+        self.context.time_base = fractions.Fraction(1, frame_rate)
+        self.context.framerate = frame_rate
+        self.context.gop_size = 1 << 30  # Keyframes only when a client needs one
+        self.context.max_b_frames = 0
+        if codec != "h264":
+            self.context.bit_rate = bit_rate or int(0.1 * frame_width * frame_height * frame_rate)
+        self.context.options = options
+
+    def encode(self, frame, keyframe=False):
+        """
+        Encode a frame.
+
+        Args:
+            frame (np.ndarray): The (height, width) uint32 BGRA frame.
+            keyframe (bool, optional): Whether to encode a keyframe the decoder can start from. Defaults to False.
+
+        Returns:
+            tuple: The encoded packet and whether it is a keyframe, or (None, False) if the encoder
+                didn't output a packet for this frame.
+        """
+        bgra = frame.view(np.uint8).reshape((self.frame_height, self.frame_width, 4))
+        video_frame = av.VideoFrame.from_ndarray(bgra, format="bgra").reformat(format="yuv420p")
+        video_frame.pts = self.frame_index
+        self.frame_index += 1
+        if keyframe:
+            video_frame.pict_type = PictureType.I
+
+        packets = self.context.encode(video_frame)
+        if not packets:
+            return None, False
+        return b''.join(bytes(packet) for packet in packets), any(packet.is_keyframe for packet in packets)
+
+
+class VideoModeSelector:
+    """
+    VideoModeSelector switches a stream between the lossless delta mode and the video mode by the
+    share of pixels changing per frame.
+
+    Deltas are small and exact while little changes, e.g. when typing. When most of the frame
+    changes, e.g. during video playback or scrolling, a video codec needs a fraction of the bandwidth.
+
+    Attributes:
+        mode (str): "auto" to switch by the change rate, "always" to stay in video mode.
+        active (bool): Whether the stream is in video mode.
+        change_rate (float): The smoothed share of changed pixels per frame.
+    """
+
+    ENTER_RATIO = 0.3  # Change rate above which video mode pays off
+    EXIT_RATIO = 0.1  # Change rate below which deltas pay off again
+    ENTER_HOLD = 0.5  # Seconds above ENTER_RATIO before switching to video mode
+    EXIT_HOLD = 2.0  # Seconds below EXIT_RATIO before switching back
+
+    def __init__(self, mode="auto"):
+        """
+        Initializes the VideoModeSelector.
+
+        Args:
+            mode (str, optional): "auto" or "always". Defaults to "auto".
+
+        Raises:
+            ValueError: If the mode is unknown.
+        """
+        if mode not in ("auto", "always"):
+            raise ValueError(f"Unknown video mode {mode!r}, expected auto or always")
+        self.mode = mode
+        self.active = mode == "always"
+        self.change_rate = None
+        self.since = None  # When the change rate crossed the threshold towards the other mode
+
+    def update(self, dirty_ratio):
+        """
+        Update the change rate with the latest frame.
+
+        Args:
+            dirty_ratio (float): The share of pixels in the frame's dirty tiles.
+
+        Returns:
+            bool: True if the mode changed.
+        """
+        self.change_rate = dirty_ratio if self.change_rate is None else \
+            self.change_rate + SMOOTHING * (dirty_ratio - self.change_rate)
+        if self.mode == "always":
+            return False
+
+        now = time.perf_counter()
+        crossing = self.change_rate < self.EXIT_RATIO if self.active else self.change_rate > self.ENTER_RATIO
+        if not crossing:
+            self.since = None
+            return False
+        if self.since is None:
+            self.since = now
+        if now - self.since < (self.EXIT_HOLD if self.active else self.ENTER_HOLD):
+            return False
+
+        self.active = not self.active
+        self.since = None
+        return True